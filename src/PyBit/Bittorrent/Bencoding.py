@@ -18,278 +18,795 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from collections import deque
 
 
 ##encode
 
-def _bencode(obj):
-    #bittorrent bencode
-    #Supports: dicts, lists, ints and strings
-    #May store: dicts, lists, tuples, ints, longs and strings
-    result = deque()
-    if type(obj)==dict:
-        #dict
-        result.append('d')
-        keys = obj.keys()
-        keys.sort()
-        for i in keys:
-            result.append(_bencode(i))
-            result.append(_bencode(obj[i]))
-        result.append('e')
-        
-    elif type(obj)==list or type(obj)==tuple:
-        #list or tuple
-        result.append('l')
-        for i in obj:
-            result.append(_bencode(i))
-        result.append('e')
-        
-    elif type(obj)==int or type(obj)==long:
-        #int or long
-        result.append('i')
-        result.append(str(obj))
-        result.append('e')
-        
-    elif type(obj)==str:
-        #string
-        result.append(str(len(obj)))
-        result.append(':')
-        result.append(obj)
-        
-    else:
-        raise Exception('Encountered unsupported element of type "'+str(type(obj))+'", value "'+str(obj)+'"!')
+def _encodeDict(obj, result, encoders):
+    result.append('d')
+    keys = obj.keys()
+    keys.sort()
+    for key in keys:
+        encoders[type(key)](key, result, encoders)
+        value = obj[key]
+        encoders[type(value)](value, result, encoders)
+    result.append('e')
     
-    return ''.join(result)
-
-
-def _bencodeExt(obj):
-    #extended bencode
-    #Supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
-    #May store: dicts, sets, lists, tuples, ints, longs, floats, bools, None, strings and unicode strings
-    result = deque()
-    if type(obj)==dict:
-        #dict
-        result.append('d')
-        keys = obj.keys()
-        keys.sort()
-        for i in keys:
-            result.append(_bencodeExt(i))
-            result.append(_bencodeExt(obj[i]))
-        result.append('e')
-        
-    elif type(obj)==set:
-        #set
-        result.append('s')
-        for i in sorted(obj):
-            result.append(_bencodeExt(i))
-        result.append('e')
-        
-    elif type(obj)==list:
-        #list
-        result.append('l')
-        for i in obj:
-            result.append(_bencodeExt(i))
-        result.append('e')
-        
-    elif type(obj)==tuple:
-        #tuple
-        result.append('t')
-        for i in obj:
-            result.append(_bencodeExt(i))
-        result.append('e')
-        
-    elif type(obj)==int or type(obj)==long:
-        #int or long
-        result.append('i')
-        result.append(str(obj))
-        result.append('e')
-        
-    elif type(obj)==float:
-        #float
-        result.append('f')
-        result.append(str(obj))
-        result.append('e')
-        
-    elif type(obj)==bool:
-        #bool
-        result.append('b')
-        if obj == True:
-            result.append('1')
-        else:
-            result.append('0')
-        result.append('e')
+    
+def _encodeList(obj, result, encoders):
+    result.append('l')
+    for value in obj:
+        encoders[type(value)](value, result, encoders)
+    result.append('e')
+    
+    
+def _encodeSet(obj, result, encoders):
+    result.append('s')
+    for value in sorted(obj):
+        encoders[type(value)](value, result, encoders)
+    result.append('e')
+    
+    
+def _encodeTuple(obj, result, encoders):
+    result.append('t')
+    for value in obj:
+        encoders[type(value)](value, result, encoders)
+    result.append('e')
+    
+    
+def _encodeInt(obj, result, encoders):
+    result.append('i%ie' % (obj,))
+    
+    
+def _encodeFloat(obj, result, encoders):
+    result.append('f%se' % (str(obj),))
+    
+    
+def _encodeBool(obj, result, encoders):
+    if obj == True:
+        result.append('b1e')
+    else:
+        result.append('b0e')
         
-    elif obj is None:
-        #None
-        result.append('n')
         
-    elif type(obj)==str:
-        #string
-        result.append(str(len(obj)))
-        result.append(':')
-        result.append(obj)
+def _encodeNone(obj, result, encoders):
+    result.append('n')
+    
+    
+def _encodeStr(obj, result, encoders):
+    result.append('%i:' % (len(obj),))
+    result.append(obj)
+    
+    
+def _encodeUnicode(obj, result, encoders):
+    encStr = obj.encode('UTF-8')
+    result.append('u%i:' % (len(encStr),))
+    result.append(encStr)
+    
+    
+class _EncoderTable(dict):
+    #maps types to their encode functions, raises a readable exception for unsupported types
+    def __missing__(self, objType):
+        raise Exception('Encountered unsupported element of type "'+str(objType)+'"!')
         
-    elif type(obj)==unicode:
-        #unicode string
-        result.append('u')
-        encStr = obj.encode('UTF-8')
-        result.append(str(len(encStr)))
-        result.append(':')
-        result.append(encStr)
         
-    else:
-        #something unsupported
-        raise Exception('Encountered unsupported element of type "'+str(type(obj))+'"!')
-    
-    return ''.join(result)
+#bittorrent bencode
+#Supports: dicts, lists, ints and strings
+#May store: dicts, lists, tuples, ints, longs and strings
+_encoders = _EncoderTable({dict:_encodeDict,
+                           list:_encodeList,
+                           tuple:_encodeList,
+                           int:_encodeInt,
+                           long:_encodeInt,
+                           str:_encodeStr})
+             
+#extended bencode
+#Supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
+#May store: dicts, sets, lists, tuples, ints, longs, floats, bools, None, strings and unicode strings
+_encodersExt = _EncoderTable({dict:_encodeDict,
+                              set:_encodeSet,
+                              list:_encodeList,
+                              tuple:_encodeTuple,
+                              int:_encodeInt,
+                              long:_encodeInt,
+                              float:_encodeFloat,
+                              bool:_encodeBool,
+                              type(None):_encodeNone,
+                              str:_encodeStr,
+                              unicode:_encodeUnicode})
 
 
 def bencode(obj, extended=False):
+    #all parts are collected in one list, which is joined once at the end
     if extended:
-        result = _bencodeExt(obj)
+        encoders = _encodersExt
     else:
-        result = _bencode(obj)
-    
-    return result
+        encoders = _encoders
+    result = []
+    encoders[type(obj)](obj, result, encoders)
+    return ''.join(result)
 
 
 ##decode
 
+class BdecodeException(Exception):
+    def __init__(self, reason, *args):
+        self.reason = reason % args
+        Exception.__init__(self, self.reason)
 
-def _bdecode(encObj, place = 0):
-    #bittorrent bdecode
-    #Supports: dicts, lists, ints and strings
-    if encObj[place]=='d':
-        #dict
-        place += 1
-        result = {}
-        while not encObj[place]=='e':
-            key, place = _bdecode(encObj, place)
-            value, place = _bdecode(encObj, place)
-            result[key] = value
-        place += 1
-        
-    elif encObj[place]=='l':
-        #dict
-        place += 1
-        result = []
-        while not encObj[place]=='e':
-            value, place = _bdecode(encObj, place)
-            result.append(value)
-        place += 1
-        
-    elif encObj[place]=='i':
-        #int
-        place += 1
-        end = encObj.find('e', place)
-        result = int(encObj[place:end])
-        place = end + 1
-        
-    else:
-        #string
-        collon = encObj.find(':', place)
-        length = int(encObj[place:collon])
-        place = collon + 1
-        result = encObj[place:place+length]
-        place += length
-    
-    return result, place
+    def getReason(self):
+        return self.reason
 
 
-def _bdecodeExt(encObj, place = 0):
-    #extended bdecode
-    #Supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
-    if encObj[place]=='d':
-        #dict
-        place += 1
-        result = {}
-        while not encObj[place]=='e':
-            key, place = _bdecodeExt(encObj, place)
-            value, place = _bdecodeExt(encObj, place)
-            result[key] = value
-        place += 1
-        
-    elif encObj[place]=='s':
-        #set
-        place += 1
-        result = set()
-        while not encObj[place]=='e':
-            value, place = _bdecodeExt(encObj, place)
-            result.add(value)
-        place += 1
-        
-    elif encObj[place]=='l':
-        #list
-        place += 1
-        result = []
-        while not encObj[place]=='e':
-            value, place = _bdecodeExt(encObj, place)
-            result.append(value)
-        place += 1
-        
-    elif encObj[place]=='t':
-        #tuple
-        place += 1
-        result = deque()
-        while not encObj[place]=='e':
-            value, place = _bdecodeExt(encObj, place)
-            result.append(value)
-        result = tuple(result)
-        place += 1
-        
-    elif encObj[place]=='i':
-        #int
-        place += 1
-        end = encObj.find('e', place)
-        result = int(encObj[place:end])
-        place = end + 1
-        
-    elif encObj[place]=='f':
-        #float
-        place += 1
-        end = encObj.find('e', place)
-        result = float(encObj[place:end])
-        place = end + 1
+_digits = frozenset('0123456789')
+
+
+class _TupleList(list):
+    #collects the items of an encoded tuple
+    pass
+
+
+#bittorrent bdecode, supports: dicts, lists, ints and strings
+_containerTypes = {'d':dict, 'l':list}
+
+#extended bdecode, supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
+_containerTypesExt = {'d':dict, 'l':list, 's':set, 't':_TupleList}
+
+#marks a dict which waits for its next key
+_noKey = object()
+
+
+def _bdecode(encObj, place, containerTypes):
+    #decodes one object starting at place, returns the object and the place behind it
+    #works without recursion (nesting depth is only limited by memory), only strings and numbers are sliced out of the input
+    extended = (len(containerTypes) > 2)
+    find = encObj.find
+    encLength = len(encObj)
+    stack = []              #(container, adder, key) of all outer containers which are not yet finished
+    container = None        #innermost unfinished container
+    adder = None            #function for adding an item to it, None for dicts
+    key = _noKey            #key of the next value or _noKey if the next object is a key, only used for dicts
+    while True:
+        if place >= encLength:
+            raise BdecodeException('Encoded object ends after %i bytes, before the end of the object', encLength)
+        char = encObj[place]
+        if char in _digits:
+            #string
+            collon = find(':', place)
+            if collon == -1:
+                raise BdecodeException('String length without ":" (offset %i)', place)
+            length = int(encObj[place:collon])
+            if length < 0 or collon + 1 + length > encLength:
+                raise BdecodeException('String of length %i exceeds the encoded object (offset %i)', length, place)
+            place = collon + 1 + length
+            result = encObj[collon + 1:place]
+            
+        elif char == 'i':
+            #int
+            end = find('e', place)
+            if end == -1:
+                raise BdecodeException('Int without end (offset %i)', place)
+            result = int(encObj[place + 1:end])
+            place = end + 1
+            
+        elif char == 'e':
+            #end of the innermost container
+            if container is None:
+                raise BdecodeException('Unexpected end of container (offset %i)', place)
+            if adder is None and key is not _noKey:
+                raise BdecodeException('Dict key has no value (offset %i)', place)
+            result = container
+            if type(result) is _TupleList:
+                result = tuple(result)
+            container, adder, key = stack.pop()
+            place += 1
+            
+        elif char in containerTypes:
+            #start of a container
+            stack.append((container, adder, key))
+            containerType = containerTypes[char]
+            container = containerType()
+            place += 1
+            if containerType is dict:
+                adder = None
+                key = _noKey
+            elif containerType is set:
+                adder = container.add
+            else:
+                adder = container.append
+            continue
         
-    elif encObj[place]=='b':
-        #bool
-        place += 1
-        end = encObj.find('e', place)
-        if encObj[place:end] == '1':
-            result = True
+        elif extended and char == 'u':
+            #unicode string
+            collon = find(':', place)
+            if collon == -1:
+                raise BdecodeException('String length without ":" (offset %i)', place)
+            length = int(encObj[place + 1:collon])
+            if length < 0 or collon + 1 + length > encLength:
+                raise BdecodeException('String of length %i exceeds the encoded object (offset %i)', length, place)
+            place = collon + 1 + length
+            result = encObj[collon + 1:place].decode('UTF-8')
+            
+        elif extended and char == 'f':
+            #float
+            end = find('e', place)
+            if end == -1:
+                raise BdecodeException('Float without end (offset %i)', place)
+            result = float(encObj[place + 1:end])
+            place = end + 1
+            
+        elif extended and char == 'b':
+            #bool
+            end = find('e', place)
+            if end == -1:
+                raise BdecodeException('Bool without end (offset %i)', place)
+            result = (encObj[place + 1:end] == '1')
+            place = end + 1
+            
+        elif extended and char == 'n':
+            #None
+            result = None
+            place += 1
+            
         else:
-            result = False
-        place = end + 1
-        
-    elif encObj[place]=='n':
-        #None
-        place += 1
-        result = None
-        
-    elif encObj[place]=='u':
-        #unicode string
-        place += 1
-        collon = encObj.find(':', place)
-        length = int(encObj[place:collon])
-        place = collon + 1
-        result = encObj[place:place+length].decode('UTF-8')
-        place += length
-        
-    else:
-        #normal string
-        collon = encObj.find(':', place)
-        length = int(encObj[place:collon])
-        place = collon + 1
-        result = encObj[place:place+length]
-        place += length
-    
+            #something unknown
+            raise BdecodeException('Invalid type identifier "%s" (offset %i)', repr(char), place)
+            
+        #got a complete object
+        if container is None:
+            break
+        elif adder is not None:
+            adder(result)
+        elif key is _noKey:
+            #dict, keys are decoded like any other object (the extended encoding allows non-string keys)
+            key = result
+        else:
+            #dict, store value
+            container[key] = result
+            key = _noKey
+            
     return result, place
 
 
+def bdecodeWithRawValues(encObj, rawKeys):
+    #bittorrent bdecode for an encoded dict, additionally returns the raw encoded values of the given top-level keys
+    #(needed for things like the infohash, which must be calculated over the original encoding)
+    if not encObj[:1]=='d':
+        raise BdecodeException('Encoded object is not a dict')
+    place = 1
+    result = {}
+    rawValues = {}
+    while not encObj[place:place + 1]=='e':
+        if place >= len(encObj):
+            raise BdecodeException('Encoded object ends after %i bytes, before the end of the object', len(encObj))
+        key, place = _bdecode(encObj, place, _containerTypes)
+        valueStart = place
+        value, place = _bdecode(encObj, place, _containerTypes)
+        result[key] = value
+        if key in rawKeys:
+            rawValues[key] = encObj[valueStart:place]
+    return result, rawValues
+
+
 def bdecode(encObj, extended=False):
     if extended:
-        result = _bdecodeExt(encObj, 0)[0]
+        result = _bdecode(encObj, 0, _containerTypesExt)[0]
     else:
-        result = _bdecode(encObj, 0)[0]
-    return result
\ No newline at end of file
+        result = _bdecode(encObj, 0, _containerTypes)[0]
+    return result
+
+
+
+
+##decode - streaming
+
+class BdecodeStream:
+    """
+    Push-style bittorrent bdecode: the encoded object is fed chunk by chunk and decoded as far as possible
+    on every call. Only the unparsed tail of the last chunk (at most one incomplete number or string length)
+    and the parts of an incomplete string are buffered.
+    """
+
+    def __init__(self, maxTokenLength=32):
+        self.maxTokenLength = maxTokenLength    #max length of an incomplete number or string length
+        self.buffer = ''                        #unparsed tail of the fed data
+        self.stringParts = None                 #received parts of an incomplete string
+        self.stringMissing = 0                  #bytes which are still missing to complete that string
+        self.stack = []                         #[container, key] of all unfinished containers, key is None if a dict needs a key
+        self.result = None
+        self.finished = False
+        self.fedBytes = 0
+
+
+    ##internal functions - objects
+
+    def _addObject(self, obj):
+        if len(self.stack) == 0:
+            #got the complete object
+            self.result = obj
+            self.finished = True
+        else:
+            item = self.stack[-1]
+            container = item[0]
+            if type(container) is list:
+                container.append(obj)
+            elif item[1] is None:
+                #key of a dict
+                if not type(obj) is str:
+                    raise BdecodeException('Dict key is not a string (offset %i)', self.fedBytes)
+                item[1] = obj
+            else:
+                #value of a dict
+                container[item[1]] = obj
+                item[1] = None
+
+
+    def _startContainer(self, container):
+        if len(self.stack) > 0 and type(self.stack[-1][0]) is dict and self.stack[-1][1] is None:
+            raise BdecodeException('Dict key is not a string (offset %i)', self.fedBytes)
+        self.stack.append([container, None])
+
+
+    def _endContainer(self):
+        if len(self.stack) == 0:
+            raise BdecodeException('Unexpected end of container (offset %i)', self.fedBytes)
+        container, key = self.stack.pop()
+        if key is not None:
+            raise BdecodeException('Dict key "%s" has no value (offset %i)', key[:64], self.fedBytes)
+        self._addObject(container)
+
+
+    ##internal functions - parsing
+
+    def _parse(self, data):
+        place = 0
+        end = len(data)
+        while place < end:
+            if self.stringMissing > 0:
+                #continue an incomplete string
+                part = data[place:place + self.stringMissing]
+                self.stringParts.append(part)
+                self.stringMissing -= len(part)
+                place += len(part)
+                if self.stringMissing == 0:
+                    obj = ''.join(self.stringParts)
+                    self.stringParts = None
+                    self._addObject(obj)
+                continue
+
+            if self.finished:
+                #ignore anything after the end of the encoded object (like bdecode does), trackers commonly append a newline
+                place = end
+                break
+
+            char = data[place]
+            if char in _digits:
+                #string
+                collon = data.find(':', place, place + self.maxTokenLength)
+                if collon == -1:
+                    break
+                try:
+                    length = int(data[place:collon])
+                except ValueError:
+                    raise BdecodeException('Invalid string length "%s" (offset %i)', data[place:collon], self.fedBytes - end + place)
+                place = collon + 1
+                if length == 0:
+                    self._addObject('')
+                else:
+                    self.stringParts = []
+                    self.stringMissing = length
+
+            elif char == 'i':
+                #int
+                intEnd = data.find('e', place, place + self.maxTokenLength)
+                if intEnd == -1:
+                    break
+                try:
+                    obj = int(data[place + 1:intEnd])
+                except ValueError:
+                    raise BdecodeException('Invalid int "%s" (offset %i)', data[place + 1:intEnd], self.fedBytes - end + place)
+                place = intEnd + 1
+                self._addObject(obj)
+
+            elif char == 'd':
+                self._startContainer({})
+                place += 1
+
+            elif char == 'l':
+                self._startContainer([])
+                place += 1
+
+            elif char == 'e':
+                self._endContainer()
+                place += 1
+
+            else:
+                raise BdecodeException('Invalid type identifier "%s" (offset %i)', repr(char), self.fedBytes - end + place)
+
+        #remember unparsed tail
+        self.buffer = data[place:]
+        if len(self.buffer) >= self.maxTokenLength:
+            raise BdecodeException('Number or string length exceeds %i bytes (offset %i)', self.maxTokenLength, self.fedBytes - len(self.buffer))
+
+
+    ##external functions
+
+    def feed(self, data):
+        #decodes as much of the data as possible, throws BdecodeException if the data is invalid
+        self.fedBytes += len(data)
+        self._parse(self.buffer + data)
+
+
+    def isFinished(self):
+        return self.finished
+
+
+    def getResult(self):
+        #returns the decoded object, throws BdecodeException if it isn't complete yet
+        if not self.finished:
+            raise BdecodeException('Encoded object is incomplete (got %i bytes)', self.fedBytes)
+        return self.result
+
+
+    def getFedBytes(self):
+        return self.fedBytes
+
+
+
+
+if __name__ == '__main__':
+    #micro-benchmark against the previous recursive implementation (kept below as a reference):
+    #metainfo of a large torrent and typical persister payloads, usage: Bencoding.py [runs]
+    from collections import deque
+    from hashlib import sha1
+    from time import time
+    import sys
+    
+    def refBencode(obj):
+        #bittorrent bencode
+        #Supports: dicts, lists, ints and strings
+        #May store: dicts, lists, tuples, ints, longs and strings
+        result = deque()
+        if type(obj)==dict:
+            #dict
+            result.append('d')
+            keys = obj.keys()
+            keys.sort()
+            for i in keys:
+                result.append(refBencode(i))
+                result.append(refBencode(obj[i]))
+            result.append('e')
+    
+        elif type(obj)==list or type(obj)==tuple:
+            #list or tuple
+            result.append('l')
+            for i in obj:
+                result.append(refBencode(i))
+            result.append('e')
+    
+        elif type(obj)==int or type(obj)==long:
+            #int or long
+            result.append('i')
+            result.append(str(obj))
+            result.append('e')
+    
+        elif type(obj)==str:
+            #string
+            result.append(str(len(obj)))
+            result.append(':')
+            result.append(obj)
+    
+        else:
+            raise Exception('Encountered unsupported element of type "'+str(type(obj))+'", value "'+str(obj)+'"!')
+    
+        return ''.join(result)
+    
+    
+    def refBencodeExt(obj):
+        #extended bencode
+        #Supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
+        #May store: dicts, sets, lists, tuples, ints, longs, floats, bools, None, strings and unicode strings
+        result = deque()
+        if type(obj)==dict:
+            #dict
+            result.append('d')
+            keys = obj.keys()
+            keys.sort()
+            for i in keys:
+                result.append(refBencodeExt(i))
+                result.append(refBencodeExt(obj[i]))
+            result.append('e')
+    
+        elif type(obj)==set:
+            #set
+            result.append('s')
+            for i in sorted(obj):
+                result.append(refBencodeExt(i))
+            result.append('e')
+    
+        elif type(obj)==list:
+            #list
+            result.append('l')
+            for i in obj:
+                result.append(refBencodeExt(i))
+            result.append('e')
+    
+        elif type(obj)==tuple:
+            #tuple
+            result.append('t')
+            for i in obj:
+                result.append(refBencodeExt(i))
+            result.append('e')
+    
+        elif type(obj)==int or type(obj)==long:
+            #int or long
+            result.append('i')
+            result.append(str(obj))
+            result.append('e')
+    
+        elif type(obj)==float:
+            #float
+            result.append('f')
+            result.append(str(obj))
+            result.append('e')
+    
+        elif type(obj)==bool:
+            #bool
+            result.append('b')
+            if obj == True:
+                result.append('1')
+            else:
+                result.append('0')
+            result.append('e')
+    
+        elif obj is None:
+            #None
+            result.append('n')
+    
+        elif type(obj)==str:
+            #string
+            result.append(str(len(obj)))
+            result.append(':')
+            result.append(obj)
+    
+        elif type(obj)==unicode:
+            #unicode string
+            result.append('u')
+            encStr = obj.encode('UTF-8')
+            result.append(str(len(encStr)))
+            result.append(':')
+            result.append(encStr)
+    
+        else:
+            #something unsupported
+            raise Exception('Encountered unsupported element of type "'+str(type(obj))+'"!')
+    
+        return ''.join(result)
+    
+    
+    def refBdecode(encObj, place = 0):
+        #bittorrent bdecode
+        #Supports: dicts, lists, ints and strings
+        if encObj[place]=='d':
+            #dict
+            place += 1
+            result = {}
+            while not encObj[place]=='e':
+                key, place = refBdecode(encObj, place)
+                value, place = refBdecode(encObj, place)
+                result[key] = value
+            place += 1
+    
+        elif encObj[place]=='l':
+            #dict
+            place += 1
+            result = []
+            while not encObj[place]=='e':
+                value, place = refBdecode(encObj, place)
+                result.append(value)
+            place += 1
+    
+        elif encObj[place]=='i':
+            #int
+            place += 1
+            end = encObj.find('e', place)
+            result = int(encObj[place:end])
+            place = end + 1
+    
+        else:
+            #string
+            collon = encObj.find(':', place)
+            length = int(encObj[place:collon])
+            place = collon + 1
+            result = encObj[place:place+length]
+            place += length
+    
+        return result, place
+    
+    
+    def refBdecodeExt(encObj, place = 0):
+        #extended bdecode
+        #Supports: dicts, sets, lists, tuples, ints, floats, bools, None, strings and unicode strings
+        if encObj[place]=='d':
+            #dict
+            place += 1
+            result = {}
+            while not encObj[place]=='e':
+                key, place = refBdecodeExt(encObj, place)
+                value, place = refBdecodeExt(encObj, place)
+                result[key] = value
+            place += 1
+    
+        elif encObj[place]=='s':
+            #set
+            place += 1
+            result = set()
+            while not encObj[place]=='e':
+                value, place = refBdecodeExt(encObj, place)
+                result.add(value)
+            place += 1
+    
+        elif encObj[place]=='l':
+            #list
+            place += 1
+            result = []
+            while not encObj[place]=='e':
+                value, place = refBdecodeExt(encObj, place)
+                result.append(value)
+            place += 1
+    
+        elif encObj[place]=='t':
+            #tuple
+            place += 1
+            result = deque()
+            while not encObj[place]=='e':
+                value, place = refBdecodeExt(encObj, place)
+                result.append(value)
+            result = tuple(result)
+            place += 1
+    
+        elif encObj[place]=='i':
+            #int
+            place += 1
+            end = encObj.find('e', place)
+            result = int(encObj[place:end])
+            place = end + 1
+    
+        elif encObj[place]=='f':
+            #float
+            place += 1
+            end = encObj.find('e', place)
+            result = float(encObj[place:end])
+            place = end + 1
+    
+        elif encObj[place]=='b':
+            #bool
+            place += 1
+            end = encObj.find('e', place)
+            if encObj[place:end] == '1':
+                result = True
+            else:
+                result = False
+            place = end + 1
+    
+        elif encObj[place]=='n':
+            #None
+            place += 1
+            result = None
+    
+        elif encObj[place]=='u':
+            #unicode string
+            place += 1
+            collon = encObj.find(':', place)
+            length = int(encObj[place:collon])
+            place = collon + 1
+            result = encObj[place:place+length].decode('UTF-8')
+            place += length
+    
+        else:
+            #normal string
+            collon = encObj.find(':', place)
+            length = int(encObj[place:collon])
+            place = collon + 1
+            result = encObj[place:place+length]
+            place += length
+    
+        return result, place
+    
+    
+    
+    def refBencodeBoth(obj, extended=False):
+        if extended:
+            result = refBencodeExt(obj)
+        else:
+            result = refBencode(obj)
+        return result
+    
+    
+    def refBdecodeBoth(encObj, extended=False):
+        if extended:
+            result = refBdecodeExt(encObj, 0)[0]
+        else:
+            result = refBdecode(encObj, 0)[0]
+        return result
+    
+    
+    runs = 5
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+        
+    pieceAmount = 200000
+    fileAmount = 50000
+    torrent = {'announce':'http://tracker.i2p/announce.php',
+               'announce-list':[['http://tracker%i.i2p/announce.php' % (trackerIdx,)] for trackerIdx in xrange(0, 10)],
+               'info':{'name':'benchmark',
+                       'piece length':262144,
+                       'pieces':''.join(sha1(str(pieceIdx)).digest() for pieceIdx in xrange(0, pieceAmount)),
+                       'files':[{'path':['dir%i' % (fileIdx / 100), 'file%i' % (fileIdx,)], 'length':fileIdx * 1024} for fileIdx in xrange(0, fileAmount)]}}
+    persisterPayloads = [({'firstPiece':fileIdx, 'lastPiece':fileIdx + 10, 'wanted':True, 'priority':0}, '0.3.1') for fileIdx in xrange(0, 10000)]
+    persisterPayloads.append({'requestSize':4096, 'pieces':[(pieceIdx, '\xff' * 8) for pieceIdx in xrange(0, 1000)]})
+    persisterPayloads.append((set(xrange(0, 100000)), None, 1.5, u'unicode'))
+    
+    #round trips, including the non-string dict keys which the persisted state uses (tracker and queue ids)
+    roundTrips = [({'announce':'http://tracker.i2p/a', 'info':{'length':1, 'path':['a', 'b']}, '':{}}, False),
+                  ({'trackers':{1:{'url':'http://tracker.i2p/a', 'tier':0}, 2:{}}, 'queueInfo':{7:{'queueId':7}}}, True),
+                  ({u'k':1, None:1, (1, 2):'x', (1, (u'a', None)):[{}], 1.5:True, False:set([1, 2])}, True),
+                  ({'':{'':{'':''}}, 'l':[[], {}, ()], 's':set(), 't':(1,)}, True)]
+    for obj, extended in roundTrips:
+        encObj = bencode(obj, extended)
+        assert encObj == refBencodeBoth(obj, extended), 'Encoding differs from the reference for %s' % (repr(obj),)
+        assert bdecode(encObj, extended) == obj, 'Round trip failed for %s' % (repr(obj),)
+        assert refBdecodeBoth(encObj, extended) == obj, 'Reference round trip failed for %s' % (repr(obj),)
+    assert bdecodeWithRawValues(bencode(roundTrips[0][0]), ('info',)) == (roundTrips[0][0], {'info':bencode(roundTrips[0][0]['info'])})
+    print 'Round trips: ok'
+    
+    #malformed input, truncated and corrupt data must fail at once
+    malformed = [('li12', False), ('d4:infod6:lengthi12', False), ('4:ab', False), ('i12', False), ('12', False), ('l', False),
+                 ('', False), ('e', False), ('d1:ae', False), ('x', False), ('-5:abcde', False), ('l-1:e', False),
+                 ('u4:ab', True), ('u-5:ab', True), ('f1.5', True), ('b1', True), ('tn', True), ('d1:ae', True)]
+    for encObj, extended in malformed:
+        try:
+            result = bdecode(encObj, extended)
+        except (BdecodeException, ValueError):
+            pass
+        else:
+            raise AssertionError('Decoded malformed input "%s" as %s' % (encObj, repr(result)))
+    for encObj in ('d4:infod6:lengthi12', 'd4:infoi1e', 'd', ''):
+        try:
+            result = bdecodeWithRawValues(encObj, ('info',))
+        except (BdecodeException, ValueError):
+            pass
+        else:
+            raise AssertionError('Decoded malformed input "%s" as %s' % (encObj, repr(result)))
+    print 'Malformed input: ok'
+    
+    def timeFunc(func, *args):
+        times = []
+        for run in xrange(0, runs):
+            start = time()
+            func(*args)
+            times.append(time() - start)
+        return min(times), sum(times) / len(times)
+    
+    def benchmark(name, func, refFunc, *args):
+        newTimes = timeFunc(func, *args)
+        if refFunc is None:
+            oldTimes = '-'
+        else:
+            try:
+                oldTimes = 'best %.4f s, average %.4f s' % timeFunc(refFunc, *args)
+            except RuntimeError:
+                oldTimes = 'fails (recursion limit)'
+        print '%-30s new: best %.4f s, average %.4f s | old: %s' % (name, newTimes[0], newTimes[1], oldTimes)
+        
+    encTorrent = bencode(torrent)
+    encPayloads = [bencode(payload, extended=True) for payload in persisterPayloads]
+    print 'Metainfo: %i bytes, persister payloads: %i (%i bytes)' % (len(encTorrent), len(encPayloads), sum(len(payload) for payload in encPayloads))
+    benchmark('Encode metainfo:', bencode, refBencodeBoth, torrent)
+    benchmark('Decode metainfo:', bdecode, refBdecodeBoth, encTorrent)
+    benchmark('Decode metainfo with raw info:', bdecodeWithRawValues, None, encTorrent, ('info',))
+    benchmark('Encode persister payloads:', lambda: [bencode(payload, extended=True) for payload in persisterPayloads],
+                                            lambda: [refBencodeBoth(payload, extended=True) for payload in persisterPayloads])
+    benchmark('Decode persister payloads:', lambda: [bdecode(payload, extended=True) for payload in encPayloads],
+                                            lambda: [refBdecodeBoth(payload, extended=True) for payload in encPayloads])
+    benchmark('Decode deeply nested list:', bdecode, refBdecodeBoth, 'l' * 100000 + 'e' * 100000)
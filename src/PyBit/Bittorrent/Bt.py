@@ -23,6 +23,7 @@ from BtObjectPersister import BtObjectPersister
 from FilePriority import FilePriority
 from Logger import Logger
 from Measure import Measure
+from PieceBuffer import PieceBuffer
 from PieceStatus import PieceStatus
 from Requester import Requester
 from Storage import Storage, StorageException
@@ -33,7 +34,7 @@ from Utilities import logTraceback
 
 class Bt:
     def __init__(self, config, eventSched, httpRequester, ownAddrFunc, peerId, persister, pInMeasure, pOutMeasure,
-                 peerPool, connBuilder, connListener, connHandler, choker, torrent, torrentIdent, torrentDataPath, version):
+                 peerPool, connBuilder, connListener, connHandler, choker, checkScheduler, diskJobQueue, filePool, mmapPool, pieceBufferBudget, readCache, torrent, torrentIdent, torrentDataPath, version):
         ##global stuff
         self.config = config
         self.version = version
@@ -58,7 +59,10 @@ class Bt:
         self.outRate.stop()
         
         self.log.debug("Creating storage class")
-        self.storage = Storage(self.config, self.btPersister, torrentIdent, self.torrent, torrentDataPath)
+        self.storage = Storage(self.config, self.btPersister, torrentIdent, self.torrent, torrentDataPath, filePool, mmapPool, readCache, checkScheduler)
+        
+        self.log.debug("Creating piece buffer class")
+        self.pieceBuffer = PieceBuffer(pieceBufferBudget, self.storage, torrentIdent)
         
         self.log.debug("Creating global status class")
         self.pieceStatus = PieceStatus(self.torrent.getTotalAmountOfPieces())
@@ -68,7 +72,7 @@ class Bt:
                                      self.torrent, torrentIdent)
         
         self.log.debug("Creating requester class")
-        self.requester = Requester(self.config, self.torrentIdent, self.pieceStatus, self.storage, self.torrent)
+        self.requester = Requester(self.config, self.btPersister, self.torrentIdent, self.pieceStatus, self.storage, self.pieceBuffer, diskJobQueue, self.torrent)
         
         self.log.debug("Creating tracker requester class")
         self.trackerRequester = TrackerRequester(self.config, self.btPersister, eventSched, peerId, self.peerPool, ownAddrFunc, httpRequester,
@@ -92,8 +96,7 @@ class Bt:
     ##internal functions - callbacks
     
     def _addCallbacks(self):
-        ownStatus = self.storage.getStatus()
-        self.persistentStatusCallback = self.config.addCallback((('storage', 'persistPieceStatus'),), ownStatus.enablePersisting)
+        self.persistentStatusCallback = self.config.addCallback((('storage', 'persistPieceStatus'),), self.storage.enablePersisting)
     
         
     def _removeCallbacks(self):
@@ -146,6 +149,24 @@ class Bt:
                 self.inRate.stop()
                 self.outRate.stop()
                 
+        #write buffered blocks of unfinished pieces to disk or drop them if we get removed
+        if targetState == 'remove':
+            self.log.debug("Clearing piece buffer")
+            self.pieceBuffer.clear()
+        else:
+            self.log.debug("Flushing piece buffer")
+            try:
+                self.pieceBuffer.flush()
+            except StorageException, e:
+                self.log.error("Failed to flush piece buffer: %s", e.reason)
+            else:
+                self.log.debug("Persisting partial pieces")
+                self.requester.persistPartialPieces()
+                
+        #close open file handles, they would only block file descriptors while we are not running
+        self.log.debug("Closing open files")
+        self.storage.close()
+                
         #shutdown/removal specific tasks which need to be done regardless of current status
         if targetState in ('shutdown', 'remove'):
             self.log.debug("Removing all infos related to us from connection pool")
@@ -243,7 +264,11 @@ class Bt:
         stats = {}
         
         if wantedStats.get('state', False):
-            stats['state'] = self.state
+            if self.state == 'loading':
+                #waiting for or doing the initial check
+                stats['state'] = self.storage.getLoadState()
+            else:
+                stats['state'] = self.state
         
         #connections
         if wantedStats.get('connections', False):
@@ -286,6 +311,7 @@ class Bt:
         #progress stats
         if wantedStats.get('progress', False):
             stats.update(self.storage.getStats())
+            stats.update(self.pieceBuffer.getStats())
                     
         #requests
         if wantedStats.get('requests', False) or wantedStats.get('pieceAverages', False):
@@ -329,8 +355,7 @@ class Bt:
     
     def setFilePriority(self, fileIds, priority):
         self.lock.acquire()
-        for fileId in fileIds:
-            self.filePrio.setFilePriority(fileId, priority)
+        self.filePrio.setFilePriority(fileIds, priority)
         self.lock.release()
         
         
@@ -341,8 +366,7 @@ class Bt:
             self.connHandler.setFileWantedFlag(self.torrentIdent, fileIds, wanted)
         else:
             #not running
-            for fileId in fileIds:
-                self.filePrio.setFileWantedFlag(fileId, wanted)
+            self.filePrio.setFileWantedFlag(fileIds, wanted)
         self.lock.release()
         
         
@@ -355,6 +379,18 @@ class Bt:
                 self.superSeedingHandler.setEnabled(enabled)
         self.lock.release()
         
+        
+    def setAllocationMode(self, mode):
+        self.lock.acquire()
+        self.storage.setAllocationMode(mode)
+        self.lock.release()
+        
+        
+    def setStorageBackend(self, backend):
+        self.lock.acquire()
+        self.storage.setBackend(backend)
+        self.lock.release()
+        
     ##external funcs - tracker actions
     
     def getTrackerInfo(self):
@@ -42,24 +42,30 @@ class BtQueueManagerException(Exception):
         
         
 class BtQueueManager:
-    def __init__(self, choker, config, connBuilder, connListener, connHandler, eventSched, httpRequester, inRate, outRate,
-                 ownAddrWatcher, peerId, peerPool, persister, progPath, curVersion):
+    def __init__(self, checkScheduler, choker, config, connBuilder, connListener, connHandler, diskJobQueue, eventSched, filePool, httpRequester, inRate, mmapPool, outRate,
+                 ownAddrWatcher, peerId, peerPool, persister, pieceBufferBudget, progPath, readCache, curVersion):
         
         #given classes
+        self.checkScheduler = checkScheduler
         self.choker = choker
         self.config = config
         self.connBuilder = connBuilder
         self.connListener = connListener
         self.connHandler = connHandler
+        self.diskJobQueue = diskJobQueue
         self.eventSched = eventSched
+        self.filePool = filePool
         self.httpRequester = httpRequester
         self.inRate = inRate
+        self.mmapPool = mmapPool
         self.outRate = outRate
         self.ownAddrWatcher = ownAddrWatcher
         self.peerId = peerId
         self.peerPool = peerPool
         self.persister = persister
+        self.pieceBufferBudget = pieceBufferBudget
         self.progPath = progPath
+        self.readCache = readCache
         self.curVersion = curVersion
         
         #log
@@ -103,6 +109,8 @@ class BtQueueManager:
             else:
                 self.log.info('Key "%s" belongs to an inactive queue job, removing it', key)
                 self.persister.remove(key, strict=False)
+                
+        self._updateCheckPriorities()
     
     
     ##internal functions - torrents
@@ -154,7 +162,7 @@ class BtQueueManager:
                 self.queue.setAdd('torrentHash', infohash)
                 self.log.debug('Torrent %i: creating bt class', torrentId)
                 btObj = Bt(self.config, self.eventSched, self.httpRequester, self.ownAddrWatcher.getOwnAddr, self.peerId, self.persister, self.inRate, self.outRate,
-                           self.peerPool, self.connBuilder, self.connListener, self.connHandler, self.choker, torrent, 'Bt'+str(torrentId), torrentDataPath, self.curVersion)
+                           self.peerPool, self.connBuilder, self.connListener, self.connHandler, self.choker, self.checkScheduler, self.diskJobQueue, self.filePool, self.mmapPool, self.pieceBufferBudget, self.readCache, torrent, 'Bt'+str(torrentId), torrentDataPath, self.curVersion)
                 
         return failureMsg, btObj
     
@@ -216,6 +224,14 @@ class BtQueueManager:
     
     ##internal functions - queue
     
+    def _updateCheckPriorities(self):
+        #torrents which are further up in the queue are allowed to check their pieces first
+        priorities = {}
+        for place, queueId in enumerate(self.queue.queueGet()):
+            priorities['Bt'+str(queueId)] = place
+        self.checkScheduler.setPriorities(priorities)
+        
+        
     def _getJobObj(self, queueId, queueInfo):
         if queueInfo['type'] == 'bt':
             #normal torrent job
@@ -238,6 +254,7 @@ class BtQueueManager:
         if failureMsg is None:
             self.queue.queueAdd(queueId, queueInfo)
             self.queueJobs[queueId] = obj
+            self._updateCheckPriorities()
         return failureMsg
     
 
@@ -269,6 +286,7 @@ class BtQueueManager:
             
         elif info['type'] == 'httpFetch':
             self.queue.setRemove('torrentUrl', info['url'])
+        self._updateCheckPriorities()
             
     
     ##external functions - torrents
@@ -356,6 +374,7 @@ class BtQueueManager:
         with self.lock:
             if queueId in self.queueJobs:
                 self.queue.queueMove(queueId, steps)
+                self._updateCheckPriorities()
                 
                 
     ##external functions - torrent actions
@@ -384,6 +403,22 @@ class BtQueueManager:
                     obj.setSuperSeeding(enabled)
                     
     
+    def setAllocationMode(self, torrentId, mode):
+        with self.lock:
+            if torrentId in self.queueJobs:
+                obj = self.queueJobs[torrentId]
+                if isinstance(obj, Bt):
+                    obj.setAllocationMode(mode)
+                    
+    
+    def setStorageBackend(self, torrentId, backend):
+        with self.lock:
+            if torrentId in self.queueJobs:
+                obj = self.queueJobs[torrentId]
+                if isinstance(obj, Bt):
+                    obj.setStorageBackend(backend)
+                    
+    
     def getTrackerInfo(self, torrentId):
         with self.lock:
             trackerInfo = []
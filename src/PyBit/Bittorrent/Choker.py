@@ -131,13 +131,12 @@ class Choker:
         for torrentIdent in self.torrents.iterkeys():
             superSeedingHandler = self.torrents[torrentIdent]['superSeedingHandler']
             ownStatus = self.torrents[torrentIdent]['ownStatus']
-            gotPieces = ownStatus.getGotPieces()
             isFinished = ownStatus.isFinished()
             conns = self.connHandler.getAllConnections(torrentIdent)
             if superSeedingHandler.isEnabled():
                 uploadableConns = set(conn for conn in conns if conn.remoteInterested() and superSeedingHandler.hasOfferedPieces(conn.fileno()))
             else:
-                uploadableConns = set(conn for conn in conns if conn.remoteInterested() and conn.getStatus().hasMatchingMissingPieces(gotPieces))
+                uploadableConns = set(conn for conn in conns if conn.remoteInterested() and conn.getStatus().getAmountOfPiecesNeededByPeer() > 0)
             
             self._chokeTorrent(torrentIdent, conns, uploadableConns, randomSlots, normalSlots, isFinished)
         
@@ -149,7 +148,7 @@ class Choker:
         for torrentIdent in self.torrents.iterkeys():
             superSeedingHandler = self.torrents[torrentIdent]['superSeedingHandler']
             ownStatus = self.torrents[torrentIdent]['ownStatus']
-            gotPieces = ownStatus.getGotPieces()
+            gotPieces = ownStatus.getGotPiecesMask()
             
             info = {}
             info['gotPieces'] = gotPieces
@@ -158,7 +157,7 @@ class Choker:
             if superSeedingHandler.isEnabled():
                 info['uploadableConns'] = set(conn for conn in info['conns'] if conn.remoteInterested() and superSeedingHandler.hasOfferedPieces(conn.fileno()))
             else:
-                info['uploadableConns'] = set(conn for conn in info['conns'] if conn.remoteInterested() and conn.getStatus().hasMatchingMissingPieces(gotPieces))
+                info['uploadableConns'] = set(conn for conn in info['conns'] if conn.remoteInterested() and conn.getStatus().getAmountOfPiecesNeededByPeer() > 0)
             info['neededSlots'] = len(info['uploadableConns'])
             
             torrentInfo[torrentIdent] = info
@@ -22,9 +22,7 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 from Conversion import peerIdToClient
 from Logger import Logger
 from Measure import Measure
-from Status import Status
-from Storage import StorageException
-from Utilities import logTraceback
+from Status import PeerStatus
 import Messages
 
 from collections import deque
@@ -364,7 +362,7 @@ class Connection:
     
     
 class BtConnection(Connection):
-    def __init__(self, torrentIdent, globalStatus, connStatsCache, connStatus, remotePeerId, \
+    def __init__(self, torrentIdent, globalStatus, connStatsCache, diskJobQueue, storage, connStatus, remotePeerId, \
                  scheduler, conn, direction, remotePeerAddr,\
                  inMeasureParent, outMeasureParent, outLimiter, inLimiter):
                     
@@ -386,8 +384,12 @@ class BtConnection(Connection):
         #conn stats cache
         self.connStatsCache = connStatsCache
         
+        #disk job queue and storage
+        self.diskJobQueue = diskJobQueue
+        self.storage = storage
+        
         #piece status
-        self.status = Status(globalStatus.getPieceAmount(), globalStatus)
+        self.status = PeerStatus(globalStatus.getPieceAmount(), globalStatus, storage.getStatus())
         
         #choke and interest state
         self.localInterest = False
@@ -398,7 +400,9 @@ class BtConnection(Connection):
         #requests
         self.outRequestsInFlight = 0
         self.outRequestQueue = []
-        self.outRequestHandles = {}
+        self.outRequestData = {}                #outrequest => prefetched data, None if not read yet
+        self.outRequestsPrefetching = set()     #outrequests whose data is currently being read
+        self.maxPrefetchBytes = 262144          #max number of bytes of queued outrequests which are read ahead
         self.maxInRequests = self._calculateMaxAmountOfInRequests()
         self.inRequestQueue = []
         self.inRequestInfo = {}
@@ -536,49 +540,94 @@ class BtConnection(Connection):
     
     ##internal functions - outrequests
     
+    def _prefetchOutRequests(self):
+        #reads the data of queued outrequests ahead, adjacent or overlapping requests are merged into single reads
+        #only one batch of reads runs at a time, requests which arrive meanwhile get merged into the next batch
+        if not self.localChoke and len(self.outRequestsPrefetching) == 0:
+            bufferedBytes = 0
+            outRequests = []
+            for outRequest in self.outRequestQueue:
+                if bufferedBytes >= self.maxPrefetchBytes:
+                    break
+                bufferedBytes += outRequest[2]
+                if self.outRequestData[outRequest] is None and not outRequest in self.outRequestsPrefetching:
+                    outRequests.append(outRequest)
+            
+            #merge requests into ranges
+            outRequests.sort()
+            ranges = []
+            for outRequest in outRequests:
+                if len(ranges) > 0 and ranges[-1][0] == outRequest[0] and outRequest[1] <= ranges[-1][2] and\
+                   max(ranges[-1][2], outRequest[1] + outRequest[2]) - ranges[-1][1] <= self.maxPrefetchBytes:
+                    #adjacent or overlapping, extend range
+                    ranges[-1][2] = max(ranges[-1][2], outRequest[1] + outRequest[2])
+                    ranges[-1][3].append(outRequest)
+                else:
+                    #start a new range
+                    ranges.append([outRequest[0], outRequest[1], outRequest[1] + outRequest[2], [outRequest]])
+                    
+            #read ranges in the background
+            for pieceIndex, startOffset, endOffset, rangeRequests in ranges:
+                self.outRequestsPrefetching.update(rangeRequests)
+                self.diskJobQueue.addJob(self.torrentIdent, self.storage.getData, funcArgs=[pieceIndex, startOffset, endOffset - startOffset],
+                                         callback=self.gotOutRequestData, callbackArgs=[startOffset, rangeRequests])
+                                         
+                                         
     def _sendOutRequest(self):
-        #queue one outrequest in the outbuffer
-        outRequest = self.outRequestQueue.pop(0)
-        try:
-            #try to get data
-            data = self.outRequestHandles.pop(outRequest)()
-        except StorageException:
+        #queues the first outrequest in the outbuffer if its data was already read
+        if self.outRequestsInFlight == 0 and len(self.outRequestQueue) > 0 and self.outRequestData[self.outRequestQueue[0]] is not None:
+            outRequest = self.outRequestQueue.pop(0)
+            data = self.outRequestData.pop(outRequest)
+            self.outRequestsInFlight += 1
+            message = Messages.generatePiece(outRequest[0], outRequest[1], data)
+            self._queueSend(message, self._outRequestGotSend, [outRequest[2]])
+        
+        
+    def _gotOutRequestData(self, success, data, startOffset, outRequests):
+        if not success:
             #failed to get data
-            self.log.error("Failed to get data for outrequest:\n%s", logTraceback())
-            data = None
+            self.log.error("Failed to get data for outrequests:\n%s", data)
             self._fail("could not get data for outrequest")
             
-        if data is not None:
-            #got data
-            if not len(data) == outRequest[2]:
-                 self.log.error("Did not get enough data for outrequest: expected %i, got %i!", outRequest[2], len(data))
-                 self._fail("could not get data for outrequest")
+        else:
+            #split data, requests which were removed in the meantime are ignored
+            failed = False
+            for outRequest in outRequests:
+                if outRequest in self.outRequestsPrefetching:
+                    self.outRequestsPrefetching.remove(outRequest)
+                    requestData = data[outRequest[1] - startOffset:outRequest[1] - startOffset + outRequest[2]]
+                    if not len(requestData) == outRequest[2]:
+                        #got too few data
+                        self.log.error("Did not get enough data for outrequest: expected %i, got %i!", outRequest[2], len(requestData))
+                        failed = True
+                    else:
+                        self.outRequestData[outRequest] = requestData
+                    
+            if failed:
+                self._fail("could not get data for outrequest")
             else:
-                message = Messages.generatePiece(outRequest[0], outRequest[1], data)
-                self.outRequestsInFlight += 1
-                self._queueSend(message, self._outRequestGotSend, [outRequest[2]])
+                self._sendOutRequest()
+                self._prefetchOutRequests()
         
 
     def _outRequestGotSend(self, dataSize):
         self.outRate.updatePayloadCounter(dataSize)
         self.outRequestsInFlight -= 1
         assert self.outRequestsInFlight == 0, 'multiple out requests in flight?!'
-        assert len(self.outRequestQueue) == len(self.outRequestHandles), 'out of sync: queue length %i but %i handles!' % (len(self.outRequestQueue), len(self.outRequestHandles))
-        if len(self.outRequestQueue) > 0 and self.outRequestsInFlight == 0:
-            self._sendOutRequest()
+        assert len(self.outRequestQueue) == len(self.outRequestData), 'out of sync: queue length %i but %i data entries!' % (len(self.outRequestQueue), len(self.outRequestData))
+        self._sendOutRequest()
+        self._prefetchOutRequests()
         
         
-    
-    def _addOutRequest(self, pieceIndex, offset, length, dataHandle):
-        self.outRequestQueue.append((pieceIndex, offset, length))
-        self.outRequestHandles[(pieceIndex, offset, length)] = dataHandle
-        if self.outRequestsInFlight == 0:
-            #no outrequest is currently being send, send one directly
-            self._sendOutRequest()
+    def _addOutRequest(self, pieceIndex, offset, length):
+        outRequest = (pieceIndex, offset, length)
+        self.outRequestQueue.append(outRequest)
+        self.outRequestData[outRequest] = None
+        self._prefetchOutRequests()
             
     
     def _hasThisOutRequest(self, pieceIndex, offset, length):
-        return (pieceIndex, offset, length) in self.outRequestHandles
+        return (pieceIndex, offset, length) in self.outRequestData
         
         
     def _getAmountOfOutRequests(self):
@@ -588,14 +637,16 @@ class BtConnection(Connection):
     def _delOutRequest(self, pieceIndex, offset, length):
         #try to find the request and delete it if found
         outRequest = (pieceIndex, offset, length)
-        if outRequest in self.outRequestHandles:
+        if outRequest in self.outRequestData:
             self.outRequestQueue.remove(outRequest)
-            del self.outRequestHandles[outRequest]
+            del self.outRequestData[outRequest]
+            self.outRequestsPrefetching.discard(outRequest)
             
             
     def _delAllOutRequests(self):
         self.outRequestQueue = []
-        self.outRequestHandles.clear()
+        self.outRequestData.clear()
+        self.outRequestsPrefetching.clear()
     
     
     ##internal functions - choking and interest
@@ -764,10 +815,18 @@ class BtConnection(Connection):
     
     ##internal functions - outrequests
     
-    def addOutRequest(self, pieceIndex, offset, length, dataHandle):
+    def addOutRequest(self, pieceIndex, offset, length):
+        self.lock.acquire()
+        if not self.closed:
+            self._addOutRequest(pieceIndex, offset, length)
+        self.lock.release()
+        
+        
+    def gotOutRequestData(self, success, data, startOffset, outRequests):
+        #called once the disk job for a range of outrequests is done
         self.lock.acquire()
         if not self.closed:
-            self._addOutRequest(pieceIndex, offset, length, dataHandle)
+            self._gotOutRequestData(success, data, startOffset, outRequests)
         self.lock.release()
         
     
@@ -845,6 +904,7 @@ class BtConnection(Connection):
         stats['remoteChoke'] = self.remoteChoke
         stats['localRequestCount'] = len(self.inRequestQueue)
         stats['remoteRequestCount'] = self.outRequestsInFlight + len(self.outRequestQueue)
+        stats['prefetchedBytes'] = sum(len(data) for data in self.outRequestData.itervalues() if data is not None)
         stats['avgInRawSpeed'] = self.inRate.getAverageRate() * 1024
         stats['avgOutRawSpeed'] = self.outRate.getAverageRate() * 1024
         stats['avgInPayloadSpeed'] = self.inRate.getAveragePayloadRate() * 1024
@@ -30,11 +30,12 @@ import Messages
 from Utilities import logTraceback
 
 class ConnectionHandler:
-    def __init__(self, config, connStatsCache, peerPool, selectFunc, scheduler, inLimiter, outLimiter, peerId):
+    def __init__(self, config, connStatsCache, diskJobQueue, peerPool, sockManager, scheduler, inLimiter, outLimiter, peerId):
         self.config = config
         self.connStatsCache = connStatsCache
+        self.diskJobQueue = diskJobQueue
         self.peerPool = peerPool
-        self.selectFunc = selectFunc
+        self.sockManager = sockManager
         self.scheduler = scheduler
         
         self.inLimiter = inLimiter
@@ -51,6 +52,7 @@ class ConnectionHandler:
         self.lock = threading.Lock()
         self.shouldStop = False
         self.thread = None
+        self.wakeupId = None       #virtual socket which gets recvable when a disk job finished
         self._start()
         
     
@@ -71,6 +73,7 @@ class ConnectionHandler:
                                        'connIds':set(),
                                        'connPeerIds':set(),
                                        'connRemoteAddrs':set()}
+        requester.setPieceFinishedFunc(self._finishedPiece)
                                     
                                     
     def _getTorrentInfo(self, conn):
@@ -79,6 +82,12 @@ class ConnectionHandler:
                                 
     def _removeTorrent(self, torrentIdent):
         self._removeAllConnectionsOfTorrent(torrentIdent, "removing torrent")
+        
+        #wait for running disk jobs of this torrent and process their results
+        self.diskJobQueue.waitForJobs(torrentIdent)
+        self.diskJobQueue.processFinishedJobs(torrentIdent)
+        
+        self.torrents[torrentIdent]['requester'].setPieceFinishedFunc(None)
         del self.torrents[torrentIdent]
         
         
@@ -97,7 +106,7 @@ class ConnectionHandler:
             self.peerPool.lostConnection(torrentIdent, remoteAddr)
         else:
             #really add this conn
-            conn = BtConnection(torrentIdent, torrent['pieceStatus'], self.connStatsCache, self.connStatus,\
+            conn = BtConnection(torrentIdent, torrent['pieceStatus'], self.connStatsCache, self.diskJobQueue, torrent['storage'], self.connStatus,\
                                 remotePeerId, self.scheduler, connSock, direction, remoteAddr,\
                                 torrent['inMeasure'], torrent['outMeasure'], self.outLimiter, self.inLimiter)
             connId = conn.fileno()
@@ -147,19 +156,52 @@ class ConnectionHandler:
         
     ##internal functions - other
     
+    def _finishedPiece(self, torrentIdent, pieceIndex):
+        #called by the requester once a piece was downloaded and checked
+        self.log.debug('Piece %i is finished', pieceIndex)
+        torrent = self.torrents[torrentIdent]
+        
+        #deal with peers
+        weAreFinished = torrent['ownStatus'].isFinished()
+        weAreSuperSeeding = torrent['superSeedingEnabled']
+        
+        for connId in torrent['connIds'].copy():
+            conn = self.conns[connId]
+            status = conn.getStatus()
+            status.ownGotPiece(pieceIndex)
+            
+            #send have if needed
+            if not weAreSuperSeeding:
+                conn.send(Messages.generateHave(pieceIndex))
+            
+            if weAreFinished and status.getAmountOfPiecesNeededByPeer() == 0:
+                #nothing to gain, nothing to give - diconnect
+                self._removeConnection(connId, "we are finished downloading and this peer has already all pieces which we have", False)
+            
+            else:
+                if conn.localInterested():
+                    #we were interested up to now
+                    if status.getAmountOfPiecesNeededByUs() == 0:
+                        #nothing to request anymore
+                        conn.setLocalInterest(False)
+                        torrent['requester'].connGotNotInteresting(conn)
+        
+        if weAreSuperSeeding:
+            torrent['superSeedingHandler'].gotNewPiece(pieceIndex)
+            
+    
     def _recheckConnLocalInterest(self, torrent):
         #recheck interest in conns
-        gotPieces = torrent['ownStatus'].getGotPieces()
-        neededPieces = torrent['ownStatus'].getNeededPieces()
         weAreFinished = torrent['ownStatus'].isFinished()
                 
         for connId in torrent['connIds'].copy():
             conn = self.conns[connId]
             status = conn.getStatus()
+            status.ownNeededPiecesChanged()
             
             if weAreFinished:
                 #seed-like
-                if not status.hasMatchingMissingPieces(gotPieces):
+                if status.getAmountOfPiecesNeededByPeer() == 0:
                     #we won't gain new pieces and this peer already has all we have, disconnect
                     self._removeConnection(connId, "we are finished downloading and this peer has already all pieces which we have", False)
                 elif conn.localInterested():
@@ -170,7 +212,7 @@ class ConnectionHandler:
             else:
                 #still downloading
                 localInterested = conn.localInterested()
-                hasMatchingPieces = status.hasMatchingGotPieces(neededPieces)
+                hasMatchingPieces = (status.getAmountOfPiecesNeededByUs() > 0)
                 if localInterested and not hasMatchingPieces:
                     #nothing to request anymore
                     conn.setLocalInterest(False)
@@ -184,8 +226,7 @@ class ConnectionHandler:
     def _setFileWantedFlag(self, torrentIdent, fileIds, wanted):
         torrentSet = self.torrents[torrentIdent]
         filePrio = torrentSet['filePriority']
-        for fileId in fileIds:
-            filePrio.setFileWantedFlag(fileId, wanted)
+        filePrio.setFileWantedFlag(fileIds, wanted)
         torrentSet['requester'].reset()
         self._recheckConnLocalInterest(torrentSet)
     
@@ -229,7 +270,7 @@ class ConnectionHandler:
             #remote interested
             if conn.remoteInterested():
                 self.log.warning('Conn %i: Set "interested"-flag and they already told us before!', conn.fileno())
-            elif not self._getTorrentInfo(conn)['ownStatus'].hasMatchingGotPieces(conn.getStatus().getMissingPieces()):
+            elif conn.getStatus().getAmountOfPiecesNeededByPeer() == 0:
                 self.log.warning('Conn %i: Set "interested"-flag and we have nothing to send them. What do they want?! - still processing because peers are dumb', conn.fileno())
                 shouldProcess = True
             else:
@@ -259,16 +300,13 @@ class ConnectionHandler:
         elif message[0] == 5:
             #remotes bitfield
             normalLength = self._getTorrentInfo(conn)['torrent'].getTotalAmountOfPieces()
-            if normalLength%8 == 0:
-                wantedLength = normalLength
-            else:
-                wantedLength = normalLength + (8 - normalLength%8)
+            wantedLength = (normalLength + 7) / 8
                 
             if not wantedLength == len(message[1]):
                 self.log.warning('Conn %i: Bitfield has the wrong size! (Wanted: %i Got: %i)',
                                  conn.fileno(), wantedLength, len(message[1]))
                                 
-            elif '1' in message[1][normalLength:]:
+            elif normalLength%8 != 0 and ord(message[1][-1]) & (0xFF >> (normalLength%8)):
                 self.log.warning('Conn %i: Bitfield contains positive flags in padding data!',
                                  conn.fileno())
                             
@@ -378,7 +416,7 @@ class ConnectionHandler:
             status = conn.getStatus()
             status.gotPiece(message[1])
             
-            if torrent['ownStatus'].isFinished() and not status.hasMatchingMissingPieces(torrent['ownStatus'].getGotPieces()):
+            if torrent['ownStatus'].isFinished() and status.getAmountOfPiecesNeededByPeer() == 0:
                 #nothing to gain, nothing to give - diconnect
                 self._removeConnection(connId, "we are finished downloading and this peer has already all pieces which we have", False)
             
@@ -405,7 +443,7 @@ class ConnectionHandler:
             status = conn.getStatus()
             status.addBitfield(message[1])
 
-            if torrent['ownStatus'].isFinished() and not status.hasMatchingMissingPieces(torrent['ownStatus'].getGotPieces()):
+            if torrent['ownStatus'].isFinished() and status.getAmountOfPiecesNeededByPeer() == 0:
                 #nothing to gain, nothing to give - diconnect
                 self._removeConnection(connId, "we are finished downloading and this peer has already all pieces which we have", False)
             
@@ -415,7 +453,7 @@ class ConnectionHandler:
                     torrent['superSeedingHandler'].connGotBitfield(connId)
                     
                 #check if the peer has something interesting
-                if status.hasMatchingGotPieces(torrent['ownStatus'].getNeededPieces()):
+                if status.getAmountOfPiecesNeededByUs() > 0:
                     #yep he has
                     self.log.debug('Conn %i: Interested in peer after getting bitfield', connId)
                     conn.setLocalInterest(True)
@@ -424,8 +462,7 @@ class ConnectionHandler:
             #remote request
             self.log.debug('Conn %i: Got request for piece %i with offset %i and length %i',\
                             connId, message[1][0], message[1][1], message[1][2])
-            dataHandle = self._getTorrentInfo(conn)['storage'].getDataHandle(message[1][0],message[1][1],message[1][2])
-            conn.addOutRequest(message[1][0],message[1][1],message[1][2], dataHandle)
+            conn.addOutRequest(message[1][0],message[1][1],message[1][2])
             
         elif message[0] == 7:
             #got data
@@ -435,40 +472,8 @@ class ConnectionHandler:
             #remove request from list
             conn.finishedInRequest(message[1][0], message[1][1], len(message[1][2]))
             
-            #notify requester
-            torrent = self._getTorrentInfo(conn)
-            if torrent['requester'].finishedRequest(message[1][2], conn, message[1][0], message[1][1]):
-                #finished to retrieve a whole piece
-                self.log.debug('Piece %i is finished', message[1][0])
-                
-                #deal with peers
-                gotPieces = torrent['ownStatus'].getGotPieces()
-                neededPieces = torrent['ownStatus'].getNeededPieces()
-                weAreFinished = torrent['ownStatus'].isFinished()
-                weAreSuperSeeding = torrent['superSeedingEnabled']
-                
-                for connId in torrent['connIds'].copy():
-                    conn = self.conns[connId]
-                    status = conn.getStatus()
-                    
-                    #send have if needed
-                    if not weAreSuperSeeding:
-                        conn.send(Messages.generateHave(message[1][0]))
-                    
-                    if weAreFinished and not status.hasMatchingMissingPieces(gotPieces):
-                        #nothing to gain, nothing to give - diconnect
-                        self._removeConnection(connId, "we are finished downloading and this peer has already all pieces which we have", False)
-                    
-                    else:
-                        if conn.localInterested():
-                            #we were interested up to now
-                            if not status.hasMatchingGotPieces(neededPieces):
-                                #nothing to request anymore
-                                conn.setLocalInterest(False)
-                                torrent['requester'].connGotNotInteresting(conn)
-                
-                if weAreSuperSeeding:
-                    torrent['superSeedingHandler'].gotNewPiece(message[1][0])
+            #notify requester, finished pieces are checked in the background and reported to _finishedPiece()
+            self._getTorrentInfo(conn)['requester'].finishedRequest(message[1][2], conn, message[1][0], message[1][1])
                             
         elif message[0] == 8:
             #cancel
@@ -492,19 +497,39 @@ class ConnectionHandler:
     def _stop(self):
         self.shouldStop = True
         
+        
+    def _diskJobFinished(self):
+        #called by the disk worker threads, without holding any lock
+        wakeupId = self.wakeupId
+        if wakeupId is not None:
+            self.sockManager.wakeup(wakeupId)
+        
 
     ##internal functions - main loop
     
     def run(self):
         try:
             self.lock.acquire()
+            self.wakeupId = self.sockManager.wakeupSocket()
+            self.diskJobQueue.setFinishedJobFunc(self._diskJobFinished)
             while not self.shouldStop:
                 recv, send, error = self.connStatus.getSelectSets()
                 
+                if self.diskJobQueue.isWriteBacklogFull():
+                    #too much data is waiting to be written to disk, stop receiving until the disk caught up
+                    recv = set()
+                recv.add(self.wakeupId)
+                
                 self.lock.release()
-                recv, send, error = self.selectFunc(recv, send, error, timeout=0.25)
+                recv, send, error = self.sockManager.select(recv, send, error, timeout=0.25)
                 self.lock.acquire()
                 
+                #finished disk jobs, the wakeup needs to be cleared before processing them or a completion could get lost
+                if self.wakeupId in recv:
+                    recv.remove(self.wakeupId)
+                    self.sockManager.clearWakeup(self.wakeupId)
+                self.diskJobQueue.processFinishedJobs()
+                
                 #failed conns
                 for connId in error:
                     if connId in self.conns:
@@ -530,6 +555,9 @@ class ConnectionHandler:
                         #conn still exists
                         self.conns[connId].sendEvent() 
             
+            self.diskJobQueue.setFinishedJobFunc(None)
+            self.sockManager.close(self.wakeupId)
+            self.wakeupId = None
             self.thread = None
             self.log.info("Stopping")
             self.lock.release()
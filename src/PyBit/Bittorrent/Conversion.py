@@ -17,11 +17,13 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from array import array
 from collections import deque
 from socket import inet_ntoa
 
 import hashlib
 import binascii
+import string
 
 
 ##binary
@@ -187,6 +189,55 @@ def hashToHex(toHash):
     return binascii.hexlify(hashlib.sha1(toHash).digest()).upper()
 
 
+##bitfields (packed bits, piece 0 is the highest bit of the first byte)
+
+#byte => byte with reversed bit order
+_reversedBits = string.maketrans(''.join(chr(byte) for byte in xrange(0, 256)),
+                                 ''.join(chr(sum([((byte >> bit) & 1) << (7 - bit) for bit in xrange(0, 8)])) for byte in xrange(0, 256)))
+
+#byte => number of set bits as a byte
+_bitCounts = string.maketrans(''.join(chr(byte) for byte in xrange(0, 256)),
+                              ''.join(chr(sum([(byte >> bit) & 1 for bit in xrange(0, 8)])) for byte in xrange(0, 256)))
+
+#byte => offsets of the set bits within the byte
+_bitOffsets = tuple(tuple(bitOffset for bitOffset in xrange(0, 8) if byte & (128 >> bitOffset)) for byte in xrange(0, 256))
+
+
+def bitfieldToMask(bitfield):
+    #converts a bitfield into a long, with piece i as bit i
+    if len(bitfield) == 0:
+        mask = 0L
+    else:
+        mask = long(binascii.b2a_hex(bitfield[::-1].translate(_reversedBits)), 16)
+    return mask
+
+
+def maskToBitfield(mask, pieceAmount):
+    #converts a long with piece i as bit i into a bitfield for the given number of pieces
+    byteAmount = (pieceAmount + 7) / 8
+    if byteAmount == 0:
+        bitfield = ''
+    else:
+        bitfield = binascii.a2b_hex(('%x' % (mask,)).zfill(byteAmount * 2))[::-1].translate(_reversedBits)
+    return bitfield
+
+
+def bitfieldBitCount(bitfield):
+    #returns the number of set bits
+    bitCounts = bitfield.translate(_bitCounts)
+    return sum([bitCounts.count(chr(bitCount)) * bitCount for bitCount in xrange(1, 9)])
+
+
+def bitfieldToPieces(bitfield):
+    #returns a list of the indexes of all set bits
+    pieces = []
+    for byteIdx, byte in enumerate(array('B', bitfield)):
+        if byte:
+            base = byteIdx * 8
+            pieces.extend([base + bitOffset for bitOffset in _bitOffsets[byte]])
+    return pieces
+
+
 ##bt specific
 
 def peerIdToClient(peerId):
@@ -0,0 +1,256 @@
+"""
+Copyright 2009  Blub
+
+DiskJobQueue, a class which executes disk related jobs with a pool of worker threads.
+This file is part of PyBit.
+
+PyBit is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, version 2 of the License.
+
+PyBit is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+##builtin
+from __future__ import with_statement
+from collections import deque, defaultdict
+import logging
+import threading
+
+##own
+from Utilities import logTraceback
+
+
+class DiskJobQueue:
+    """
+    Executes disk jobs (reads, writes, piece checks) in worker threads. Finished jobs are queued until
+    processFinishedJobs() gets called, which then executes the callbacks of these jobs in the calling thread.
+    Jobs with the same key are executed one after another in the order they were added.
+    If set, the finished job func gets called (outside of the lock) whenever a job finishes while no other finished
+    job is waiting, so that the thread which processes the finished jobs doesn't need to poll.
+    """
+
+    def __init__(self, workerAmount, maxWriteBacklog=33554432):
+        self.maxWriteBacklog = maxWriteBacklog     #max number of bytes of queued write jobs before the backlog counts as full
+
+        #jobs
+        self.jobQueue = deque()                    #jobs which may be executed right away
+        self.keyQueues = {}                        #key => deque of jobs which need to wait for the currently running job with the same key
+        self.finishedJobs = deque()                #jobs which were executed but whose callbacks weren't called yet
+        self.identJobs = defaultdict(int)          #ident => number of jobs which are queued or running
+        self.finishedJobFunc = None                #called without arguments when the first job gets added to finishedJobs
+
+        #stats
+        self.runningJobs = 0
+        self.writeBacklog = 0
+        self.executedJobs = 0
+        self.failedJobs = 0
+
+        #workers
+        self.workerAmount = workerAmount
+        self.workers = set()
+        self.workerId = 0
+        self.shouldStop = False
+
+        self.log = logging.getLogger('DiskJobQueue')
+        self.lock = threading.Lock()
+        self.jobEvent = threading.Condition(self.lock)       #notified when a job gets added
+        self.identEvent = threading.Condition(self.lock)     #notified when a job finished
+
+        self._startWorkers()
+
+
+    ##internal functions - workers
+
+    def _startWorkers(self):
+        while len(self.workers) < self.workerAmount:
+            workerId = self.workerId
+            self.workerId += 1
+            thread = threading.Thread(target=self.run, args=(workerId,))
+            thread.setDaemon(True)
+            self.workers.add(workerId)
+            thread.start()
+
+
+    ##internal functions - jobs
+
+    def _queueJob(self, job):
+        key = job['key']
+        if key is None:
+            #no ordering needed
+            self.jobQueue.append(job)
+            self.jobEvent.notify()
+
+        elif key in self.keyQueues:
+            #another job with this key is queued or running, need to wait
+            self.keyQueues[key].append(job)
+
+        else:
+            #first job with this key
+            self.keyQueues[key] = deque()
+            self.jobQueue.append(job)
+            self.jobEvent.notify()
+
+
+    def _finishedJob(self, job):
+        #returns True if the finished job func needs to be called
+        key = job['key']
+        if key is not None:
+            #release next job with the same key
+            keyQueue = self.keyQueues[key]
+            if len(keyQueue) == 0:
+                del self.keyQueues[key]
+            else:
+                self.jobQueue.append(keyQueue.popleft())
+                self.jobEvent.notify()
+
+        self.runningJobs -= 1
+        self.writeBacklog -= job['writeBytes']
+        self.executedJobs += 1
+        if not job['success']:
+            self.failedJobs += 1
+        notify = (len(self.finishedJobs) == 0)
+        self.finishedJobs.append(job)
+        self.identEvent.notifyAll()
+        return notify
+
+
+    ##internal functions - main loop
+
+    def run(self, workerId):
+        self.lock.acquire()
+        while not (self.shouldStop or len(self.workers) > self.workerAmount):
+            if len(self.jobQueue) == 0:
+                #nothing to do
+                self.jobEvent.wait()
+            else:
+                #execute one job
+                job = self.jobQueue.popleft()
+                self.runningJobs += 1
+                self.lock.release()
+
+                try:
+                    job['result'] = job['func'](*job['funcArgs'], **job['funcKw'])
+                    job['success'] = True
+                except:
+                    job['result'] = logTraceback()
+                    job['success'] = False
+
+                self.lock.acquire()
+                if self._finishedJob(job):
+                    finishedJobFunc = self.finishedJobFunc
+                    if finishedJobFunc is not None:
+                        #don't hold the lock while calling foreign code
+                        self.lock.release()
+                        try:
+                            finishedJobFunc()
+                        except:
+                            self.log.error('Error in finished job func:\n%s', logTraceback())
+                        self.lock.acquire()
+
+        self.workers.remove(workerId)
+        self.lock.release()
+
+
+    ##external functions - jobs
+
+    def addJob(self, ident, func, funcArgs=[], funcKw={}, callback=None, callbackArgs=[], callbackKw={}, key=None, writeBytes=0):
+        #the callback gets called with (success, result, *callbackArgs, **callbackKw), result is the traceback if the job failed
+        with self.lock:
+            job = {'ident':ident,
+                   'func':func,
+                   'funcArgs':funcArgs,
+                   'funcKw':funcKw,
+                   'callback':callback,
+                   'callbackArgs':callbackArgs,
+                   'callbackKw':callbackKw,
+                   'key':key,
+                   'writeBytes':writeBytes,
+                   'success':False,
+                   'result':None}
+            self.identJobs[ident] += 1
+            self.writeBacklog += writeBytes
+            self._queueJob(job)
+
+
+    def processFinishedJobs(self, ident=None):
+        #executes the callbacks of finished jobs (all or only those of one ident) in the calling thread
+        with self.lock:
+            if ident is None:
+                jobs = self.finishedJobs
+                self.finishedJobs = deque()
+            else:
+                jobs = deque(job for job in self.finishedJobs if job['ident'] == ident)
+                self.finishedJobs = deque(job for job in self.finishedJobs if not job['ident'] == ident)
+
+            for job in jobs:
+                self.identJobs[job['ident']] -= 1
+                if self.identJobs[job['ident']] == 0:
+                    del self.identJobs[job['ident']]
+
+        for job in jobs:
+            if job['callback'] is not None:
+                try:
+                    job['callback'](job['success'], job['result'], *job['callbackArgs'], **job['callbackKw'])
+                except:
+                    self.log.error('Error in callback of disk job:\n%s', logTraceback())
+
+
+    def waitForJobs(self, ident):
+        #blocks until all queued or running jobs of this ident were executed, does not process their callbacks
+        with self.lock:
+            while self.identJobs.get(ident, 0) > len([job for job in self.finishedJobs if job['ident'] == ident]):
+                self.identEvent.wait()
+
+
+    def hasPendingJobs(self):
+        with self.lock:
+            return (len(self.identJobs) > 0)
+
+
+    def isWriteBacklogFull(self):
+        with self.lock:
+            return (self.writeBacklog >= self.maxWriteBacklog)
+
+
+    def setFinishedJobFunc(self, finishedJobFunc):
+        #finishedJobFunc may be None to remove a previously set func
+        with self.lock:
+            self.finishedJobFunc = finishedJobFunc
+
+
+    ##external functions - workers
+
+    def setWorkerAmount(self, workerAmount):
+        with self.lock:
+            self.workerAmount = workerAmount
+            if len(self.workers) > workerAmount:
+                #wakeup workers so that the unneeded ones notice that they should stop
+                self.jobEvent.notifyAll()
+            else:
+                self._startWorkers()
+
+
+    def stop(self):
+        with self.lock:
+            self.shouldStop = True
+            self.jobEvent.notifyAll()
+
+
+    ##external functions - stats
+
+    def getStats(self):
+        with self.lock:
+            stats = {}
+            stats['diskJobsQueued'] = len(self.jobQueue) + sum(len(keyQueue) for keyQueue in self.keyQueues.itervalues())
+            stats['diskJobsRunning'] = self.runningJobs
+            stats['diskJobsExecuted'] = self.executedJobs
+            stats['diskJobsFailed'] = self.failedJobs
+            stats['diskWriteBacklog'] = self.writeBacklog
+        return stats
@@ -34,12 +34,12 @@ class FilePriority:
         if self.fileInfo is None:
             #nothing stored, create info from scratch
             self.log.debug('No stored file info found, creating it from scratch')
-            files = torrent.getFiles()
             pieceLength = torrent.getPieceLength()
             self.fileInfo = []
-            for file in files:
-                self.fileInfo.append({'firstPiece':file['offset'] / pieceLength,
-                                      'lastPiece':(file['offset'] + file['size']) / pieceLength,
+            for fileIndex in xrange(0, torrent.getAmountOfFiles()):
+                fileOffset = torrent.getFileOffset(fileIndex)
+                self.fileInfo.append({'firstPiece':fileOffset / pieceLength,
+                                      'lastPiece':(fileOffset + torrent.getFileSize(fileIndex)) / pieceLength,
                                       'wanted':True,
                                       'priority':0})
             self._persist()
@@ -103,7 +103,7 @@ class FilePriority:
                 #higher prio and same piece
                 lastPiecePrio = self.fileInfo[idx]['priority']
                 break
-            idx -= 1
+            idx += 1
             
         #set the priority of the various pieces
         if firstPiece == lastPiece:
@@ -121,7 +121,7 @@ class FilePriority:
             if lastPiece - firstPiece > 1:
                 #more pieces involved
                 self.log.debug('Setting prio of remaining piece %i-%i to %i', firstPiece + 1, lastPiece - 1, priority)
-                self.pieceStatus.setPriority(xrange(firstPiece + 1, lastPiece), priority)
+                self.pieceStatus.setRangePriority(firstPiece + 1, lastPiece - 1, priority)
                 
                 
     def _applyWantedFlag(self, fileId, info):
@@ -157,7 +157,7 @@ class FilePriority:
                     #piece is wanted for this file
                     lastPieceWanted = True
                     break
-                idx -= 1
+                idx += 1
             
         #set the wanted flag of the various pieces
         if firstPiece == lastPiece:
@@ -175,35 +175,36 @@ class FilePriority:
             if lastPiece - firstPiece > 1:
                 #more pieces involved
                 self.log.debug('Setting wanted flag of remaining piece %i-%i to %i', firstPiece + 1, lastPiece - 1, wanted)
-                self.ownStatus.setPieceWantedFlag((pieceIndex for pieceIndex in xrange(firstPiece + 1, lastPiece)), wanted)
+                self.ownStatus.setRangeWantedFlag(firstPiece + 1, lastPiece - 1, wanted)
     
     
     ##external functions - files
                 
-    def setFilePriority(self, fileId, priority):
-        info = self.fileInfo[fileId]
-        info['priority'] = priority
-        self._applyPriority(fileId, info)
+    def setFilePriority(self, fileIds, priority):
+        for fileId in fileIds:
+            info = self.fileInfo[fileId]
+            info['priority'] = priority
+            self._applyPriority(fileId, info)
         self._persist()
         
         
-    def setFileWantedFlag(self, fileId, wanted):
-        info = self.fileInfo[fileId]
-        info['wanted'] = wanted
-        self._applyWantedFlag(fileId, info)
+    def setFileWantedFlag(self, fileIds, wanted):
+        for fileId in fileIds:
+            info = self.fileInfo[fileId]
+            info['wanted'] = wanted
+            self._applyWantedFlag(fileId, info)
         self._persist()
         
         
     ##external functions - stats
         
     def getStats(self):
-        files = self.torrent.getFiles()
         pieceSize = self.torrent.getPieceLength()
         lastTorrentPiece = self.torrent.getTotalAmountOfPieces()-1
         lastTorrentPieceSizeDiff = pieceSize - self.torrent.getLengthOfPiece(lastTorrentPiece)
         stats = []
         
-        for idx in xrange(0, len(files)):
+        for idx in xrange(0, len(self.fileInfo)):
             firstPiece = self.fileInfo[idx]['firstPiece']
             lastPiece = self.fileInfo[idx]['lastPiece']
             
@@ -226,8 +227,8 @@ class FilePriority:
             
             #add to list
             stats.append({'id':idx,
-                          'path':files[idx]['path'],
-                          'size':files[idx]['size'],
+                          'path':self.torrent.getFilePath(idx),
+                          'size':self.torrent.getFileSize(idx),
                           'progress':progress,
                           'firstPiece':firstPiece,
                           'lastPiece':lastPiece,
@@ -21,7 +21,7 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 import threading
 
-from HttpResponseParser import HttpResponseParser, HttpResponseParserException, RequestFailedException, InvalidResponseException
+from HttpResponseParser import HttpResponseParser, HttpResponseParserException, RequestFailedException, InvalidResponseException, InvalidDataException
 from HttpUtilities import i2pDestHttpUrlAddrRegexObj, joinUrl, splitUrl
 from PySamLib.I2PSocket import I2PSocket
 from Utilities import logTraceback
@@ -52,7 +52,7 @@ class HttpRequester:
         
     ##internal functions - requests
         
-    def _addRequest(self, addr, host, url, maxHeaderSize, maxDataSize, callback, callbackArgs, callbackKws, transferTimeout, requestTimeout, maxReqTries): 
+    def _addRequest(self, addr, host, url, maxHeaderSize, maxDataSize, decodeData, storeData, callback, callbackArgs, callbackKws, transferTimeout, requestTimeout, maxReqTries): 
         self.log.debug('Adding request to "%s" for "%s" with maxHeaderSize "%d" and maxDataSize "%d"', addr, joinUrl(url), maxHeaderSize, maxDataSize)
         self.requestId += 1
         
@@ -60,7 +60,7 @@ class HttpRequester:
         sockNum = self._connect(addr, transferTimeout, requestTimeout, self.requestId)
         
         #http request obj
-        requestObj = HttpResponseParser(addr, host, url, maxHeaderSize, maxDataSize)
+        requestObj = HttpResponseParser(addr, host, url, maxHeaderSize, maxDataSize, decodeData, storeData)
             
         #add to local requestDict
         self.requests[self.requestId] = {'request':requestObj,
@@ -92,8 +92,9 @@ class HttpRequester:
         requestId = connSet['requestId']
         requestSet = self.requests[requestId]
         data = requestSet['request'].getData()
+        decodedData = requestSet['request'].getDecodedData()
         header = requestSet['request'].getHeader()
-        self.log.debug('Request to "%s": finished successfully (response-length: %d)', connSet['sock'].getpeername(), len(data))
+        self.log.debug('Request to "%s": finished successfully (response-length: %d)', connSet['sock'].getpeername(), requestSet['request'].getProgress()['dataSize'])
         
         #remove request
         self._removeRequest(requestId)
@@ -102,6 +103,7 @@ class HttpRequester:
         result = {'id':requestId,
                   'success':True,
                   'data':data,
+                  'decodedData':decodedData,
                   'header':header}
         self._reportRequestResult(requestSet, result)
         
@@ -242,7 +244,7 @@ class HttpRequester:
         
         try:
             finished = requestSet['request'].handleData(data)
-        except RequestFailedException, e:
+        except (RequestFailedException, InvalidDataException), e:
             finished = False
             self._failRequest(connSet['requestId'], e.getReason(), requestSet['request'].getHeader())
         except HttpResponseParserException, e:
@@ -313,7 +315,9 @@ class HttpRequester:
             
     ##external functions - requests
     
-    def makeRequest(self, url, callback, callbackArgs=[], callbackKws={}, addr=None, host=None, transferTimeout=120, requestTimeout=300, maxHeaderSize=4096, maxDataSize=1048576, maxReqTries=1):
+    def makeRequest(self, url, callback, callbackArgs=[], callbackKws={}, addr=None, host=None, transferTimeout=120, requestTimeout=300, maxHeaderSize=4096, maxDataSize=1048576, maxReqTries=1, decodeData=False, storeData=True):
+        #decodeData: bdecode the response body while it arrives, the result then contains the decoded object as "decodedData"
+        #storeData: keep the raw response body as "data" (empty if disabled)
         if type(url) == str:
             url = splitUrl(url)
             
@@ -339,7 +343,7 @@ class HttpRequester:
         
         #finally really do the request
         self.lock.acquire()
-        requestId = self._addRequest(addr, host, url, maxHeaderSize, maxDataSize, callback, callbackArgs, callbackKws, transferTimeout, requestTimeout, maxReqTries)
+        requestId = self._addRequest(addr, host, url, maxHeaderSize, maxDataSize, decodeData, storeData, callback, callbackArgs, callbackKws, transferTimeout, requestTimeout, maxReqTries)
         self.lock.release()
         return requestId
     
@@ -21,6 +21,7 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 from collections import deque
 import logging
 
+from Bencoding import BdecodeStream, BdecodeException
 from Conversion import hexToInt
 from HttpUtilities import joinRelativeUrl
 
@@ -42,15 +43,21 @@ class RequestFailedException(HttpResponseParserException):
     pass
 
 
+class InvalidDataException(HttpResponseParserException):
+    pass
+
+
 
 
 class HttpResponseParser:
-    def __init__(self, addr, host, url, maxHeaderSize=4096, maxDataSize=1048576):
+    def __init__(self, addr, host, url, maxHeaderSize=4096, maxDataSize=1048576, decodeData=False, storeData=True):
         self.addr = addr
         self.host = host
         self.url = url
         self.userHeaderSizeLimit = maxHeaderSize
         self.userDataSizeLimit = maxDataSize
+        self.decodeData = decodeData        #bdecode the body while it arrives
+        self.storeData = storeData          #keep the raw body, not needed if only the decoded object is of interest
         
         #raw data
         self.gotRawBytes = 0
@@ -60,6 +67,7 @@ class HttpResponseParser:
         self.data = None
         self.dataSize = 0
         self.maxDataSize = 0
+        self.decoder = None
         
         #state
         self.step = 'header'
@@ -87,6 +95,7 @@ class HttpResponseParser:
         self.data = None
         self.dataSize = 0
         self.maxDataSize = 0
+        self.decoder = None
         
         #state
         self.step = 'header'
@@ -162,18 +171,40 @@ class HttpResponseParser:
             self.log.debug('Increasing max data size by "%i" bytes to "%i" bytes', additionalBytes, self.maxDataSize)
             
     
+    def _initData(self):
+        self.data = deque()
+        if self.decodeData:
+            self.decoder = BdecodeStream()
+            
+    
     def _storeData(self, data):
         #store data
-        self.data.append(data)
+        if self.storeData:
+            self.data.append(data)
         self.dataSize += len(data)
         
         if self.dataSize > self.maxDataSize:
             raise InvalidResponseException('data size exceeds exptected size while receiving "%s"', self.step)
         
+        if self.decoder is not None:
+            #decode as far as possible
+            try:
+                self.decoder.feed(data)
+            except BdecodeException, e:
+                raise InvalidDataException('Invalid bencoded data: %s', e.getReason())
+        
     
     def _getData(self):
         return ''.join(self.data)
     
+    
+    def _getDecodedData(self):
+        if self.decoder is None:
+            decodedData = None
+        else:
+            decodedData = self.decoder.getResult()
+        return decodedData
+    
         
     ##internal functions - header
     
@@ -255,7 +286,7 @@ class HttpResponseParser:
                 else:
                     #chunked encoding
                     self.step = 'chunk header'
-                    self.data = deque()
+                    self._initData()
                     self.transferEncoding = 'chunked'
                     
                     self.log.debug('Got response "%s %s" from server: detected chunked transfer encoding', headerStatus[1], headerStatus[2])
@@ -271,7 +302,7 @@ class HttpResponseParser:
                 
                 #adapt state
                 self.step = 'body'
-                self.data = deque()
+                self._initData()
                 self.transferEncoding = None
                 self._increaseDataSizeLimit(length)
                     
@@ -456,6 +487,8 @@ class HttpResponseParser:
                 #trailer
                 data = self._processTrailerData(data)
                 
+        if self.finished and self.decoder is not None and not self.decoder.isFinished():
+            raise InvalidDataException('Invalid bencoded data: body ended after %i bytes, before the end of the encoded object', self.dataSize)
         return self.finished
     
     
@@ -467,6 +500,10 @@ class HttpResponseParser:
         return self._getData()
     
     
+    def getDecodedData(self):
+        return self._getDecodedData()
+    
+    
     def getProgress(self):
         progress = {'recvBytes':self.gotRawBytes,
                     'dataSize':self.dataSize,
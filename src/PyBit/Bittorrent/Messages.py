@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from Conversion import longIntToBinary, shortIntToBinary, binaryToLongInt, binaryToShortInt, binToBinary, binaryToBin
+from Conversion import longIntToBinary, shortIntToBinary, binaryToLongInt, binaryToShortInt
 
 
 ##internal functions
@@ -53,7 +53,7 @@ def generateHave(pieceIndex):
 
 
 def generateBitfield(bitfield):
-    bitfield = binToBinary(bitfield)
+    #bitfield needs to be already packed
     return _createMessageLength(1+len(bitfield))+shortIntToBinary(5)+bitfield
 
 
@@ -125,7 +125,7 @@ def decodeMessage(message):
             result = (numericMessageTyp, binaryToLongInt(message[5:9]))
         elif numericMessageTyp==5:
             #bitfield
-            result = (numericMessageTyp, binaryToBin(message[5:]))
+            result = (numericMessageTyp, message[5:])
         elif numericMessageTyp==6 and length==13:
             #request
             result = (numericMessageTyp, (binaryToLongInt(message[5:9]),\
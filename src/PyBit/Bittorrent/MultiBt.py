@@ -32,8 +32,11 @@ from ConnectionBuilder import ConnectionBuilder
 from ConnectionHandler import ConnectionHandler
 from ConnectionListener import ConnectionListener
 from ConnectionStatsCache import ConnectionStatsCache
+from DiskJobQueue import DiskJobQueue
 from PeerPool import PeerPool
 from EventScheduler import EventScheduler
+from PieceBuffer import PieceBufferBudget
+from Storage import StorageCheckScheduler, StorageFilePool, StorageMmapPool, StorageReadCache
 from HttpRequester import HttpRequester
 from Limiter import SelfRefillingQuotaLimiter
 from Measure import Measure
@@ -100,10 +103,13 @@ class MultiBt:
         self.inRate = Measure(self.eventSched, 60)
         self.outRate = Measure(self.eventSched, 60)
         
+        #create disk job queue
+        self.diskJobQueue = DiskJobQueue(self.config.get('storage', 'diskThreads'))
+        
         #create connection related classes
         self.peerPool = PeerPool()
         self.connStatsCache = ConnectionStatsCache()
-        self.connHandler = ConnectionHandler(self.config, self.connStatsCache, self.peerPool, self.samSockManager.select, self.eventSched,\
+        self.connHandler = ConnectionHandler(self.config, self.connStatsCache, self.diskJobQueue, self.peerPool, self.samSockManager, self.eventSched,\
                                              self.inLimiter, self.outLimiter, self.peerId)
         self.connListener = ConnectionListener(self.eventSched, self.connHandler, self.peerPool, self.destNum, self.samSockManager, self.peerId)
         self.connBuilder = ConnectionBuilder(self.eventSched, self.connHandler, self.peerPool, self.destNum, self.samSockManager, self.peerId)
@@ -111,6 +117,13 @@ class MultiBt:
         #create choker
         self.choker = Choker(self.config, self.eventSched, self.connHandler)
         
+        #create storage related classes
+        self.filePool = StorageFilePool(self.config.get('storage', 'maxOpenFiles'))
+        self.mmapPool = StorageMmapPool(self.config.get('storage', 'maxMappedBytes'))
+        self.pieceBufferBudget = PieceBufferBudget(self.config.get('storage', 'pieceBufferSize'))
+        self.readCache = StorageReadCache(self.config.get('storage', 'readCacheSize'))
+        self.checkScheduler = StorageCheckScheduler(self.config.get('storage', 'maxConcurrentChecks'))
+        
         #create own address watcher class
         self.ownAddrWatcher = OwnAddressWatcher(self.destNum, self.samSockManager)
         
@@ -147,11 +160,17 @@ class MultiBt:
         
         self.config.addCallback((('network', 'downSpeedLimit'),), self.inLimiter.changeRate)
         self.config.addCallback((('network', 'upSpeedLimit'),), self.outLimiter.changeRate)
+        self.config.addCallback((('storage', 'maxOpenFiles'),), self.filePool.setMaxOpenFiles)
+        self.config.addCallback((('storage', 'maxMappedBytes'),), self.mmapPool.setMaxMappedBytes)
+        self.config.addCallback((('storage', 'pieceBufferSize'),), self.pieceBufferBudget.setMaxBytes)
+        self.config.addCallback((('storage', 'readCacheSize'),), self.readCache.setMaxBytes)
+        self.config.addCallback((('storage', 'diskThreads'),), self.diskJobQueue.setWorkerAmount)
+        self.config.addCallback((('storage', 'maxConcurrentChecks'),), self.checkScheduler.setMaxChecks)
         
         #queue
-        self.queue = BtQueueManager(self.choker, self.config, self.connBuilder, self.connListener, self.connHandler, self.eventSched,
-                                    self.httpRequester, self.inRate, self.outRate, self.ownAddrWatcher, self.peerId, self.peerPool,
-                                    self.persister, self.progPath, self.version)
+        self.queue = BtQueueManager(self.checkScheduler, self.choker, self.config, self.connBuilder, self.connListener, self.connHandler, self.diskJobQueue, self.eventSched,
+                                    self.filePool, self.httpRequester, self.inRate, self.mmapPool, self.outRate, self.ownAddrWatcher, self.peerId, self.peerPool,
+                                    self.persister, self.pieceBufferBudget, self.progPath, self.readCache, self.version)
                                     
         #lock
         self.lock = threading.Lock()
@@ -214,6 +233,16 @@ class MultiBt:
             self.queue.setSuperSeeding(torrentId, enabled)
             
             
+    def setAllocationMode(self, torrentId, mode):
+        with self.lock:
+            self.queue.setAllocationMode(torrentId, mode)
+            
+            
+    def setStorageBackend(self, torrentId, backend):
+        with self.lock:
+            self.queue.setStorageBackend(torrentId, backend)
+            
+            
     def getTrackerInfo(self, torrentId):
         with self.lock:
             return self.queue.getTrackerInfo(torrentId)
@@ -237,6 +266,10 @@ class MultiBt:
             stats['inRawSpeed'] = self.inRate.getCurrentRate()
             stats['outRawSpeed'] = self.outRate.getCurrentRate()
         
+        #disk stats
+        if wantedStats.get('disk', False):
+            stats.update(self.diskJobQueue.getStats())
+        
         #bt stats
         btStats = wantedStats.get('bt')
         if btStats is not None:
@@ -272,6 +305,10 @@ class MultiBt:
         self.connBuilder.stop()
         self.connStatsCache.stop()
         
+        #stop disk job queue
+        self.log.info("Stopping disk job queue")
+        self.diskJobQueue.stop()
+        
         #stop traffic related classes
         self.log.info("Stopping limiter and measurer")
         self.inLimiter.stop()
@@ -0,0 +1,176 @@
+"""
+Copyright 2009  Blub
+
+PieceBuffer, a class which collects the blocks of pieces in memory until the piece is complete.
+This file is part of PyBit.
+
+PyBit is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, version 2 of the License.
+
+PyBit is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+##builtin
+from __future__ import with_statement
+import threading
+
+##own
+from Logger import Logger
+
+
+class PieceBufferBudget:
+    """
+    Limits the number of bytes which all piece buffers together may hold in memory.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        self.lock = threading.Lock()
+
+
+    def claim(self, bytes):
+        with self.lock:
+            success = (self.usedBytes + bytes <= self.maxBytes)
+            if success:
+                self.usedBytes += bytes
+        return success
+
+
+    def release(self, bytes):
+        with self.lock:
+            self.usedBytes -= bytes
+
+
+    def setMaxBytes(self, maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+
+
+    def getUsedBytes(self):
+        with self.lock:
+            return self.usedBytes
+
+
+
+
+class PieceBuffer:
+    def __init__(self, budget, storage, ident):
+        self.budget = budget
+        self.storage = storage
+
+        self.pieces = {}              #pieceIndex => {offset:data}
+        self.pieceSizes = {}          #pieceIndex => buffered bytes
+        self.writeThrough = set()     #pieces which didn't fit into the buffer, their blocks are written to disk directly
+
+        self.log = Logger('PieceBuffer', '%-6s - ', ident)
+        self.lock = threading.Lock()
+
+
+    ##internal functions - pieces
+
+    def _removePiece(self, pieceIndex):
+        blocks = self.pieces.pop(pieceIndex, None)
+        if blocks is not None:
+            self.budget.release(self.pieceSizes.pop(pieceIndex))
+        return blocks
+
+
+    def _flushPiece(self, pieceIndex):
+        #writes all buffered blocks of a piece to disk, from then on the piece is handled write-through
+        blocks = self._removePiece(pieceIndex)
+        self.writeThrough.add(pieceIndex)
+        if blocks is not None:
+            self.log.debug('Flushing %i buffered blocks of piece %i to disk', len(blocks), pieceIndex)
+            for offset in sorted(blocks.iterkeys()):
+                self.storage.storeData(pieceIndex, blocks[offset], offset)
+
+
+    ##external functions - pieces
+
+    def storeBlock(self, pieceIndex, offset, data):
+        #returns a list of (offset, data) blocks which need to be written to disk, empty if the block got buffered
+        with self.lock:
+            unbufferedBlocks = []
+            if pieceIndex in self.writeThrough:
+                #piece is handled write-through
+                unbufferedBlocks.append((offset, data))
+                
+            elif self.budget.claim(len(data)):
+                #got enough space
+                if not pieceIndex in self.pieces:
+                    self.pieces[pieceIndex] = {}
+                    self.pieceSizes[pieceIndex] = 0
+                blocks = self.pieces[pieceIndex]
+                if offset in blocks:
+                    #replacing an older copy of this block
+                    self.budget.release(len(blocks[offset]))
+                    self.pieceSizes[pieceIndex] -= len(blocks[offset])
+                blocks[offset] = data
+                self.pieceSizes[pieceIndex] += len(data)
+                
+            else:
+                #budget exhausted, switch this piece to write-through
+                blocks = self._removePiece(pieceIndex)
+                self.writeThrough.add(pieceIndex)
+                if blocks is not None:
+                    unbufferedBlocks.extend((blockOffset, blocks[blockOffset]) for blockOffset in sorted(blocks.iterkeys()) if not blockOffset == offset)
+                unbufferedBlocks.append((offset, data))
+        return unbufferedBlocks
+
+
+    def popPiece(self, pieceIndex):
+        #returns the data of a completely buffered piece and removes it from the buffer, None if it wasn't buffered
+        with self.lock:
+            self.writeThrough.discard(pieceIndex)
+            blocks = self._removePiece(pieceIndex)
+            if blocks is None:
+                data = None
+            else:
+                data = ''.join([blocks[offset] for offset in sorted(blocks.iterkeys())])
+        return data
+
+
+    def setWriteThrough(self, pieceIndex):
+        #blocks of this piece aren't buffered, used for pieces which already have data on disk
+        with self.lock:
+            self.writeThrough.add(pieceIndex)
+            
+            
+    def discardPiece(self, pieceIndex):
+        #drops all buffered data of a piece
+        with self.lock:
+            self.writeThrough.discard(pieceIndex)
+            self._removePiece(pieceIndex)
+
+
+    def flush(self):
+        #writes all buffered blocks to disk, may throw StorageException
+        with self.lock:
+            for pieceIndex in self.pieces.keys():
+                self._flushPiece(pieceIndex)
+
+
+    def clear(self):
+        #drops everything without writing it to disk
+        with self.lock:
+            for pieceIndex in self.pieces.keys():
+                self._removePiece(pieceIndex)
+            self.writeThrough.clear()
+
+
+    ##external functions - stats
+
+    def getStats(self):
+        with self.lock:
+            stats = {}
+            stats['bufferedPieces'] = len(self.pieces)
+            stats['bufferedBytes'] = sum(self.pieceSizes.itervalues())
+        return stats
@@ -0,0 +1,118 @@
+"""
+Copyright 2009  Blub
+
+PiecePicker, a class which keeps pieces in sorted buckets to quickly find the best pieces for requests.
+This file is part of PyBit.
+
+PyBit is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published
+by the Free Software Foundation, version 2 of the License.
+
+PyBit is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+##builtin
+from array import array
+from bisect import bisect_left, insort
+from random import randrange
+
+
+class PiecePicker:
+    def __init__(self, pieceAmount):
+        self.pieceAmount = pieceAmount
+        self.buckets = {}                                   #bucket ident (priority, availability, concurrent requests, finished requests) => list of pieces
+        self.bucketIdents = []                              #sorted list of all bucket idents
+        self.piecePos = array('l', [0]) * pieceAmount       #position of each piece within the list of its bucket
+
+
+    ##internal functions - buckets
+
+    def _addPiece(self, pieceIndex, bucketIdent):
+        bucket = self.buckets.get(bucketIdent, None)
+        if bucket is None:
+            #new bucket
+            bucket = []
+            self.buckets[bucketIdent] = bucket
+            insort(self.bucketIdents, bucketIdent)
+        self.piecePos[pieceIndex] = len(bucket)
+        bucket.append(pieceIndex)
+
+
+    def _removePiece(self, pieceIndex, bucketIdent):
+        bucket = self.buckets[bucketIdent]
+        pos = self.piecePos[pieceIndex]
+        assert bucket[pos] == pieceIndex, 'piece not in bucket?!'
+
+        #replace the piece with the last one of the bucket, so the list never needs to be shifted
+        lastPieceIndex = bucket.pop()
+        if not lastPieceIndex == pieceIndex:
+            bucket[pos] = lastPieceIndex
+            self.piecePos[lastPieceIndex] = pos
+
+        if len(bucket) == 0:
+            #bucket is empty
+            del self.buckets[bucketIdent]
+            del self.bucketIdents[bisect_left(self.bucketIdents, bucketIdent)]
+
+
+    ##internal functions - iterating
+
+    def _iterBucket(self, bucket, pieceFilter):
+        #yields the pieces in random order, so that different peers don't all get the same pieces: a Fisher-Yates
+        #shuffle which only draws the positions that are actually consumed, swapped positions are kept in a dict
+        #instead of a copy of the bucket
+        length = len(bucket)
+        swapped = {}
+        for idx in xrange(0, length):
+            randIdx = randrange(idx, length)
+            pos = swapped.get(randIdx, randIdx)
+            swapped[randIdx] = swapped.get(idx, idx)
+            pieceIndex = bucket[pos]
+            if pieceFilter(pieceIndex):
+                yield pieceIndex
+
+
+    ##external functions - changes
+
+    def rebuild(self, bucketIdents):
+        #bucketIdents contains the bucket ident of each piece, ordered by piece index
+        buckets = {}
+        piecePos = self.piecePos
+        for pieceIndex, bucketIdent in enumerate(bucketIdents):
+            bucket = buckets.get(bucketIdent, None)
+            if bucket is None:
+                bucket = []
+                buckets[bucketIdent] = bucket
+            piecePos[pieceIndex] = len(bucket)
+            bucket.append(pieceIndex)
+        self.buckets = buckets
+        self.bucketIdents = sorted(buckets.iterkeys())
+
+
+    def movePiece(self, pieceIndex, oldBucketIdent, newBucketIdent):
+        self._removePiece(pieceIndex, oldBucketIdent)
+        self._addPiece(pieceIndex, newBucketIdent)
+
+
+    ##external functions - iterating
+
+    def iterPieces(self, bucketFilter, pieceFilter):
+        #yields the pieces of all buckets accepted by bucketFilter, best bucket first; pieces are only checked with
+        #pieceFilter when they are reached, so stopping the iteration early also stops all work
+        #the buckets must not be changed while an iterator is in use
+        for bucketIdent in self.bucketIdents:
+            if bucketFilter(bucketIdent):
+                for pieceIndex in self._iterBucket(self.buckets[bucketIdent], pieceFilter):
+                    yield pieceIndex
+
+
+    ##external functions - info
+
+    def getBucketAmount(self):
+        return len(self.bucketIdents)
@@ -18,12 +18,22 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 ##builtin
+from array import array
 from collections import deque, defaultdict
+from itertools import izip
 from random import randrange
 import logging
 import threading
 
+##optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 ##own
+from Conversion import bitfieldToPieces
+from PiecePicker import PiecePicker
 from Utilities import logTraceback
 
 
@@ -32,25 +42,28 @@ class PieceStatus:
         self.pieceAmount = pieceAmount
         
         #piece status - requests
-        self.priority = {}           #piece priority
-        self.availability = {}       #piece availability
-        self.concurrentRequests = {} #number of concurrent requests of the same data within a piece (minimum!), -2 = ignore
-        self.finishedRequests = {}   #number of finished piece parts
+        self.priority = None           #piece priority
+        self.availability = None       #piece availability
+        self.concurrentRequests = None #number of concurrent requests of the same data within a piece (minimum!), -2 = ignore
+        self.finishedRequests = None   #number of finished piece parts
         
         #piece status - uploads
-        self.assignedUploads = {}    #assigned uploads (=pieces available to peers who need them, super seeding)
+        self.assignedUploads = None    #assigned uploads (=pieces available to peers who need them, super seeding)
         
         #groups - requests
         self.maxConcReqs = -1                                      #highest concurrent request count
         self.concReqGroups = defaultdict(int)                      #groups of pieces which share the same concurrent request count
-        self.pieceGroups = defaultdict(set)                        #groups of pieces which share the same priority, availability, concurrent requests count and finished request count (meaning the have the same overall priority)
+        self.picker = PiecePicker(pieceAmount)                     #groups of pieces which share the same priority, availability, concurrent requests count and finished request count (meaning the have the same overall priority)
+        self.pieceGroupsValid = True                               #False after bulk availability or priority changes, the groups get rebuilt once they are needed
+        self.maxSinglePriorityChanges = 64                         #priority changes of larger piece ranges invalidate the groups instead of moving each piece
         
         #groups - uploads
         self.upPieceGroups = defaultdict(set)
+        self.upPieceGroupsValid = True
         
         #freezing
-        self.freezed = 0               #updating of self.concReqGroups and/or self.pieceGroups allowed?
-        self.queuedChanges = deque()   #queued changes for self.concReqGroups and self.pieceGroups
+        self.freezed = 0               #updating of self.concReqGroups and/or self.picker allowed?
+        self.queuedChanges = deque()   #queued changes for self.concReqGroups and self.picker
         
         #init pieces
         self._init()
@@ -62,13 +75,13 @@ class PieceStatus:
     ##internal functions - init
         
     def _init(self):
-        for pieceIndex in xrange(0, self.pieceAmount):
-            self.priority[pieceIndex] = 0
-            self.availability[pieceIndex] = 0
-            self.concurrentRequests[pieceIndex] = 0
-            self.finishedRequests[pieceIndex] = 0
-            self.assignedUploads[pieceIndex] = 0
-        self.pieceGroups[(0,0,0,0)] = set(xrange(0, self.pieceAmount))
+        #per piece values are kept in arrays, so that bulk changes can be done in one pass
+        self.priority = array('l', [0]) * self.pieceAmount
+        self.availability = array('l', [0]) * self.pieceAmount
+        self.concurrentRequests = array('l', [0]) * self.pieceAmount
+        self.finishedRequests = array('l', [0]) * self.pieceAmount
+        self.assignedUploads = array('l', [0]) * self.pieceAmount
+        self._rebuildPieceGroups()
         self.concReqGroups[0] = self.pieceAmount
         self.upPieceGroups[0] = set(xrange(0, self.pieceAmount))
 
@@ -88,41 +101,65 @@ class PieceStatus:
             
     def _commitChanges(self):
         #commit queued changes
-        for pieceIndex, oldReqGroupIdent, newReqGroupIdent, oldUpGroupIdent, newUpGroupIdent in self.queuedChanges:
-            if not oldReqGroupIdent == newReqGroupIdent:
-                #print pieceIndex, oldReqGroupIdent, newReqGroupIdent
-                #move piece index between piece groups
-                self.pieceGroups[newReqGroupIdent].add(pieceIndex)
-                self.pieceGroups[oldReqGroupIdent].remove(pieceIndex)
-                if len(self.pieceGroups[oldReqGroupIdent]) == 0:
-                    del self.pieceGroups[oldReqGroupIdent]
-                    
-                #update concurrent request stuff
-                oldConcReqs = oldReqGroupIdent[2]
-                newConcReqs = newReqGroupIdent[2]
+        for pieceIndex, oldReqGroupIdent, newReqGroupIdent in self.queuedChanges:
+            self._moveReqGroup(pieceIndex, oldReqGroupIdent, newReqGroupIdent)
+        self.queuedChanges.clear()
+        
+        
+    def _moveReqGroup(self, pieceIndex, oldReqGroupIdent, newReqGroupIdent):
+        if self.pieceGroupsValid:
+            #print pieceIndex, oldReqGroupIdent, newReqGroupIdent
+            #move piece index between piece groups
+            self.picker.movePiece(pieceIndex, oldReqGroupIdent, newReqGroupIdent)
                 
-                if not oldConcReqs == newConcReqs:
-                    deletedOld = False
-                    self.concReqGroups[newConcReqs] += 1
-                    self.concReqGroups[oldConcReqs] -= 1
-                    if self.concReqGroups[oldConcReqs] == 0:
-                        deletedOld = True
-                        del self.concReqGroups[oldConcReqs]
+        #update concurrent request stuff (not affected by availability changes, so always valid)
+        oldConcReqs = oldReqGroupIdent[2]
+        newConcReqs = newReqGroupIdent[2]
+        
+        if not oldConcReqs == newConcReqs:
+            deletedOld = False
+            self.concReqGroups[newConcReqs] += 1
+            self.concReqGroups[oldConcReqs] -= 1
+            if self.concReqGroups[oldConcReqs] == 0:
+                deletedOld = True
+                del self.concReqGroups[oldConcReqs]
+        
+            #update max concurrent requests
+            if newConcReqs > oldConcReqs or (deletedOld and self.maxConcReqs == oldConcReqs and newConcReqs < oldConcReqs):
+                self.maxConcReqs = newConcReqs
                 
-                    #update max concurrent requests
-                    if newConcReqs > oldConcReqs or (deletedOld and self.maxConcReqs == oldConcReqs and newConcReqs < oldConcReqs):
-                        self.maxConcReqs = newConcReqs
-                        
-                        
-            if not oldUpGroupIdent == newUpGroupIdent:
-                #print pieceIndex, oldUpGroupIdent, newUpGroupIdent
-                #move piece index between piece groups
-                self.upPieceGroups[newUpGroupIdent].add(pieceIndex)
-                self.upPieceGroups[oldUpGroupIdent].remove(pieceIndex)
-                if len(self.upPieceGroups[oldUpGroupIdent]) == 0:
-                    del self.upPieceGroups[oldUpGroupIdent]
+                
+    def _moveUpGroup(self, pieceIndex, oldUpGroupIdent, newUpGroupIdent):
+        #upload groups are not used by the iterators of sortPieceList(), so they don't need to wait for a thaw
+        if self.upPieceGroupsValid:
+            #print pieceIndex, oldUpGroupIdent, newUpGroupIdent
+            #move piece index between piece groups
+            self.upPieceGroups[newUpGroupIdent].add(pieceIndex)
+            self.upPieceGroups[oldUpGroupIdent].remove(pieceIndex)
+            if len(self.upPieceGroups[oldUpGroupIdent]) == 0:
+                del self.upPieceGroups[oldUpGroupIdent]
+                
+                
+    def _rebuildPieceGroups(self):
+        assert not self.freezed, 'cannot rebuild during freeze!'
+        self.picker.rebuild(izip(self.priority, self.availability, self.concurrentRequests, self.finishedRequests))
+        self.pieceGroupsValid = True
         
-        self.queuedChanges.clear()
+        
+    def _rebuildUpPieceGroups(self):
+        upPieceGroups = defaultdict(set)
+        for pieceIndex, groupIdent in enumerate(self._getSums(self.availability, self.assignedUploads)):
+            upPieceGroups[groupIdent].add(pieceIndex)
+        self.upPieceGroups = upPieceGroups
+        self.upPieceGroupsValid = True
+        
+        
+    def _getSums(self, values, otherValues):
+        if numpy is None:
+            sums = [value + otherValue for value, otherValue in izip(values, otherValues)]
+        else:
+            sums = (numpy.frombuffer(values, dtype='l') + numpy.frombuffer(otherValues, dtype='l')).tolist()
+        return sums
         
         
     def _updatePieceGroups(self, pieces, newPriority=None, availabilityChange=None, newConcurrentRequests=None,
@@ -165,42 +202,30 @@ class PieceStatus:
             newUpGroupIdent = availability + assignedUploads
             
             #update state if possible
-            if self.freezed:
-                #not allowed to do the change right now
-                self.queuedChanges.append((pieceIndex, oldReqGroupIdent, newReqGroupIdent, oldUpGroupIdent, newUpGroupIdent))
-            else:
-                #allowed
-                if not oldReqGroupIdent == newReqGroupIdent:
-                    #print pieceIndex, oldReqGroupIdent, newReqGroupIdent
-                    #move piece index between piece groups
-                    self.pieceGroups[newReqGroupIdent].add(pieceIndex)
-                    self.pieceGroups[oldReqGroupIdent].remove(pieceIndex)
-                    if len(self.pieceGroups[oldReqGroupIdent]) == 0:
-                        del self.pieceGroups[oldReqGroupIdent]
-                        
-                    #update concurrent request stuff
-                    oldConcReqs = oldReqGroupIdent[2]
-                    newConcReqs = newReqGroupIdent[2]
-                    
-                    if not oldConcReqs == newConcReqs:
-                        deletedOld = False
-                        self.concReqGroups[newConcReqs] += 1
-                        self.concReqGroups[oldConcReqs] -= 1
-                        if self.concReqGroups[oldConcReqs] == 0:
-                            deletedOld = True
-                            del self.concReqGroups[oldConcReqs]
-                    
-                        #update max concurrent requests
-                        if newConcReqs > oldConcReqs or (deletedOld and self.maxConcReqs == oldConcReqs and newConcReqs < oldConcReqs):
-                            self.maxConcReqs = newConcReqs
+            if not oldReqGroupIdent == newReqGroupIdent:
+                if self.freezed:
+                    #not allowed to do the change right now
+                    self.queuedChanges.append((pieceIndex, oldReqGroupIdent, newReqGroupIdent))
+                else:
+                    #allowed
+                    self._moveReqGroup(pieceIndex, oldReqGroupIdent, newReqGroupIdent)
                             
-                if not oldUpGroupIdent == newUpGroupIdent:
-                    #print pieceIndex, oldUpGroupIdent, newUpGroupIdent
-                    #move piece index between piece groups
-                    self.upPieceGroups[newUpGroupIdent].add(pieceIndex)
-                    self.upPieceGroups[oldUpGroupIdent].remove(pieceIndex)
-                    if len(self.upPieceGroups[oldUpGroupIdent]) == 0:
-                        del self.upPieceGroups[oldUpGroupIdent]
+            if not oldUpGroupIdent == newUpGroupIdent:
+                self._moveUpGroup(pieceIndex, oldUpGroupIdent, newUpGroupIdent)
+                
+                
+    def _updateAvailability(self, bitfield, availabilityChange):
+        #bulk change of the availability of all pieces in the bitfield, the groups are rebuilt once they are needed
+        if numpy is None:
+            availability = self.availability
+            for pieceIndex in bitfieldToPieces(bitfield):
+                availability[pieceIndex] += availabilityChange
+        else:
+            bits = numpy.unpackbits(numpy.frombuffer(bitfield, dtype=numpy.uint8))[:self.pieceAmount]
+            availability = numpy.frombuffer(self.availability, dtype='l')
+            availability += bits.astype('l') * availabilityChange
+        self.pieceGroupsValid = False
+        self.upPieceGroupsValid = False
 
 
     ##external functions - status
@@ -221,16 +246,16 @@ class PieceStatus:
         if pieceIndex is not None:
             self._updatePieceGroups((pieceIndex,), availabilityChange=1)
         if bitfield is not None:
-            self._updatePieceGroups((pieceIndex for pieceIndex in xrange(0, len(bitfield)) if bitfield[pieceIndex] == '1'), availabilityChange=1)
+            self._updateAvailability(bitfield, 1)
         self.lock.release()
 
 
     def decreaseAvailability(self, pieceIndex=None, bitfield=None):
         self.lock.acquire()
         if pieceIndex is not None:
-            self._updatePieceGroup((pieceIndex,), availabilityChange=-1)
+            self._updatePieceGroups((pieceIndex,), availabilityChange=-1)
         if bitfield is not None:
-            self._updatePieceGroups((pieceIndex for pieceIndex in xrange(0, len(bitfield)) if bitfield[pieceIndex] == '1'), availabilityChange=-1)
+            self._updateAvailability(bitfield, -1)
         self.lock.release()
 
 
@@ -253,6 +278,22 @@ class PieceStatus:
         self.lock.release()
         
         
+    def setRangePriority(self, firstPiece, lastPiece, newPriority):
+        self.lock.acquire()
+        newPriority *= -1
+        pieceCount = lastPiece - firstPiece + 1
+        if pieceCount <= self.maxSinglePriorityChanges:
+            #few pieces, moving them between the groups is cheaper than a rebuild
+            self._updatePieceGroups((pieceIndex for pieceIndex in xrange(firstPiece, lastPiece + 1) if not self.priority[pieceIndex] == newPriority) , newPriority=newPriority)
+        else:
+            #many pieces, replace the whole range at once and rebuild the groups once they are needed
+            newPriorities = array('l', [newPriority]) * pieceCount
+            if not self.priority[firstPiece:lastPiece + 1] == newPriorities:
+                self.priority[firstPiece:lastPiece + 1] = newPriorities
+                self.pieceGroupsValid = False
+        self.lock.release()
+        
+        
     def getConcurrentRequestsCounter(self, pieceIndex):
         self.lock.acquire()
         concRequests = self.concurrentRequests[pieceIndex]
@@ -333,8 +374,12 @@ class PieceStatus:
         self.lock.release()
         
 
-    def sortPieceList(self, pieces, *concReqCounts):
+    def sortPieceList(self, pieceFilter, *concReqCounts):
+        #pieceFilter is called with each candidate piece index and needs to return True for pieces which may be requested,
+        #usually its the hasPiece() function of the status of a peer
         self.lock.acquire()
+        if not self.pieceGroupsValid:
+            self._rebuildPieceGroups()
         self._freeze()
         
         allowedConcReqCounts = set()
@@ -345,8 +390,8 @@ class PieceStatus:
                 count = 0
             allowedConcReqCounts.add(count)
 
-        pieceGroups = (list(self.pieceGroups[groupIdent].intersection(pieces)) for groupIdent in sorted(groupId for groupId in self.pieceGroups.iterkeys() if (not groupId[1] == 0) and groupId[2] in allowedConcReqCounts))
-        iterator = PieceIterator(self.thaw, pieceGroups)
+        groupFilter = lambda groupIdent: (not groupIdent[1] == 0) and groupIdent[2] in allowedConcReqCounts
+        iterator = PickedPieceIterator(self.thaw, self.picker.iterPieces(groupFilter, pieceFilter))
         self.lock.release()
         return iterator
     
@@ -355,6 +400,8 @@ class PieceStatus:
     
     def getUpPieces(self, possiblePieces, count):
         self.lock.acquire()
+        if not self.upPieceGroupsValid:
+            self._rebuildUpPieceGroups()
         pieceGroups = (list(self.upPieceGroups[groupIdent].intersection(possiblePieces)) for groupIdent in sorted(self.upPieceGroups.iterkeys()))
         iterator = PieceIterator(None, pieceGroups)
         upPieces = []
@@ -373,8 +420,8 @@ class PieceStatus:
         self.lock.acquire()
         stats = {}
         if kwargs.get('pieceAverages', False):
-            stats['avgPieceAvailability'] = (sum(self.availability.itervalues()) * 1.0) / max(len(self.availability), 1)
-            stats['minPieceAvailability'] = min(self.availability.itervalues())
+            stats['avgPieceAvailability'] = (sum(self.availability) * 1.0) / max(len(self.availability), 1)
+            stats['minPieceAvailability'] = min(self.availability)
         self.lock.release()
         return stats
 
@@ -421,3 +468,58 @@ class PieceIterator:
             self.length -= 1
             
         return pieceIndex
+
+
+
+
+class PickedPieceIterator(PieceIterator):
+    def __init__(self, finishIterFunc, pieces):
+        PieceIterator.__init__(self, finishIterFunc, None)
+        self.pieces = pieces
+        
+    def next(self):
+        #randomising is already done by the picker
+        return self.pieces.next()
+
+
+
+
+if __name__ == '__main__':
+    #micro-benchmark: filling the requests of one peer for torrents of different sizes, usage: PieceStatus.py [runs]
+    from random import random, seed
+    from time import time
+    import sys
+    
+    from Conversion import maskToBitfield
+    from Status import Status
+    
+    runs = 100
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+    
+    seed(0)
+    for pieceAmount in (1000, 10000, 100000, 1000000):
+        #a few seeds and some random peers, the peer which requests has about half of all pieces
+        pieceStatus = PieceStatus(pieceAmount)
+        for seedIdx in xrange(0, 3):
+            pieceStatus.increaseAvailability(bitfield=maskToBitfield((1L << pieceAmount) - 1, pieceAmount))
+        for peerIdx in xrange(0, 5):
+            pieceStatus.increaseAvailability(bitfield=maskToBitfield(long(''.join(random() < 0.1 and '1' or '0' for pieceIdx in xrange(0, pieceAmount)), 2), pieceAmount))
+        peerStatus = Status(pieceAmount)
+        peerStatus.addBitfield(maskToBitfield(long(''.join(random() < 0.5 and '1' or '0' for pieceIdx in xrange(0, pieceAmount)), 2), pieceAmount))
+        pieceStatus.sortPieceList(peerStatus.hasPiece, -1) #rebuilds the groups once
+        
+        times = []
+        for run in xrange(0, runs):
+            start = time()
+            pieces = []
+            iterator = pieceStatus.sortPieceList(peerStatus.hasPiece, 0, -1)
+            for pieceIndex in iterator:
+                pieces.append(pieceIndex)
+                pieceStatus.setConcurrentRequestsCounter((pieceIndex,), 1)
+                if len(pieces) == 32:
+                    break
+            del iterator
+            times.append(time() - start)
+            pieceStatus.setConcurrentRequestsCounter(pieces, -1)
+        print '%7i pieces: filling 32 requests best %.6f s, average %.6f s' % (pieceAmount, min(times), sum(times) / len(times))
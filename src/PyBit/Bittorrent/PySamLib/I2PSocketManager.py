@@ -285,9 +285,37 @@ class I2PSocketManager:
             elif connType == 'tcpListen':
                 #tcp listening socket
                 self.i2pDests[destId]['obj'].stopListening(i2pSocketId)
+                
+            elif connType == 'wakeup':
+                #virtual socket, not bound to any destination
+                self.i2pSockStatus.removeConn(i2pSocketId)
                     
         self.lock.release()
         
+        
+    def wakeupSocket(self):
+        #creates a virtual socket which only gets recvable when wakeup() is called, allows other threads to interrupt a select()
+        self.lock.acquire()
+        i2pSocketId = self.i2pSockStatus.addConn(None, 'wakeup', 'out')
+        self.lock.release()
+        return i2pSocketId
+    
+    
+    def wakeup(self, i2pSocketId):
+        self.lock.acquire()
+        if self.i2pSockStatus.connExists(i2pSocketId) and not self.i2pSockStatus.getRecvable(i2pSocketId):
+            #socket is valid and not yet signaled
+            self.i2pSockStatus.setRecvable(True, i2pSocketId)
+        self.lock.release()
+        
+        
+    def clearWakeup(self, i2pSocketId):
+        self.lock.acquire()
+        if self.i2pSockStatus.getRecvable(i2pSocketId):
+            #socket is valid and signaled
+            self.i2pSockStatus.setRecvable(False, i2pSocketId)
+        self.lock.release()
+        
     
     def getOwnDestination(self, destId=None, i2pSocketId=None, timeout=None):
         self.lock.acquire()
@@ -17,6 +17,8 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from hashlib import sha1
+
 from Utilities import logTraceback
 
 
@@ -30,6 +32,12 @@ class Request:
         self.neededReqs = set()   #requests which are still needed
         self.curReqs = set()      #requests with lowest number of running requests        
         self.minReqCount = 0      #lowest number of simultaneous running requests
+        
+        #hashing
+        self.hasher = sha1()      #hash of all finished requests from the start of the piece up to the first gap
+        self.hashedBytes = 0      #number of bytes which were fed into the hasher
+        self.unhashedData = {}    #data of finished requests which came in out of order, waiting for the gap to be filled
+        self.hashing = True       #False if the data of some finished requests isn't available (restored requests)
 
         #add requests
         offset = 0
@@ -115,6 +123,51 @@ class Request:
         return conns
     
     
+    def _hashData(self, reqOffset, data):
+        if not self.hashing:
+            #can't hash incrementally, the piece will be hashed once its finished
+            pass
+        
+        elif not reqOffset == self.hashedBytes:
+            #there is a gap in front of this request, keep it until the gap is filled
+            self.unhashedData[reqOffset] = data
+        else:
+            #continues the hashed data
+            self.hasher.update(data)
+            self.hashedBytes += len(data)
+            
+            while self.hashedBytes in self.unhashedData:
+                #gap closed, process waiting data
+                data = self.unhashedData.pop(self.hashedBytes)
+                self.hasher.update(data)
+                self.hashedBytes += len(data)
+                
+                
+    def _resetHash(self):
+        self.hasher = sha1()
+        self.hashedBytes = 0
+        self.unhashedData.clear()
+        self.hashing = True
+        
+        
+    def _restoreFinishedRequests(self, offsets):
+        #marks requests as finished whose data was already stored on disk earlier, no requests may be running
+        for offset in offsets:
+            if offset in self.neededReqs:
+                self.neededReqs.remove(offset)
+                self.curReqs.discard(offset)
+                
+        if len(self.neededReqs) == 0:
+            #completely finished
+            self.minReqCount = -1
+        elif len(self.curReqs) == 0:
+            self._refillCurReqs()
+            
+        #the data of the restored requests isn't available, so the hash can't be built incrementally
+        self._resetHash()
+        self.hashing = False
+    
+    
     def _abortAllRequests(self):
         #abort all requests, return conns which were affected
         conns = set()
@@ -131,6 +184,9 @@ class Request:
         self.neededReqs = set(self.requests.iterkeys())
         self.curReqs = set(self.requests.iterkeys())
         self.minReqCount = 0
+        
+        #finished requests need to be redone, so the hash is worthless
+        self._resetHash()
         return conns
 
 
@@ -179,8 +235,9 @@ class Request:
         self.pieceStatus.setFinishedRequestsCounter((self.pieceIndex,), len(self.requests) - len(self.neededReqs))
 
 
-    def finishedRequest(self, offset, conn):
+    def finishedRequest(self, offset, conn, data):
         conns = self._finishedRequest(offset, conn)
+        self._hashData(offset, data)
         self.pieceStatus.setConcurrentRequestsCounter((self.pieceIndex,), self.minReqCount)
         self.pieceStatus.setFinishedRequestsCounter((self.pieceIndex,), len(self.requests) - len(self.neededReqs))
         return conns
@@ -191,6 +248,21 @@ class Request:
         self.pieceStatus.setConcurrentRequestsCounter((self.pieceIndex,), self.minReqCount)
         self.pieceStatus.setFinishedRequestsCounter((self.pieceIndex,), len(self.requests) - len(self.neededReqs))
         return conns
+    
+    
+    def restoreFinishedRequests(self, offsets):
+        self._restoreFinishedRequests(offsets)
+        self.pieceStatus.setConcurrentRequestsCounter((self.pieceIndex,), self.minReqCount)
+        self.pieceStatus.setFinishedRequestsCounter((self.pieceIndex,), len(self.requests) - len(self.neededReqs))
+        
+        
+    def getFinishedRequestsBitmap(self):
+        #returns a string with one char ("1" = finished, "0" = needed) per request, ordered by offset
+        return ''.join(('0' if offset in self.neededReqs else '1' for offset in sorted(self.requests.iterkeys())))
+    
+    
+    def getRequestOffsets(self):
+        return sorted(self.requests.iterkeys())
 
 
     def getMinReqCount(self):
@@ -199,6 +271,15 @@ class Request:
 
     def getPieceSize(self):
         return self.pieceSize
+    
+    
+    def getPieceHash(self):
+        #returns the sha1 digest of the piece if all of its data was hashed, None otherwise
+        if self.hashedBytes == self.pieceSize:
+            pieceHash = self.hasher.digest()
+        else:
+            pieceHash = None
+        return pieceHash
 
 
     def isEmpty(self):
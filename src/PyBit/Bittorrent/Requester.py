@@ -20,21 +20,32 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 from collections import deque, defaultdict
 from hashlib import sha1
 
+from Conversion import binaryToBin, binToBinary, bitfieldToPieces, maskToBitfield
 from Logger import Logger
 from Request import Request
 from Utilities import logTraceback
 
 
 class Requester:
-    def __init__(self, config, ident, pieceStatus, storage, torrent):
+    def __init__(self, config, btPersister, ident, pieceStatus, storage, pieceBuffer, diskJobQueue, torrent):
         self.config = config
+        self.btPersister = btPersister
+        self.ident = ident
         self.storage = storage
+        self.pieceBuffer = pieceBuffer
+        self.diskJobQueue = diskJobQueue
         self.torrent = torrent
         self.pieceStatus = pieceStatus
         self.ownStatus = storage.getStatus()
         
-        self.requestedPieces = {} #pieces which are (partly) requested
-        self.waitingConns = set() #connections which allow requests and are not filled
+        self.requestedPieces = {}        #pieces which are (partly) requested
+        self.waitingConns = set()        #connections which allow requests and are not filled
+        self.checkedPieces = set()       #finished pieces which are currently checked (and written) in the background
+        self.failedWritePieces = set()   #pieces for which at least one write failed
+        self.pieceFinishedFunc = None    #called with (ident, pieceIndex) once a piece was successfully checked
+        self.requestSize = 4096          #size of a single request
+        self.restoredPieces = False      #persisted partial pieces were already restored
+        self.neededPiecesMask = None     #mask of the needed pieces during the last reset
         
         self.log = Logger('Requester', '%-6s - ', ident)
     
@@ -49,7 +60,7 @@ class Requester:
             if not pieceIndex in self.requestedPieces:
                 #first request for this piece
                 assert not endgame,'Endgame but still pieces left?!'
-                requestObj = Request(self.pieceStatus, pieceIndex, self.torrent.getLengthOfPiece(pieceIndex), 4096)
+                requestObj = Request(self.pieceStatus, pieceIndex, self.torrent.getLengthOfPiece(pieceIndex), self.requestSize)
                 self.requestedPieces[pieceIndex] = requestObj
                 requests = requestObj.getRequests(neededRequests, conn)
                 assert len(requests) > 0,str(pieceIndex)+': new request but nothing requestable?!'
@@ -90,7 +101,7 @@ class Requester:
             
         else:
             #actually need to request something
-            allRequestablePieces = conn.getStatus().getGotPieces()
+            allRequestablePieces = conn.getStatus().hasPiece                                             #only checked for the pieces which are actually considered
             
             #self.log.debug('available pieces:\n%s', str(sorted(connStatus.getGotPieces())))
             #self.log.debug('needed pieces:\n%s', str(sorted(self.requestablePieces[-1])))
@@ -173,6 +184,98 @@ class Requester:
         return success
     
     
+    ##internal functions - partial pieces
+    
+    def _restorePartialPieces(self, neededPieces):
+        #recreates the requests of pieces which were partly downloaded before the torrent was stopped
+        partialPieces = self.btPersister.get('Requester-partialPieces', None)
+        if partialPieces is not None:
+            self.btPersister.remove('Requester-partialPieces')
+            if not partialPieces['requestSize'] == self.requestSize:
+                self.log.info('Request size changed, ignoring persisted partial pieces')
+            else:
+                for pieceIndex, bitmap in partialPieces['pieces']:
+                    if pieceIndex in neededPieces and (not pieceIndex in self.requestedPieces) and (not pieceIndex in self.checkedPieces):
+                        requestObj = Request(self.pieceStatus, pieceIndex, self.torrent.getLengthOfPiece(pieceIndex), self.requestSize)
+                        offsets = requestObj.getRequestOffsets()
+                        bitmap = binaryToBin(bitmap)[:len(offsets)]
+                        finishedOffsets = [offsets[idx] for idx in xrange(0, len(bitmap)) if bitmap[idx] == '1']
+                        if 0 < len(finishedOffsets) < len(offsets):
+                            #the already finished data is on disk, don't buffer the remaining blocks
+                            self.log.debug('Restoring %i finished requests of piece %i', len(finishedOffsets), pieceIndex)
+                            requestObj.restoreFinishedRequests(finishedOffsets)
+                            self.requestedPieces[pieceIndex] = requestObj
+                            self.pieceBuffer.setWriteThrough(pieceIndex)
+                        else:
+                            self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -1)
+                            
+                            
+    ##internal functions - disk jobs
+    
+    def _writeBlocks(self, pieceIndex, blocks):
+        #executed by a disk worker
+        for offset, data in blocks:
+            self.storage.storeData(pieceIndex, data, offset)
+            
+            
+    def _wroteBlocks(self, success, result, pieceIndex):
+        if not success:
+            #failed to store data, the piece will fail its check
+            self.log.error('Failed to store data of piece "%i":\n%s', pieceIndex, result)
+            self.failedWritePieces.add(pieceIndex)
+            
+            
+    def _checkPiece(self, pieceIndex, pieceSize, pieceData, pieceHash):
+        #executed by a disk worker, returns True if the piece is valid
+        buffered = (pieceData is not None)
+        if pieceHash is None:
+            #hash is incomplete, need to hash the whole piece
+            if not buffered:
+                #piece was (at least partly) written to disk, need to read it back
+                pieceData = self.storage.getData(pieceIndex, 0, pieceSize)
+            pieceHash = sha1(pieceData).digest()
+        
+        valid = (pieceHash == self.torrent.getPieceHashByPieceIndex(pieceIndex))
+        if valid and buffered:
+            #verified piece from memory, write it to disk in one go
+            self.storage.storeData(pieceIndex, pieceData, 0)
+        return valid
+    
+    
+    def _checkedPiece(self, success, result, pieceIndex):
+        self.checkedPieces.remove(pieceIndex)
+        if not success:
+            self.log.error('Failed to check piece "%i":\n%s', pieceIndex, result)
+            valid = False
+        elif pieceIndex in self.failedWritePieces:
+            self.log.warn("Failed to store some data of piece %d, discarding it!", pieceIndex)
+            valid = False
+        else:
+            valid = result
+            if not valid:
+                self.log.warn("Checksum error for retrieved piece %d!", pieceIndex)
+        self.failedWritePieces.discard(pieceIndex)
+                
+        if valid:
+            #success
+            self.ownStatus.gotPiece(pieceIndex)
+            self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -2)
+            if self.ownStatus.isFinished():
+                #clear waiting conns
+                self.waitingConns.clear()
+            if self.pieceFinishedFunc is not None:
+                self.pieceFinishedFunc(self.ident, pieceIndex)
+                
+        elif self.ownStatus.needsPiece(pieceIndex):
+            #failure, try again
+            self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -1)
+            self._tryPieceWithWaitingConns(pieceIndex)
+            
+        else:
+            #failure, but the piece isn't needed anymore
+            self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -2)
+    
+    
     ##external functions - requests
     
     def makeRequests(self, conn):
@@ -190,55 +293,39 @@ class Requester:
             if request.isEmpty():
                 #not a single in progress piece, remove request object
                 del self.requestedPieces[pieceIndex]
+                self.pieceBuffer.discardPiece(pieceIndex)
                 self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -1)
     
     
     def finishedRequest(self, data, conn, pieceIndex, offset):
-        #finished a request
+        #finished a request, the data is buffered or written to disk in the background
         assert not self.ownStatus.isFinished(), 'already seed but finished a request?!'
-        finishedPiece = False
         request = self.requestedPieces[pieceIndex]
+        canceledConns = request.finishedRequest(offset, conn, data)
         
-        try:
-            self.storage.storeData(pieceIndex, data, offset)
-            success = True
-        except:
-            self.log.error('Failed to store data of piece "%i", offset "%i":\n%s', pieceIndex, offset, logTraceback())
-            success = False
+        #store data
+        blocks = self.pieceBuffer.storeBlock(pieceIndex, offset, data)
+        if len(blocks) > 0:
+            #piece isn't buffered in memory, write blocks directly
+            self.diskJobQueue.addJob(self.ident, self._writeBlocks, [pieceIndex, blocks],
+                                     callback=self._wroteBlocks, callbackArgs=[pieceIndex],
+                                     key=(self.ident, pieceIndex), writeBytes=sum(len(block[1]) for block in blocks))
         
-        if not success:
-            #failed to store data
-            canceledConns = []
-            request.failedRequest(offset, conn)
-            
-        else:
-            #stored data
-            canceledConns = request.finishedRequest(offset, conn)
+        #check if request is finished
+        if request.isFinished():
+            #finished piece, check it in the background (after all writes of this piece are done)
+            del self.requestedPieces[pieceIndex]
+            self.checkedPieces.add(pieceIndex)
+            self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -2)
             
-            #check if request is finished
-            if request.isFinished():
-                #finished piece
-                del self.requestedPieces[pieceIndex]
-                
-                #get data
-                try:
-                    pieceData = self.storage.getData(pieceIndex, 0, request.getPieceSize())
-                except:
-                    pieceData = ''
-                    self.log.error('Failed to read data of piece "%i":\n%s', pieceIndex, logTraceback())
-                
-                #check data
-                if sha1(pieceData).digest() == self.torrent.getPieceHashByPieceIndex(pieceIndex):
-                    #success
-                    finishedPiece = True
-                    self.ownStatus.gotPiece(pieceIndex)
-                    self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -2)
-                else:
-                    #failure
-                    if not pieceData == '':
-                        self.log.warn("Checksum error for retrieved piece %d!", pieceIndex)
-                    self.pieceStatus.setConcurrentRequestsCounter((pieceIndex,), -1)
-                    self._tryPieceWithWaitingConns(pieceIndex)
+            pieceData = self.pieceBuffer.popPiece(pieceIndex)
+            if pieceData is None:
+                writeBytes = 0
+            else:
+                writeBytes = len(pieceData)
+            self.diskJobQueue.addJob(self.ident, self._checkPiece, [pieceIndex, request.getPieceSize(), pieceData, request.getPieceHash()],
+                                     callback=self._checkedPiece, callbackArgs=[pieceIndex],
+                                     key=(self.ident, pieceIndex), writeBytes=writeBytes)
                     
         if self.ownStatus.isFinished():
             #clear waiting conns
@@ -250,8 +337,6 @@ class Requester:
             #make requests for canceled ones
             for conn in canceledConns:
                 self._makeRequestsForConn(conn)
-                
-        return finishedPiece
     
 
     def connGotUnchoked(self, conn):
@@ -275,23 +360,41 @@ class Requester:
         self.waitingConns.discard(conn)
         
         
+    def setPieceFinishedFunc(self, pieceFinishedFunc):
+        self.pieceFinishedFunc = pieceFinishedFunc
+        
+        
     def reset(self):
-        #pieces
-        neededPieces = self.ownStatus.getNeededPieces()
-        notNeededPieces = self.ownStatus.getGotPieces()
-        notNeededPieces.update(self.ownStatus.getMissingPieces())
-        notNeededPieces.difference_update(neededPieces)
+        #pieces, only those which got needed or not needed since the last reset need to be changed
+        pieceAmount = self.torrent.getTotalAmountOfPieces()
+        neededPiecesMask = self.ownStatus.getNeededPiecesMask()
+        if self.neededPiecesMask is None:
+            changedPiecesMask = (1L << pieceAmount) - 1
+        else:
+            changedPiecesMask = self.neededPiecesMask ^ neededPiecesMask
+        self.neededPiecesMask = neededPiecesMask
+        
+        neededPieces = set(bitfieldToPieces(maskToBitfield(changedPiecesMask & neededPiecesMask, pieceAmount)))
+        notNeededPieces = set(bitfieldToPieces(maskToBitfield(changedPiecesMask & ~neededPiecesMask, pieceAmount)))
+        
+        #restore partial pieces of the last run
+        if not self.restoredPieces:
+            self.restoredPieces = True
+            self._restorePartialPieces(neededPieces)
         
         #abort requests
         canceledConns = set()
-        requests = [pieceIndex for pieceIndex in self.requestedPieces if pieceIndex not in neededPieces]
+        requests = [pieceIndex for pieceIndex in self.requestedPieces if pieceIndex in notNeededPieces]
         for pieceIndex in requests:
             self.log.debug('Aborting requests for piece %i', pieceIndex)
             canceledConns.update(self.requestedPieces[pieceIndex].abortAllRequests())
             del self.requestedPieces[pieceIndex]
+            self.pieceBuffer.discardPiece(pieceIndex)
+            self.failedWritePieces.discard(pieceIndex)
             
         #change piece status
         neededPieces.difference_update(set(self.requestedPieces.iterkeys()))
+        neededPieces.difference_update(self.checkedPieces)
         self.pieceStatus.setConcurrentRequestsCounter(notNeededPieces, -2)
         self.pieceStatus.setConcurrentRequestsCounter(neededPieces, -1)
                 
@@ -300,6 +403,20 @@ class Requester:
             self._makeRequestsForConn(conn)
             
             
+    def persistPartialPieces(self):
+        #persists which requests of partly downloaded pieces are finished, all data needs to be on disk already
+        if self.restoredPieces and self.config.get('storage', 'persistPieceStatus'):
+            pieces = []
+            for pieceIndex, requestObj in self.requestedPieces.iteritems():
+                if not pieceIndex in self.failedWritePieces:
+                    bitmap = requestObj.getFinishedRequestsBitmap()
+                    if '1' in bitmap:
+                        pieces.append((pieceIndex, binToBinary(bitmap)))
+            self.log.debug('Persisting %i partial pieces', len(pieces))
+            self.btPersister.store('Requester-partialPieces', {'requestSize':self.requestSize,
+                                                               'pieces':pieces})
+            
+            
     def getStats(self, **kwargs):
         stats = {}
         if kwargs.get('requestDetails', False):
@@ -17,15 +17,53 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from collections import deque
+from array import array
+from time import time
+import string
 import threading
 
-from Conversion import binaryToBin, binToBinary
+from Conversion import bitfieldBitCount, bitfieldToMask, bitfieldToPieces, maskToBitfield
+
+
+##bit masks - piece i is bit i of a long, bitwise operations and conversions run in C
+
+_flagsToBin = string.maketrans('\x00\x01', '01')
+
+
+def _bitCount(mask):
+    #counts the set bits over the packed bytes of the mask
+    return bitfieldBitCount(maskToBitfield(mask, len('%x' % (mask,)) * 4))
+
+
+def _piecesToMask(pieces, pieceAmount):
+    #converts an iterable of piece indexes or a mask into a mask
+    if isinstance(pieces, (int, long)):
+        mask = pieces
+    else:
+        flags = array('B', [0]) * pieceAmount
+        for pieceIndex in pieces:
+            flags[pieceIndex] = 1
+        mask = long(flags.tostring().translate(_flagsToBin)[::-1] or '0', 2)
+    return mask
+
+
+def _rangeToMask(firstPiece, lastPiece):
+    #returns a mask with all pieces from firstPiece up to and including lastPiece set
+    return ((1L << (lastPiece - firstPiece + 1)) - 1) << firstPiece
+
+
+def _maskToPieces(mask):
+    #returns a set of the indexes of all set bits
+    return set(bitfieldToPieces(maskToBitfield(mask, len('%x' % (mask,)) * 4)))
+
+
+
 
 class Status:
     def __init__(self, pieceAmount, pieceStatus=None):
         self.pieceAmount = pieceAmount
         self.pieceStatus = pieceStatus
+        self.allPieces = (1L << pieceAmount) - 1      #mask with all pieces set
         
         self._initStatus()
         
@@ -35,21 +73,22 @@ class Status:
     ##internal functions - bitfield
     
     def _getBitfield(self):
-        return ''.join((str(int(pieceIndex in self.gotPieces)) for pieceIndex in xrange(0, self.pieceAmount)))
+        return self.gotPiecesBits.tostring()
         
         
     ##internal functions - pieces
         
     def _initStatus(self):
-        self.gotPieces = set()
+        self.gotPieces = 0L                             #mask of got pieces, missing pieces are the complement
+        self.gotPiecesBits = array('B', [0]) * ((self.pieceAmount + 7) / 8) #the same pieces packed like a bitfield, allows lookups of single pieces in constant time
         self.gotPiecesCount = 0
-        self.missingPieces = set()
-        
-        for piece in xrange(0, self.pieceAmount):
-            self.missingPieces.add(piece)
         self.missingPiecesCount = self.pieceAmount
         
         
+    def _getMissingPieces(self):
+        return self.allPieces ^ self.gotPieces
+        
+        
     def _clear(self):
         if self.pieceStatus is not None:
             self.pieceStatus.decreaseAvailability(bitfield=self._getBitfield())
@@ -57,20 +96,28 @@ class Status:
             
             
     def _addBitfield(self, bitfield):
-        for pieceIndex in xrange(0, self.pieceAmount):
-            if bitfield[pieceIndex]=='1':
-                self.gotPieces.add(pieceIndex)
-                self.missingPieces.remove(pieceIndex)
-                self.gotPiecesCount += 1
-                self.missingPiecesCount -=1
+        pieces = bitfieldToMask(bitfield)
+        if self.gotPieces == 0 and pieces >> self.pieceAmount == 0 and len(bitfield) == len(self.gotPiecesBits):
+            #nothing known yet (the usual case for peers), counting the bits of the packed bitfield is faster
+            newPieces = pieces
+            newPiecesCount = bitfieldBitCount(bitfield)
+            self.gotPieces = newPieces
+            self.gotPiecesBits = array('B', bitfield)
+        else:
+            newPieces = pieces & self.allPieces & ~self.gotPieces
+            newPiecesCount = _bitCount(newPieces)
+            self.gotPieces |= newPieces
+            self.gotPiecesBits = array('B', maskToBitfield(self.gotPieces, self.pieceAmount))
+        self.gotPiecesCount += newPiecesCount
+        self.missingPiecesCount -= newPiecesCount
                 
         if self.pieceStatus is not None:
             self.pieceStatus.increaseAvailability(bitfield=bitfield)
     
     
     def _gotPiece(self, pieceIndex):
-        self.missingPieces.remove(pieceIndex)
-        self.gotPieces.add(pieceIndex)
+        self.gotPieces |= 1L << pieceIndex
+        self.gotPiecesBits[pieceIndex >> 3] |= 0x80 >> (pieceIndex & 7)
         self.gotPiecesCount += 1
         self.missingPiecesCount -= 1
         
@@ -79,19 +126,20 @@ class Status:
     
     
     def _setPieceStatus(self, pieceIndex, got):
-        if got and pieceIndex in self.missingPieces:
+        pieceBit = 1L << pieceIndex
+        if got and not self.gotPieces & pieceBit:
             #piece is in wrong set
-            self.missingPieces.remove(pieceIndex)
-            self.gotPieces.add(pieceIndex)
+            self.gotPieces |= pieceBit
+            self.gotPiecesBits[pieceIndex >> 3] |= 0x80 >> (pieceIndex & 7)
             self.missingPiecesCount -= 1
             self.gotPiecesCount += 1
             if self.pieceStatus is not None:
                 self.pieceStatus.increaseAvailability(pieceIndex=pieceIndex)
         
-        elif (not got) and pieceIndex in self.gotPieces:
+        elif (not got) and self.gotPieces & pieceBit:
             #piece is in wrong set
-            self.gotPieces.remove(pieceIndex)
-            self.missingPieces.add(pieceIndex)
+            self.gotPieces ^= pieceBit
+            self.gotPiecesBits[pieceIndex >> 3] &= ~(0x80 >> (pieceIndex & 7))
             self.gotPiecesCount -= 1
             self.missingPiecesCount += 1
             if self.pieceStatus is not None:
@@ -108,7 +156,7 @@ class Status:
 
     def gotPiece(self, pieceIndex):
         self.lock.acquire()
-        assert pieceIndex in self.missingPieces,'got piece which we already had?!'
+        assert not self.gotPieces & (1L << pieceIndex),'got piece which we already had?!'
         self._gotPiece(pieceIndex)
         self.lock.release()
         
@@ -127,20 +175,37 @@ class Status:
         
     ##external functions - get information about the pieces
     
+    #the "pieces" argument of the hasMatching*/getMatching* functions may either be an iterable of piece indexes or
+    #a mask as returned by the get*PiecesMask functions, masks are intersected without converting them to sets
+    
     def getGotPieces(self):
         self.lock.acquire()
-        pieces = self.gotPieces.copy()
+        pieces = _maskToPieces(self.gotPieces)
         self.lock.release()
         return pieces
     
 
     def getMissingPieces(self):
         self.lock.acquire()
-        pieces = self.missingPieces.copy()
+        pieces = _maskToPieces(self._getMissingPieces())
         self.lock.release()
         return pieces
     
     
+    def getGotPiecesMask(self):
+        self.lock.acquire()
+        mask = self.gotPieces
+        self.lock.release()
+        return mask
+    
+    
+    def getMissingPiecesMask(self):
+        self.lock.acquire()
+        mask = self._getMissingPieces()
+        self.lock.release()
+        return mask
+    
+    
     def getAmountOfGotPieces(self):
         self.lock.acquire()
         count = self.gotPiecesCount
@@ -157,28 +222,28 @@ class Status:
 
     def hasMatchingGotPieces(self, pieces):
         self.lock.acquire()
-        result = (len(self.gotPieces.intersection(pieces)) > 0)
+        result = (self.gotPieces & _piecesToMask(pieces, self.pieceAmount) != 0)
         self.lock.release()
         return result
     
 
     def hasMatchingMissingPieces(self, pieces):
         self.lock.acquire()
-        result = (len(self.missingPieces.intersection(pieces)) > 0)
+        result = (self._getMissingPieces() & _piecesToMask(pieces, self.pieceAmount) != 0)
         self.lock.release()
         return result
     
 
     def getMatchingGotPieces(self, pieces):
         self.lock.acquire()
-        pieces = self.gotPieces.intersection(pieces)
+        pieces = _maskToPieces(self.gotPieces & _piecesToMask(pieces, self.pieceAmount))
         self.lock.release()
         return pieces
 
 
     def getMatchingMissingPieces(self, pieces):
         self.lock.acquire()
-        pieces = self.missingPieces.intersection(pieces)
+        pieces = _maskToPieces(self._getMissingPieces() & _piecesToMask(pieces, self.pieceAmount))
         self.lock.release()
         return pieces
     
@@ -192,14 +257,14 @@ class Status:
     
     def hasPiece(self, pieceIndex):
         self.lock.acquire()
-        result = pieceIndex in self.gotPieces
+        result = 0 <= pieceIndex < self.pieceAmount and self.gotPiecesBits[pieceIndex >> 3] & (0x80 >> (pieceIndex & 7)) != 0
         self.lock.release()
         return result
     
 
     def needsPiece(self, pieceIndex):
         self.lock.acquire()
-        result =  pieceIndex in self.missingPieces
+        result = 0 <= pieceIndex < self.pieceAmount and self.gotPiecesBits[pieceIndex >> 3] & (0x80 >> (pieceIndex & 7)) == 0
         self.lock.release()
         return result
     
@@ -229,6 +294,80 @@ class Status:
 
 
 
+class PeerStatus(Status):
+    def __init__(self, pieceAmount, pieceStatus, ownStatus):
+        self.ownStatus = ownStatus
+        Status.__init__(self, pieceAmount, pieceStatus)
+        
+    ##internal functions - pieces
+    
+    def _initStatus(self):
+        Status._initStatus(self)
+        self.piecesNeededByUs = 0                                      #pieces which the peer has and we need
+        self.piecesNeededByPeer = self.ownStatus.getAmountOfGotPieces() #pieces which we have and the peer misses
+        
+        
+    def _countMatchingPieces(self):
+        self.piecesNeededByUs = _bitCount(self.gotPieces & self.ownStatus.getNeededPiecesMask())
+        self.piecesNeededByPeer = _bitCount(self.ownStatus.getGotPiecesMask() & ~self.gotPieces)
+        
+        
+    def _addBitfield(self, bitfield):
+        Status._addBitfield(self, bitfield)
+        self._countMatchingPieces()
+        
+        
+    def _gotPiece(self, pieceIndex):
+        Status._gotPiece(self, pieceIndex)
+        if self.ownStatus.needsPiece(pieceIndex):
+            self.piecesNeededByUs += 1
+        elif self.ownStatus.hasPiece(pieceIndex):
+            self.piecesNeededByPeer -= 1
+            
+            
+    def _setPieceStatus(self, pieceIndex, got):
+        Status._setPieceStatus(self, pieceIndex, got)
+        self._countMatchingPieces()
+        
+        
+    ##external functions - changes of our own status
+    
+    #our own status doesn't notify the status objects of peers by itself (lock order), the connection handler calls
+    #these functions after it changed
+    
+    def ownGotPiece(self, pieceIndex):
+        self.lock.acquire()
+        if self.gotPiecesBits[pieceIndex >> 3] & (0x80 >> (pieceIndex & 7)):
+            self.piecesNeededByUs -= 1
+        else:
+            self.piecesNeededByPeer += 1
+        self.lock.release()
+        
+        
+    def ownNeededPiecesChanged(self):
+        self.lock.acquire()
+        self.piecesNeededByUs = _bitCount(self.gotPieces & self.ownStatus.getNeededPiecesMask())
+        self.lock.release()
+        
+        
+    ##external functions - get information about the pieces
+    
+    def getAmountOfPiecesNeededByUs(self):
+        self.lock.acquire()
+        result = self.piecesNeededByUs
+        self.lock.release()
+        return result
+    
+    
+    def getAmountOfPiecesNeededByPeer(self):
+        self.lock.acquire()
+        result = self.piecesNeededByPeer
+        self.lock.release()
+        return result
+    
+    
+    
+    
 class OwnStatus(Status):
     def __init__(self, pieceAmount, pieceStatus=None):
         Status.__init__(self, pieceAmount, pieceStatus)
@@ -237,57 +376,60 @@ class OwnStatus(Status):
         
     def _initStatus(self):
         Status._initStatus(self)
-        self.wantedPieces = set(xrange(0, self.pieceAmount)) #pieces which we actually want to download
+        self.wantedPieces = self.allPieces                  #pieces which we actually want to download
+        self.wantedPiecesBits = array('B', maskToBitfield(self.wantedPieces, self.pieceAmount))
         self.wantedPiecesCount = self.pieceAmount
-        self.neededPieces = self.missingPieces.copy()        #pieces which are both missing and wanted
+        self.neededPieces = self._getMissingPieces()        #pieces which are both missing and wanted
         self.neededPiecesCount = self.missingPiecesCount
             
             
     def _addBitfield(self, bitfield):
-        for pieceIndex in xrange(0, self.pieceAmount):
-            if bitfield[pieceIndex]=='1':
-                if pieceIndex in self.neededPieces:
-                    self.neededPieces.remove(pieceIndex)
-                    self.neededPiecesCount -= 1
+        noLongerNeededPieces = bitfieldToMask(bitfield) & self.neededPieces
+        self.neededPieces ^= noLongerNeededPieces
+        self.neededPiecesCount -= _bitCount(noLongerNeededPieces)
         Status._addBitfield(self, bitfield)
     
     
     def _gotPiece(self, pieceIndex):
-        assert pieceIndex in self.neededPieces, 'got piece which we don\'t want?!'
-        self.neededPieces.remove(pieceIndex)
+        pieceBit = 1L << pieceIndex
+        assert self.neededPieces & pieceBit, 'got piece which we don\'t want?!'
+        self.neededPieces ^= pieceBit
         self.neededPiecesCount -= 1
         Status._gotPiece(self, pieceIndex)
     
     
     def _setPieceStatus(self, pieceIndex, got):
-        if got and pieceIndex in self.neededPieces:
+        pieceBit = 1L << pieceIndex
+        if got and self.neededPieces & pieceBit:
             #piece is no longer needed
-            self.neededPieces.remove(pieceIndex)
+            self.neededPieces ^= pieceBit
             self.neededPiecesCount -= 1
             
-        elif (not got) and (not pieceIndex in self.neededPieces) and pieceIndex in self.wantedPieces:
+        elif (not got) and (not self.neededPieces & pieceBit) and self.wantedPieces & pieceBit:
             #piece is again needed
-            self.neededPieces.add(pieceIndex)
+            self.neededPieces |= pieceBit
             self.neededPiecesCount += 1
             
         Status._setPieceStatus(self, pieceIndex, got)
         
         
     def _setPieceWantedFlag(self, pieces, wanted):
-        for pieceIndex in pieces:
-            if wanted and pieceIndex not in self.wantedPieces:
-                self.wantedPieces.add(pieceIndex)
-                self.wantedPiecesCount += 1
-                if pieceIndex in self.missingPieces:
-                    self.neededPieces.add(pieceIndex)
-                    self.neededPiecesCount += 1
-                    
-            elif (not wanted) and pieceIndex in self.wantedPieces:
-                self.wantedPieces.remove(pieceIndex)
-                self.wantedPiecesCount -= 1
-                if pieceIndex in self.missingPieces:
-                    self.neededPieces.remove(pieceIndex)
-                    self.neededPiecesCount -= 1
+        pieces = _piecesToMask(pieces, self.pieceAmount)
+        if wanted:
+            changedPieces = pieces & ~self.wantedPieces
+            self.wantedPieces |= changedPieces
+            self.wantedPiecesCount += _bitCount(changedPieces)
+            changedPieces &= self._getMissingPieces()
+            self.neededPieces |= changedPieces
+            self.neededPiecesCount += _bitCount(changedPieces)
+        else:
+            changedPieces = pieces & self.wantedPieces
+            self.wantedPieces ^= changedPieces
+            self.wantedPiecesCount -= _bitCount(changedPieces)
+            changedPieces &= self.neededPieces
+            self.neededPieces ^= changedPieces
+            self.neededPiecesCount -= _bitCount(changedPieces)
+        self.wantedPiecesBits = array('B', maskToBitfield(self.wantedPieces, self.pieceAmount))
     
     
     ##external functions - change status
@@ -298,22 +440,42 @@ class OwnStatus(Status):
         self.lock.release()
         
         
+    def setRangeWantedFlag(self, firstPiece, lastPiece, wanted):
+        self.lock.acquire()
+        self._setPieceWantedFlag(_rangeToMask(firstPiece, lastPiece), wanted)
+        self.lock.release()
+        
+        
     ##external functions - get information about the pieces
     
     def getWantedPieces(self):
         self.lock.acquire()
-        pieces = self.wantedPieces.copy()
+        pieces = _maskToPieces(self.wantedPieces)
         self.lock.release()
         return pieces
     
     
     def getNeededPieces(self):
         self.lock.acquire()
-        pieces = self.neededPieces.copy()
+        pieces = _maskToPieces(self.neededPieces)
         self.lock.release()
         return pieces
     
     
+    def getWantedPiecesMask(self):
+        self.lock.acquire()
+        mask = self.wantedPieces
+        self.lock.release()
+        return mask
+    
+    
+    def getNeededPiecesMask(self):
+        self.lock.acquire()
+        mask = self.neededPieces
+        self.lock.release()
+        return mask
+    
+    
     def getAmountOfWantedPieces(self):
         self.lock.acquire()
         count = self.wantedPiecesCount
@@ -330,42 +492,43 @@ class OwnStatus(Status):
     
     def hasMatchingWantedPieces(self, pieces):
         self.lock.acquire()
-        result = (len(self.wantedPieces.intersection(pieces)) > 0)
+        result = (self.wantedPieces & _piecesToMask(pieces, self.pieceAmount) != 0)
         self.lock.release()
         return result
     
     
     def hasMatchingNeededPieces(self, pieces):
         self.lock.acquire()
-        result = (len(self.neededPieces.intersection(pieces)) > 0)
+        result = (self.neededPieces & _piecesToMask(pieces, self.pieceAmount) != 0)
         self.lock.release()
         return result
     
     
     def getMatchingWantedPieces(self, pieces):
         self.lock.acquire()
-        pieces = self.wantedPieces.intersection(pieces)
+        pieces = _maskToPieces(self.wantedPieces & _piecesToMask(pieces, self.pieceAmount))
         self.lock.release()
         return pieces
     
     
     def getMatchingNeededPieces(self, pieces):
         self.lock.acquire()
-        pieces = self.neededPieces.intersection(pieces)
+        pieces = _maskToPieces(self.neededPieces & _piecesToMask(pieces, self.pieceAmount))
         self.lock.release()
         return pieces
     
     
     def wantsPiece(self, pieceIndex):
         self.lock.acquire()
-        result = pieceIndex in self.wantedPieces
+        result = 0 <= pieceIndex < self.pieceAmount and self.wantedPiecesBits[pieceIndex >> 3] & (0x80 >> (pieceIndex & 7)) != 0
         self.lock.release()
         return result
     
     
     def needsPiece(self, pieceIndex):
         self.lock.acquire()
-        result = pieceIndex in self.neededPieces
+        pieceBit = 0x80 >> (pieceIndex & 7)
+        result = 0 <= pieceIndex < self.pieceAmount and self.wantedPiecesBits[pieceIndex >> 3] & pieceBit != 0 and self.gotPiecesBits[pieceIndex >> 3] & pieceBit == 0
         self.lock.release()
         return result
     
@@ -386,9 +549,19 @@ class PersistentOwnStatus(OwnStatus):
         self.btPersister = btPersister
         self.shouldPersist = shouldPersist
         self.allowedToPersist = False
+        
+        #journal - finished pieces are appended to a journal instead of storing the whole bitfield each time,
+        #the journal is compacted into a new bitfield once it gets too long or the status gets flushed
+        self.journal = []                #pieces which were finished since the last stored bitfield
+        self.journalStoreTime = 0        #time of the last store of the journal
+        self.journalExists = True        #the persister might still contain a journal (of the last run)
+        self.journalDelay = 5            #min seconds between two stores of the journal
+        self.maxJournalLength = 512      #max number of journal entries, the journal gets compacted then
+        
         if not self.shouldPersist:
             #remove any leftovers
             self.btPersister.remove('PersistentStatus-bitfield')
+            self._removeJournal()
             
         OwnStatus.__init__(self, pieceAmount, pieceStatus)
         
@@ -396,10 +569,33 @@ class PersistentOwnStatus(OwnStatus):
     ##internal functions - persisting
         
     def _persist(self):
+        #stores the whole bitfield, which makes the journal obsolete
         if self.shouldPersist and self.allowedToPersist:
-            binaryBitfield = binToBinary(''.join((str(int(pieceIndex in self.gotPieces)) for pieceIndex in xrange(0, self.pieceAmount))))
-            self.btPersister.store('PersistentStatus-bitfield', binaryBitfield)
+            self.btPersister.store('PersistentStatus-bitfield', self._getBitfield())
+            self._removeJournal()
+            
+            
+    def _persistJournal(self):
+        #pieces which are not yet in the stored journal are lost on a crash, this is fine because all files which
+        #were written to since their stamps were stored get checked again on the next load (see Storage, which
+        #flushes the journal before storing the stamps)
+        if self.shouldPersist and self.allowedToPersist:
+            if len(self.journal) >= self.maxJournalLength:
+                #compact
+                self._persist()
+            elif time() - self.journalStoreTime >= self.journalDelay:
+                #debounced store
+                self.btPersister.store('PersistentStatus-journal', self.journal)
+                self.journalStoreTime = time()
+                self.journalExists = True
+                
                 
+    def _removeJournal(self):
+        self.journal = []
+        if self.journalExists:
+            self.btPersister.remove('PersistentStatus-journal')
+            self.journalExists = False
+            
         
     ##internal functions - pieces
         
@@ -415,7 +611,9 @@ class PersistentOwnStatus(OwnStatus):
     
     def _gotPiece(self, pieceIndex):
         OwnStatus._gotPiece(self, pieceIndex)
-        self._persist()
+        if self.shouldPersist and self.allowedToPersist:
+            self.journal.append(pieceIndex)
+            self._persistJournal()
             
     
     def _setPieceStatus(self, pieceIndex, got):
@@ -432,7 +630,12 @@ class PersistentOwnStatus(OwnStatus):
             bitfield = self.btPersister.get('PersistentStatus-bitfield', None)
             if bitfield is not None:
                 success = True
-                self._addBitfield(binaryToBin(bitfield))
+                self._addBitfield(bitfield)
+                
+                #replay the journal, the pieces in it may already be part of the bitfield
+                for pieceIndex in self.btPersister.get('PersistentStatus-journal', ()):
+                    if 0 <= pieceIndex < self.pieceAmount:
+                        OwnStatus._setPieceStatus(self, pieceIndex, True)
         self.lock.release()
         return success
     
@@ -443,6 +646,14 @@ class PersistentOwnStatus(OwnStatus):
         self.allowedToPersist = True
         self._persist()
         self.lock.release()
+        
+        
+    def flush(self):
+        #compacts the journal into the stored bitfield, called when the torrent gets stopped and before file stamps are stored
+        self.lock.acquire()
+        if len(self.journal) > 0:
+            self._persist()
+        self.lock.release()
     
     
     def enablePersisting(self, active):
@@ -456,5 +667,6 @@ class PersistentOwnStatus(OwnStatus):
             #got deactived
             self.shouldPersist = False
             self.btPersister.remove('PersistentStatus-bitfield')
+            self._removeJournal()
             
         self.lock.release()
\ No newline at end of file
@@ -19,12 +19,17 @@ along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 
 ##builtin
 from __future__ import with_statement
+from collections import deque
 from hashlib import sha1
+from Queue import Queue
 from time import time
+import mmap
 import os
+import sys
 import threading
 
 ##own
+from Conversion import maskToBitfield
 from Logger import Logger
 from Status import PersistentOwnStatus
 from Utilities import logTraceback
@@ -38,34 +43,1112 @@ class StorageException(Exception):
         
         
 
+def _getPosixFallocate():
+    #returns a function which behaves like posix_fallocate(fd, offset, length), None if it isn't available on this platform
+    func = getattr(os, 'posix_fallocate', None)
+    if func is None:
+        try:
+            import ctypes
+            import ctypes.util
+            cFunc = ctypes.CDLL(ctypes.util.find_library('c')).posix_fallocate64
+            cFunc.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+            def func(fd, offset, length):
+                result = cFunc(fd, offset, length)
+                if not result == 0:
+                    raise OSError(result, os.strerror(result))
+        except (ImportError, OSError, AttributeError):
+            func = None
+    return func
+
+posixFallocate = _getPosixFallocate()
+
+
+
+
+class StorageLruQueue:
+    """
+    Keeps entries (dicts) of a pool or cache in least-recently-used order. Adding, moving and removing an entry
+    takes constant time: the entry remembers the stamp of its newest place in the queue, places with an older
+    stamp are skipped and dropped lazily.
+    """
+    
+    def __init__(self):
+        self.queue = deque()    #(stamp, entry), least recently used first, may contain outdated places
+        self.nextStamp = 0
+        self.length = 0         #number of queued entries
+        
+        
+    def __len__(self):
+        return self.length
+    
+    
+    def __iter__(self):
+        #iterates over a snapshot of the queued entries, least recently used first
+        return iter([entry for stamp, entry in self.queue if entry['lruStamp'] == stamp])
+    
+    
+    def _compact(self):
+        #drops all outdated places, keeps the queue from growing when entries are moved but never popped
+        self.queue = deque([(stamp, entry) for stamp, entry in self.queue if entry['lruStamp'] == stamp])
+        
+        
+    def add(self, entry):
+        #adds the entry as the most recently used one, moves it there if it is already queued
+        if entry.get('lruStamp', None) is None:
+            self.length += 1
+        entry['lruStamp'] = self.nextStamp
+        self.queue.append((self.nextStamp, entry))
+        self.nextStamp += 1
+        if len(self.queue) > 2 * self.length + 64:
+            self._compact()
+            
+            
+    def remove(self, entry):
+        if entry.get('lruStamp', None) is not None:
+            entry['lruStamp'] = None
+            self.length -= 1
+            
+            
+    def pop(self):
+        #removes and returns the least recently used entry
+        stamp, entry = self.queue.popleft()
+        while not entry['lruStamp'] == stamp:
+            stamp, entry = self.queue.popleft()
+        entry['lruStamp'] = None
+        self.length -= 1
+        return entry
+    
+    
+    
+
+class StorageFilePool:
+    """
+    A bounded pool of open file handles, shared by all storage objects. Idle handles are kept
+    open and get closed in least-recently-used order once the limit is reached, so that
+    reading or writing a block doesn't cost an open and a close call each time.
+    """
+    
+    def __init__(self, maxOpenFiles):
+        self.maxOpenFiles = max(1, maxOpenFiles)
+        
+        self.openFiles = 0          #number of open handles, both idle and in use
+        self.idleHandles = {}       #(ident, path) => list of idle handles
+        self.idleQueue = StorageLruQueue()  #idle handles, least recently used first
+        self.usedHandles = {}       #ident => list of handles which are currently in use
+        
+        #stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self.lock = threading.Lock()
+        
+        
+    ##internal functions - handles
+    
+    def _openFile(self, filePath):
+        #open the file unbuffered, reads and writes are large enough and this prevents stale buffers
+        try:
+            fl = open(filePath, 'rb+', 0)
+            writable = True
+        except IOError:
+            fl = open(filePath, 'rb', 0)
+            writable = False
+        return fl, writable
+    
+    
+    def _removeIdleHandle(self, handle):
+        idle = self.idleHandles[handle['key']]
+        idle.remove(handle)
+        if len(idle) == 0:
+            del self.idleHandles[handle['key']]
+        
+        
+    def _evictIdleHandles(self, limit):
+        #close least recently used idle handles until at most limit handles are open
+        closedFiles = []
+        while self.openFiles > limit and len(self.idleQueue) > 0:
+            handle = self.idleQueue.pop()
+            self._removeIdleHandle(handle)
+            closedFiles.append(handle['file'])
+            self.openFiles -= 1
+            self.evictions += 1
+        return closedFiles
+    
+    
+    def _closeFiles(self, files):
+        for fl in files:
+            try:
+                fl.close()
+            except IOError:
+                pass
+    
+    
+    ##external functions - handles
+    
+    def acquire(self, ident, filePath, writable):
+        #returns an open handle for the given file, which is exclusively used until it is released again
+        key = (ident, filePath)
+        with self.lock:
+            handle = None
+            for idleHandle in self.idleHandles.get(key, ()):
+                if idleHandle['writable'] or not writable:
+                    handle = idleHandle
+                    break
+                    
+            if handle is not None:
+                #reuse idle handle
+                self._removeIdleHandle(handle)
+                self.idleQueue.remove(handle)
+                self.hits += 1
+                closedFiles = []
+            else:
+                #need to open the file, reserve a slot
+                self.misses += 1
+                closedFiles = self._evictIdleHandles(self.maxOpenFiles - 1)
+                self.openFiles += 1
+            
+        self._closeFiles(closedFiles)
+        
+        if handle is None:
+            #open file outside of the lock
+            try:
+                fl, fileWritable = self._openFile(filePath)
+            except:
+                with self.lock:
+                    self.openFiles -= 1
+                raise
+            handle = {'key':key,
+                      'file':fl,
+                      'writable':fileWritable,
+                      'discard':False}
+            
+        with self.lock:
+            self.usedHandles.setdefault(ident, []).append(handle)
+        return handle
+    
+    
+    def release(self, handle, failed=False):
+        #gives a handle back to the pool, handles which encountered errors are closed
+        ident = handle['key'][0]
+        with self.lock:
+            used = self.usedHandles[ident]
+            used.remove(handle)
+            if len(used) == 0:
+                del self.usedHandles[ident]
+                
+            if failed or handle['discard']:
+                #close handle
+                self.openFiles -= 1
+                closedFiles = [handle['file']]
+            else:
+                #keep it open for later use
+                self.idleHandles.setdefault(handle['key'], []).append(handle)
+                self.idleQueue.add(handle)
+                closedFiles = self._evictIdleHandles(self.maxOpenFiles)
+                
+        self._closeFiles(closedFiles)
+    
+    
+    def closeAll(self, ident):
+        #closes all idle handles which belong to the given ident, handles in use get closed on release
+        with self.lock:
+            closedFiles = []
+            for handle in self.idleQueue:
+                if handle['key'][0] == ident:
+                    self.idleQueue.remove(handle)
+                    self._removeIdleHandle(handle)
+                    closedFiles.append(handle['file'])
+                    self.openFiles -= 1
+                    
+            for handle in self.usedHandles.get(ident, ()):
+                handle['discard'] = True
+                
+        self._closeFiles(closedFiles)
+        
+        
+    def setMaxOpenFiles(self, maxOpenFiles):
+        with self.lock:
+            self.maxOpenFiles = max(1, maxOpenFiles)
+            closedFiles = self._evictIdleHandles(self.maxOpenFiles)
+        self._closeFiles(closedFiles)
+        
+        
+    ##external functions - stats
+    
+    def getStats(self):
+        with self.lock:
+            stats = {}
+            stats['filePoolOpenFiles'] = self.openFiles
+            stats['filePoolHits'] = self.hits
+            stats['filePoolMisses'] = self.misses
+            stats['filePoolEvictions'] = self.evictions
+        return stats
+        
+        
+        
+
+class StorageReadCache:
+    """
+    A byte-budgeted cache for data read from disk, shared by all storage objects. Data is cached in aligned
+    spans of a piece (the whole piece for normal piece sizes), the least recently used spans are dropped
+    once the budget is exceeded.
+    """
+    
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.usedBytes = 0
+        
+        self.spans = {}                     #(ident, pieceIndex, spanOffset) => span entry ({'key', 'data'})
+        self.pieceSpans = {}                #(ident, pieceIndex) => set of cached span offsets
+        self.lruQueue = StorageLruQueue()   #cached span entries, least recently used first
+        
+        #stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self.lock = threading.Lock()
+        
+        
+    ##internal functions - spans
+    
+    def _removeSpan(self, key):
+        span = self.spans.pop(key)
+        self.lruQueue.remove(span)
+        self.usedBytes -= len(span['data'])
+        pieceKey = key[:2]
+        pieceSpans = self.pieceSpans[pieceKey]
+        pieceSpans.remove(key[2])
+        if len(pieceSpans) == 0:
+            del self.pieceSpans[pieceKey]
+            
+            
+    def _evictSpans(self, limit):
+        #drop least recently used spans until at most limit bytes are cached
+        while self.usedBytes > limit and len(self.lruQueue) > 0:
+            self._removeSpan(self.lruQueue.pop()['key'])
+            self.evictions += 1
+            
+            
+    ##external functions - spans
+    
+    def get(self, ident, pieceIndex, spanOffset):
+        #returns the cached data of the span, None if it isn't cached
+        key = (ident, pieceIndex, spanOffset)
+        with self.lock:
+            span = self.spans.get(key, None)
+            if span is None:
+                self.misses += 1
+                data = None
+            else:
+                self.hits += 1
+                self.lruQueue.add(span)
+                data = span['data']
+        return data
+    
+    
+    def add(self, ident, pieceIndex, spanOffset, data):
+        key = (ident, pieceIndex, spanOffset)
+        with self.lock:
+            if len(data) <= self.maxBytes and not key in self.spans:
+                self._evictSpans(self.maxBytes - len(data))
+                span = {'key':key,
+                        'data':data}
+                self.spans[key] = span
+                self.pieceSpans.setdefault(key[:2], set()).add(spanOffset)
+                self.lruQueue.add(span)
+                self.usedBytes += len(data)
+                
+                
+    def invalidate(self, ident, pieces):
+        #drops all cached spans of the given pieces, needs to be called whenever data of a piece gets written
+        with self.lock:
+            for pieceIndex in pieces:
+                for spanOffset in list(self.pieceSpans.get((ident, pieceIndex), ())):
+                    self._removeSpan((ident, pieceIndex, spanOffset))
+                    
+                    
+    def clear(self, ident):
+        #drops all cached spans of the given ident
+        with self.lock:
+            for key in [key for key in self.spans.iterkeys() if key[0] == ident]:
+                self._removeSpan(key)
+                
+                
+    def mayCache(self, bytes):
+        #returns True if spans of the given size fit into the cache
+        with self.lock:
+            return (bytes <= self.maxBytes)
+        
+        
+    def setMaxBytes(self, maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            self._evictSpans(self.maxBytes)
+            
+            
+    ##external functions - stats
+    
+    def getStats(self):
+        with self.lock:
+            stats = {}
+            stats['readCacheBytes'] = self.usedBytes
+            stats['readCacheHits'] = self.hits
+            stats['readCacheMisses'] = self.misses
+            stats['readCacheHitRate'] = (self.hits * 1.0) / max(self.hits + self.misses, 1)
+            stats['readCacheEvictions'] = self.evictions
+        return stats
+        
+        
+        
+
+class StorageMmapPool:
+    """
+    A bounded pool of memory mappings of data files, shared by all storage objects which use the mmap backend.
+    Files are mapped lazily in windows of a fixed size, unused windows are unmapped in least-recently-used order
+    once the number of mapped bytes exceeds the limit.
+    """
+    
+    def __init__(self, maxMappedBytes):
+        self.maxMappedBytes = maxMappedBytes
+        self.windowSize = 16777216      #multiple of mmap.ALLOCATIONGRANULARITY on all common platforms
+        
+        self.mappedBytes = 0
+        self.mappings = {}          #(ident, path, windowIndex) => mapping
+        self.idleQueue = StorageLruQueue()  #mappings which are currently unused, least recently used first
+        
+        #stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self.lock = threading.Lock()
+        
+        
+    ##internal functions - mappings
+    
+    def _mapWindow(self, filePath, fileSize, windowIndex):
+        #maps one window of the file, returns None for the map if the file is too short (it is never resized here,
+        #the caller only holds the shared lock of the file while reading), may throw IOError or mmap.error
+        try:
+            fl = open(filePath, 'rb+')
+            writable = True
+        except IOError:
+            fl = open(filePath, 'rb')
+            writable = False
+            
+        with fl:
+            windowOffset = windowIndex * self.windowSize
+            windowSize = min(self.windowSize, fileSize - windowOffset)
+            fl.seek(0, 2)
+            if fl.tell() < windowOffset + windowSize:
+                #mapping behind the end of a file doesn't work
+                windowMap = None
+            else:
+                if writable:
+                    access = mmap.ACCESS_WRITE
+                else:
+                    access = mmap.ACCESS_READ
+                windowMap = mmap.mmap(fl.fileno(), windowSize, access=access, offset=windowOffset)
+        return windowMap, windowSize, writable
+    
+    
+    def _evictIdleMappings(self, limit):
+        #unmap least recently used idle windows until at most limit bytes are mapped
+        closedMaps = []
+        while self.mappedBytes > limit and len(self.idleQueue) > 0:
+            mapping = self.idleQueue.pop()
+            del self.mappings[mapping['key']]
+            closedMaps.append(mapping['map'])
+            self.mappedBytes -= mapping['size']
+            self.evictions += 1
+        return closedMaps
+    
+    
+    def _closeMaps(self, maps):
+        for windowMap in maps:
+            try:
+                windowMap.close()
+            except EnvironmentError:
+                pass
+            
+            
+    ##external functions - mappings
+    
+    def acquire(self, ident, filePath, fileSize, windowIndex):
+        #returns the mapping of the given window of the file, which stays mapped until it is released again,
+        #returns None if the file is too short to map the window
+        key = (ident, filePath, windowIndex)
+        with self.lock:
+            mapping = self.mappings.get(key, None)
+            if mapping is not None:
+                #reuse mapping
+                if mapping['users'] == 0:
+                    self.idleQueue.remove(mapping)
+                mapping['users'] += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+                
+        if mapping is None:
+            #map window outside of the lock
+            windowMap, windowSize, writable = self._mapWindow(filePath, fileSize, windowIndex)
+            if windowMap is not None:
+                with self.lock:
+                    mapping = self.mappings.get(key, None)
+                    if mapping is not None:
+                        #another thread was faster
+                        if mapping['users'] == 0:
+                            self.idleQueue.remove(mapping)
+                        mapping['users'] += 1
+                        closedMaps = [windowMap]
+                    else:
+                        #add new mapping
+                        mapping = {'key':key,
+                                   'map':windowMap,
+                                   'size':windowSize,
+                                   'writable':writable,
+                                   'users':1,
+                                   'discard':False}
+                        self.mappings[key] = mapping
+                        self.mappedBytes += windowSize
+                        closedMaps = self._evictIdleMappings(self.maxMappedBytes)
+                self._closeMaps(closedMaps)
+        return mapping
+    
+    
+    def release(self, mapping):
+        with self.lock:
+            mapping['users'] -= 1
+            closedMaps = []
+            if mapping['users'] == 0:
+                if mapping['discard']:
+                    #unmap it
+                    closedMaps.append(mapping['map'])
+                    self.mappedBytes -= mapping['size']
+                else:
+                    #keep it for later use
+                    self.idleQueue.add(mapping)
+                    closedMaps = self._evictIdleMappings(self.maxMappedBytes)
+        self._closeMaps(closedMaps)
+        
+        
+    def closeAll(self, ident):
+        #unmaps all idle windows which belong to the given ident, windows in use get unmapped on release
+        with self.lock:
+            closedMaps = []
+            for key, mapping in self.mappings.items():
+                if key[0] == ident:
+                    del self.mappings[key]
+                    if mapping['users'] == 0:
+                        self.idleQueue.remove(mapping)
+                        closedMaps.append(mapping['map'])
+                        self.mappedBytes -= mapping['size']
+                    else:
+                        mapping['discard'] = True
+        self._closeMaps(closedMaps)
+        
+        
+    def setMaxMappedBytes(self, maxMappedBytes):
+        with self.lock:
+            self.maxMappedBytes = maxMappedBytes
+            closedMaps = self._evictIdleMappings(self.maxMappedBytes)
+        self._closeMaps(closedMaps)
+        
+        
+    ##external functions - stats
+    
+    def getStats(self):
+        with self.lock:
+            stats = {}
+            stats['mmapMappedBytes'] = self.mappedBytes
+            stats['mmapHits'] = self.hits
+            stats['mmapMisses'] = self.misses
+            stats['mmapEvictions'] = self.evictions
+        return stats
+    
+    
+    
+
+class StorageFileLock:
+    """
+    A readers-writer lock for a single data file: any number of readers or one writer at a time.
+    Waiting writers block new readers, so that a steady stream of uploads can't starve the writes.
+    """
+    
+    def __init__(self):
+        self.readers = 0
+        self.writing = False
+        self.waitingWriters = 0
+        
+        self.lock = threading.Lock()
+        self.lockEvent = threading.Condition(self.lock)
+        
+        
+    ##external functions - locking
+    
+    def acquire(self, exclusive):
+        with self.lock:
+            if exclusive:
+                self.waitingWriters += 1
+                while self.writing or self.readers > 0:
+                    self.lockEvent.wait()
+                self.waitingWriters -= 1
+                self.writing = True
+            else:
+                while self.writing or self.waitingWriters > 0:
+                    self.lockEvent.wait()
+                self.readers += 1
+                
+                
+    def release(self, exclusive):
+        with self.lock:
+            if exclusive:
+                self.writing = False
+            else:
+                self.readers -= 1
+            self.lockEvent.notifyAll()
+            
+            
+            
+
+class StorageCheckScheduler:
+    """
+    Limits the number of torrents which check their pieces at the same time, shared by all storage objects.
+    Waiting torrents are allowed to start in the order of their priority (lower value first), which
+    is pushed from the outside (the position of the torrent in the queue).
+    """
+    
+    def __init__(self, maxChecks):
+        self.maxChecks = max(1, maxChecks)
+        
+        self.waiting = set()        #idents which wait for their turn
+        self.running = set()        #idents which are currently checking
+        self.priorities = {}        #ident => priority
+        
+        self.lock = threading.Lock()
+        self.checkEvent = threading.Condition(self.lock)
+        
+        
+    ##internal functions - checks
+    
+    def _getPriority(self, ident):
+        return (self.priorities.get(ident, 2**31), ident)
+    
+    
+    def _mayStart(self, ident):
+        return len(self.running) < self.maxChecks and ident == min(self.waiting, key=self._getPriority)
+    
+    
+    ##external functions - checks
+    
+    def acquire(self, ident, shouldAbortFunc):
+        #blocks until this ident may start checking, returns False if shouldAbortFunc returned True while waiting
+        with self.lock:
+            self.waiting.add(ident)
+            while (not shouldAbortFunc()) and not self._mayStart(ident):
+                self.checkEvent.wait()
+            self.waiting.remove(ident)
+            
+            allowed = not shouldAbortFunc()
+            if allowed:
+                self.running.add(ident)
+            else:
+                #the next one may be allowed to start now
+                self.checkEvent.notifyAll()
+        return allowed
+    
+    
+    def release(self, ident):
+        with self.lock:
+            self.running.remove(ident)
+            self.checkEvent.notifyAll()
+            
+            
+    def abort(self):
+        #wakes up all waiting idents, so that they notice if they should abort
+        with self.lock:
+            self.checkEvent.notifyAll()
+            
+            
+    def setPriorities(self, priorities):
+        with self.lock:
+            self.priorities = priorities
+            self.checkEvent.notifyAll()
+            
+            
+    def setMaxChecks(self, maxChecks):
+        with self.lock:
+            self.maxChecks = max(1, maxChecks)
+            self.checkEvent.notifyAll()
+            
+            
+    ##external functions - stats
+    
+    def getState(self, ident):
+        with self.lock:
+            if ident in self.waiting:
+                state = 'queued for check'
+            elif ident in self.running:
+                state = 'checking'
+            else:
+                state = None
+        return state
+        
+        
+        
+
 class Storage:
-    def __init__(self, config, btPersister, ident, torrent, pathprefix):
+    def __init__(self, config, btPersister, ident, torrent, pathprefix, filePool, mmapPool, readCache, checkScheduler):
         self.config = config
         self.btPersister = btPersister
+        self.ident = ident
         self.torrent = torrent
         self.pathprefix = pathprefix
+        self.filePool = filePool
+        self.mmapPool = mmapPool
+        self.backend = self.btPersister.get('Storage-backend', None)       #None: use the default of the config
+        self.readCache = readCache
+        self.readCacheSpanSize = min(self.torrent.getPieceLength(), 1048576)
+        self.checkScheduler = checkScheduler
         
         #loading
         self.loaded = False
         self.shouldAbortLoad = False
         self.loadLock = threading.Lock()
         
+        #piece check progress
+        self.checkRunning = False
+        self.checkStartTime = 0
+        self.checkEndTime = 0
+        self.checkTotalBytes = 0
+        self.checkedBytes = 0
+        self.checkSkippedBytes = 0          #bytes which were already checked before a resumed check started
+        self.checkHashedPieces = set()      #pieces above self.checkVerifiedPieces which were already hashed
+        self.checkVerifiedPieces = 0        #all pieces below this index were hashed
+        self.checkLock = threading.Lock()
+        
+        #allocation
+        self.allocationMode = self.btPersister.get('Storage-allocationMode', None)     #None: use the default of the config
+        self.allocationThread = None
+        self.allocationRunning = False
+        self.shouldAbortAllocation = False
+        
         #other
         shouldPersist = self.config.get('storage', 'persistPieceStatus')
+        if not shouldPersist:
+            #remove any leftovers
+            self.btPersister.remove('Storage-fileStamps')
+            self.btPersister.remove('Storage-checkCheckpoint')
         self.ownStatus = PersistentOwnStatus(btPersister, shouldPersist, self.torrent.getTotalAmountOfPieces())
         self.log = Logger('Storage', '%-6s - ', ident)
-        self.lock = threading.Lock()
+        self.realFilePaths = {}     #fileIndex => real path of the file
+        self.fileLocks = []         #fileIndex => (lock order, lock), files with the same path share one lock
+        pathLocks = {}
+        for fileIndex in xrange(0, self.torrent.getAmountOfFiles()):
+            filePath = self.torrent.getFilePath(fileIndex)
+            if not filePath in pathLocks:
+                pathLocks[filePath] = (fileIndex, StorageFileLock())
+            self.fileLocks.append(pathLocks[filePath])
         
         
     ##internal functions - files
     
+    def _acquireFileLocks(self, spans, exclusive):
+        #locks the files of the given spans (as returned by torrent.getFileSpansForOffset), always in the same order to prevent deadlocks
+        locks = []
+        try:
+            for lockOrder, fileLock in sorted(set(self.fileLocks[span[0]] for span in spans)):
+                fileLock.acquire(exclusive)
+                locks.append(fileLock)
+        except:
+            self._releaseFileLocks(locks, exclusive)
+            raise
+        return locks
+    
+    
+    def _releaseFileLocks(self, locks, exclusive):
+        for fileLock in locks:
+            fileLock.release(exclusive)
+            
+            
+    def _getFilePathOfIndex(self, fileIndex):
+        realFilePath = self.realFilePaths.get(fileIndex, None)
+        if realFilePath is None:
+            realFilePath = self._getFilePath(self.torrent.getFilePath(fileIndex))
+            self.realFilePaths[fileIndex] = realFilePath
+        return realFilePath
+    
+    
     def _getFilePath(self, filePath):
         realFilePath = os.path.normpath(os.path.join(self.pathprefix, filePath))
         if not realFilePath.startswith(self.pathprefix):
             raise StorageException('Security violation: file "%s" is not inside base directory "%s" (original path: "%s")', realFilePath, self.pathprefix, os.path.join(self.pathprefix, filePath))
         return realFilePath
     
+    
+    def _readFromFile(self, filePath, offset, length):
+        #reads data using a pooled file handle, may throw IOError
+        handle = self.filePool.acquire(self.ident, filePath, False)
+        failed = True
+        try:
+            fl = handle['file']
+            fl.seek(offset)
+            data = fl.read(length)
+            failed = False
+        finally:
+            self.filePool.release(handle, failed)
+        return data
+    
+    
+    def _writeToFile(self, filePath, offset, data):
+        #writes data using a pooled file handle, may throw IOError
+        handle = self.filePool.acquire(self.ident, filePath, True)
+        failed = True
+        try:
+            if not handle['writable']:
+                raise IOError('File "%s" is not writable' % (filePath,))
+            fl = handle['file']
+            fl.seek(offset)
+            fl.write(data)
+            failed = False
+        finally:
+            self.filePool.release(handle, failed)
+    
+    
+    def _growFile(self, filePath, fileSize):
+        #sets the size of a too short file, only allowed while holding the write lock of the file, may throw IOError
+        handle = self.filePool.acquire(self.ident, filePath, True)
+        failed = True
+        try:
+            if not handle['writable']:
+                raise IOError('File "%s" is too short and not writable' % (filePath,))
+            fl = handle['file']
+            fl.seek(0, 2)
+            if fl.tell() < fileSize:
+                fl.truncate(fileSize)
+            failed = False
+        finally:
+            self.filePool.release(handle, failed)
+    
+    
+    def _readFromMapping(self, filePath, fileSize, offset, length):
+        #reads data from the mapped windows of the file, may throw IOError or mmap.error
+        data = []
+        windowSize = self.mmapPool.windowSize
+        while length > 0:
+            windowIndex = offset / windowSize
+            mapping = self.mmapPool.acquire(self.ident, filePath, fileSize, windowIndex)
+            if mapping is None:
+                #file is too short to be mapped, only the writer may grow it
+                data.append(self._readFromFile(filePath, offset, length))
+                break
+            try:
+                start = offset - windowIndex * windowSize
+                chunk = mapping['map'][start:start + min(length, mapping['size'] - start)]
+            finally:
+                self.mmapPool.release(mapping)
+            if len(chunk) == 0:
+                break
+            data.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return ''.join(data)
+    
+    
+    def _writeToMapping(self, filePath, fileSize, offset, data):
+        #writes data into the mapped windows of the file, may throw IOError or mmap.error
+        windowSize = self.mmapPool.windowSize
+        dataOffset = 0
+        while dataOffset < len(data):
+            windowIndex = offset / windowSize
+            mapping = self.mmapPool.acquire(self.ident, filePath, fileSize, windowIndex)
+            if mapping is None:
+                #mapping behind the end of a file doesn't work, grow it (the write lock of the file is held)
+                self._growFile(filePath, fileSize)
+                mapping = self.mmapPool.acquire(self.ident, filePath, fileSize, windowIndex)
+                if mapping is None:
+                    raise IOError('File "%s" is still too short after growing it' % (filePath,))
+            try:
+                if not mapping['writable']:
+                    raise IOError('File "%s" is not writable' % (filePath,))
+                start = offset - windowIndex * windowSize
+                length = min(len(data) - dataOffset, mapping['size'] - start)
+                mapping['map'][start:start + length] = data[dataOffset:dataOffset + length]
+            finally:
+                self.mmapPool.release(mapping)
+            offset += length
+            dataOffset += length
+            
+            
+    def _getSpansOfData(self, pieceIndex, addOffset, length):
+        fromOffset = self.torrent.convertPieceIndexToOffset(pieceIndex, addOffset)
+        return self.torrent.getFileSpansForOffset(fromOffset, fromOffset + length)
+    
+    
+    def _readData(self, spans, backend):
+        #reads data from the given file spans of the torrent, may throw StorageException
+        data = []
+        for fileIndex, fileOffset, fileBytes in spans:
+            filePath = self._getFilePathOfIndex(fileIndex)
+            
+            try:
+                #read data from file
+                if backend == 'mmap':
+                    fileData = self._readFromMapping(filePath, self.torrent.getFileSize(fileIndex), fileOffset, fileBytes)
+                else:
+                    fileData = self._readFromFile(filePath, fileOffset, fileBytes)
+                
+            except (IOError, mmap.error):
+                #file operation failed
+                raise StorageException('Failure while trying to read from file "%s":\n%s' % (filePath, logTraceback()))
+                
+            if len(fileData) == fileBytes:
+                #got enough data
+                data.append(fileData)
+            else:
+                #too few bytes, something went wrong here - too short file?!
+                raise StorageException('Couldn\'t read enough bytes from file "%s": wanted %i, got %i' % (filePath, fileBytes, len(fileData)))
+            
+        data = ''.join(data)
+        return data
+        
+        
+    ##internal functions - file stamps
+    
+    def _getFileStamps(self):
+        #returns a (size, mtime in ms, inode) tuple for every file of the torrent, None for files which don't exist
+        stamps = []
+        for fileSet in self.torrent.getFiles():
+            try:
+                fileStat = os.stat(self._getFilePath(fileSet['path']))
+                stamps.append((fileStat.st_size, int(fileStat.st_mtime * 1000), fileStat.st_ino))
+            except OSError:
+                stamps.append(None)
+        return stamps
+    
+    
+    def _storeFileStamps(self):
+        #persists the current stamps of all files, used on the next load to find out which files changed in the meantime
+        if self.config.get('storage', 'persistPieceStatus'):
+            #pieces which are only in the unstored part of the journal would be lost on a crash without a recheck of their files
+            self.ownStatus.flush()
+            self.btPersister.store('Storage-fileStamps', self._getFileStamps())
+            
+            
+    def _getPieceRangesOfChangedFiles(self, fileStamps):
+        #returns a sorted list of (startPiece, endPiece) ranges which cover all pieces of files whose stamp differs from the persisted one
+        oldFileStamps = self.btPersister.get('Storage-fileStamps', None)
+        pieceRanges = []
+        if oldFileStamps is None:
+            #no stamps persisted up to now, trust the persisted status
+            self.log.debug('No file stamps persisted, assuming that no files changed')
+            
+        elif not len(oldFileStamps) == len(fileStamps):
+            #shouldn't happen, check everything
+            self.log.warn('Persisted file stamps don\'t match the files of the torrent, checking all pieces')
+            pieceRanges.append((0, self.torrent.getTotalAmountOfPieces()))
+            
+        else:
+            #compare stamps
+            pieceLength = self.torrent.getPieceLength()
+            files = self.torrent.getFiles()
+            for fileIndex in xrange(0, len(files)):
+                fileSet = files[fileIndex]
+                if fileSet['size'] > 0 and not oldFileStamps[fileIndex] == fileStamps[fileIndex]:
+                    #file changed
+                    self.log.info('File "%s" changed since the last run, need to check its pieces', fileSet['path'])
+                    startPiece = fileSet['offset'] / pieceLength
+                    endPiece = (fileSet['offset'] + fileSet['size'] - 1) / pieceLength + 1
+                    if len(pieceRanges) > 0 and pieceRanges[-1][1] >= startPiece:
+                        #overlaps with the range of the previous file
+                        pieceRanges[-1] = (pieceRanges[-1][0], endPiece)
+                    else:
+                        pieceRanges.append((startPiece, endPiece))
+        return pieceRanges
+        
+        
+    ##internal functions - check checkpoints
+    
+    def _storeCheckCheckpoint(self, fileStamps):
+        #persists the index of the first piece which wasn't hashed yet and the status of all pieces before it
+        with self.checkLock:
+            verifiedPieces = self.checkVerifiedPieces
+        verifiedMask = self.ownStatus.getGotPiecesMask() & ((1L << verifiedPieces) - 1)
+        self.btPersister.store('Storage-checkCheckpoint', {'fileStamps':fileStamps,
+                                                           'verifiedPieces':verifiedPieces,
+                                                           'bitfield':maskToBitfield(verifiedMask, self.torrent.getTotalAmountOfPieces())})
+        self.log.debug('Stored check checkpoint at piece %i', verifiedPieces)
+        
+        
+    def _loadCheckCheckpoint(self, fileStamps):
+        #restores the result of an interrupted check, returns the index of the piece with which the check should continue
+        startPiece = 0
+        checkpoint = self.btPersister.get('Storage-checkCheckpoint', None)
+        if checkpoint is not None:
+            if not list(checkpoint['fileStamps']) == fileStamps:
+                #files changed since the checkpoint was stored, need a full check
+                self.log.info('Files changed since the last check was interrupted, ignoring check checkpoint')
+                self.btPersister.remove('Storage-checkCheckpoint')
+            else:
+                #still valid
+                startPiece = checkpoint['verifiedPieces']
+                pieceAmount = self.torrent.getTotalAmountOfPieces()
+                self.ownStatus.clear()
+                self.ownStatus.addBitfield(checkpoint['bitfield'])
+                self.log.info('Resuming interrupted check at piece %i of %i', startPiece, pieceAmount)
+        return startPiece
+        
+        
+    ##internal functions - backend
+    
+    def _getBackend(self):
+        backend = self.backend
+        if backend is None:
+            backend = self.config.get('storage', 'backend')
+        if not backend in ('file', 'mmap'):
+            self.log.warn('Unknown storage backend "%s", using file backend', backend)
+            backend = 'file'
+        elif backend == 'mmap' and sys.version_info < (2, 6):
+            #mapping windows at an offset needs python 2.6
+            self.log.info('The mmap backend needs python 2.6 or newer, using file backend')
+            backend = 'file'
+        return backend
+    
+    
+    ##internal functions - allocation
+    
+    def _getAllocationMode(self):
+        mode = self.allocationMode
+        if mode is None:
+            mode = self.config.get('storage', 'allocationMode')
+        if not mode in ('sparse', 'full', 'compat'):
+            self.log.warn('Unknown allocation mode "%s", using sparse allocation', mode)
+            mode = 'sparse'
+        if mode == 'full' and posixFallocate is None:
+            self.log.info('Full allocation is not supported on this platform, using compat allocation')
+            mode = 'compat'
+        return mode
+    
+    
+    def _needsAllocation(self, realFilePath, wantedFileSize, mode):
+        fileStat = os.stat(realFilePath)
+        needed = fileStat.st_size < wantedFileSize
+        if mode == 'full' and hasattr(fileStat, 'st_blocks'):
+            #file may have the right size but still be sparse
+            needed |= fileStat.st_blocks * 512 < wantedFileSize
+        return needed
+    
+    
+    def _allocateSparse(self, realFilePath, wantedFileSize, fileLock):
+        #only sets the size of the file, most filesystems won't reserve any space for it
+        fileLock.acquire(True)
+        try:
+            handle = self.filePool.acquire(self.ident, realFilePath, True)
+            failed = True
+            try:
+                fl = handle['file']
+                fl.seek(0, 2)
+                if fl.tell() < wantedFileSize:
+                    fl.truncate(wantedFileSize)
+                failed = False
+            finally:
+                self.filePool.release(handle, failed)
+        finally:
+            fileLock.release(True)
+                
+                
+    def _allocateFull(self, realFilePath, wantedFileSize, fileLock):
+        #reserves the space for the whole file without writing any data, done in chunks to allow aborting
+        offset = 0
+        while (not self.shouldAbortAllocation) and offset < wantedFileSize:
+            length = min(67108864, wantedFileSize - offset)
+            handle = self.filePool.acquire(self.ident, realFilePath, True)
+            failed = True
+            try:
+                posixFallocate(handle['file'].fileno(), offset, length)
+                failed = False
+            finally:
+                self.filePool.release(handle, failed)
+            offset += length
+            self.log.debug("Progress: %i / %i", offset, wantedFileSize)
+            
+            
+    def _allocateCompat(self, realFilePath, wantedFileSize, fileLock):
+        #grows the file by writing single zero bytes behind its end, the step size is adjusted so that a write needs about 0.1 seconds
+        #only writes behind the current end of the file, so it never overwrites data which was downloaded in the meantime
+        step = 1048576
+        currentFileSize = 0
+        while (not self.shouldAbortAllocation) and currentFileSize < wantedFileSize:
+            fileLock.acquire(True)
+            try:
+                handle = self.filePool.acquire(self.ident, realFilePath, True)
+                failed = True
+                try:
+                    fl = handle['file']
+                    fl.seek(0, 2)
+                    currentFileSize = fl.tell()
+                    if currentFileSize < wantedFileSize:
+                        start = time()
+                        fl.seek(min(currentFileSize + step, wantedFileSize) - 1)
+                        fl.write('\x00')
+                        needed = time() - start
+                        currentFileSize = fl.tell()
+                        if needed > 0:
+                            step = max(1048576, int(step * 0.1 / needed))
+                    failed = False
+                finally:
+                    self.filePool.release(handle, failed)
+            finally:
+                fileLock.release(True)
+            self.log.debug("Progress: %i / %i", currentFileSize, wantedFileSize)
+            
+            
+    def _allocateFiles(self):
+        #executed by the allocation thread
+        mode = self._getAllocationMode()
+        allocFuncs = {'sparse':self._allocateSparse,
+                      'full':self._allocateFull,
+                      'compat':self._allocateCompat}
+        start = time()
+        self.log.info('Allocating files, mode "%s"', mode)
+        
+        try:
+            for fileIndex, fileSet in enumerate(self.torrent.getFiles()):
+                if self.shouldAbortAllocation:
+                    break
+                
+                try:
+                    realFilePath = self._getFilePath(fileSet['path'])
+                    if self._needsAllocation(realFilePath, fileSet['size'], mode):
+                        self.log.debug('Allocating file "%s"', realFilePath)
+                        allocFuncs[mode](realFilePath, fileSet['size'], self.fileLocks[fileIndex][1])
+                except (IOError, OSError, StorageException):
+                    self.log.error('Failed to allocate file "%s":\n%s', fileSet['path'], logTraceback())
+                    
+            if not self.shouldAbortAllocation:
+                #the stamps of the files changed
+                self._storeFileStamps()
+                self.log.info('Allocated files in %.1f seconds', time() - start)
+        finally:
+            self.allocationRunning = False
+    
+    
+    def _startAllocation(self):
+        self.shouldAbortAllocation = False
+        self.allocationRunning = True
+        self.allocationThread = threading.Thread(target=self._allocateFiles)
+        self.allocationThread.start()
+        
         
+    def _stopAllocation(self):
+        if self.allocationThread is not None:
+            self.shouldAbortAllocation = True
+            self.allocationThread.join()
+            self.allocationThread = None
+            
+            
     ##internal functions - loading
         
     def _checkFile(self, filePath, wantedFileSize):
@@ -106,42 +1189,11 @@ class Storage:
                 fl.seek(0, 2)
                 currentFileSize = fl.tell()
                 if currentFileSize < wantedFileSize:
+                    #allocation is done in the background once loading finished
                     self.log.debug('File "%s" is %d bytes to short', realFilePath, wantedFileSize - currentFileSize)
                     modified = True
                 else:
                     self.log.debug('File "%s" has the correct size', realFilePath)
-                
-                #fill if needed
-                if (not self.shouldAbortLoad) and currentFileSize + 1045876 < wantedFileSize:
-                    #large fill
-                    start = time()
-                    fl.seek(1048575, 1)
-                    fl.write('\x00')
-                    fl.flush()
-                    currentFileSize = fl.tell()
-                    needed = time() - start
-                    
-                    try:
-                        step = int(1048575 * 0.1 / needed)
-                    except ZeroDivisionError:
-                        step = wantedFileSize - currentFileSize - 1
-                    step = max(1, step)
-                    self.log.debug('Needed %f seconds for 1 Mb, step size %i', needed, step)
-                    
-                    while (not self.shouldAbortLoad) and currentFileSize + step <= wantedFileSize - 1:
-                        fl.seek(step, 1)
-                        fl.write('\x00')
-                        fl.flush()
-                        currentFileSize = fl.tell()
-                        self.log.debug("Progress: %i / %i", currentFileSize, wantedFileSize)
-                
-                if (not self.shouldAbortLoad) and currentFileSize < wantedFileSize: 
-                    #seek remaining bytes and write last byte
-                    fl.seek((wantedFileSize - currentFileSize - 1), 1)
-                    fl.write('\x00')
-                    fl.flush()
-                    currentFileSize = fl.tell()
-                    self.log.debug("Progress: %i / %i", currentFileSize, wantedFileSize)
             
         except IOError:
             #something failed
@@ -165,25 +1217,161 @@ class Storage:
         return allCreated, anyModified
             
             
-    def _checkPieceAvailability(self):
-        #check which pieces are already finished
+    def _getPieceRangeSize(self, startPiece, endPiece):
+        return min(self.torrent.convertPieceIndexToOffset(endPiece), self.torrent.getTotalSize()) - self.torrent.convertPieceIndexToOffset(startPiece)
+    
+    
+    def _iterPieceData(self, readSize, startPiece, endPiece):
+        #reads the files sequentially with large reads and yields (pieceIndex, data) for every piece from startPiece up to (excluding) endPiece
         #may throw StorageException if things go wrong
-        piece = 0
-        pieceAmount = self.torrent.getTotalAmountOfPieces()
-        while (not self.shouldAbortLoad) and piece < pieceAmount:
-            #check piece
-            data = self.getData(piece, 0, self.torrent.getLengthOfPiece(piece))
-            if sha1(data).digest() == self.torrent.getPieceHashByPieceIndex(piece):
-                #hash matches, piece is finished
-                self.ownStatus.setPieceStatus(piece, True)
-                self.log.debug('Piece Nr. %d is finished', piece)
-            else:
-                #hash doesn't match, not finished
-                self.ownStatus.setPieceStatus(piece, False)
-                self.log.debug('Piece Nr. %d is  not finished', piece)
-            piece += 1
+        pieceLength = self.torrent.getPieceLength()
+        pieceIndex = startPiece
+        startOffset = self.torrent.convertPieceIndexToOffset(startPiece)
+        endOffset = min(self.torrent.convertPieceIndexToOffset(endPiece), self.torrent.getTotalSize())
+        buf = []
+        bufSize = 0
+        
+        for fileSet in self.torrent.getFiles():
+            if self.shouldAbortLoad or fileSet['offset'] >= endOffset:
+                break
+            
+            if fileSet['offset'] + fileSet['size'] <= startOffset:
+                #file only contains pieces before the range
+                continue
+            
+            filePath = self._getFilePath(fileSet['path'])
+            fileOffset = max(0, startOffset - fileSet['offset'])
+            remainingBytes = min(fileSet['size'], endOffset - fileSet['offset']) - fileOffset
+            try:
+                fl = open(filePath, 'rb')
+                with fl:
+                    if fileOffset > 0:
+                        fl.seek(fileOffset)
+                    while (not self.shouldAbortLoad) and remainingBytes > 0:
+                        data = fl.read(min(readSize, remainingBytes))
+                        if len(data) == 0:
+                            #file is too short, it wasn't allocated completely up to now - the missing bytes would be zeros afterwards
+                            data = '\x00' * min(readSize, remainingBytes)
+                        remainingBytes -= len(data)
+                        buf.append(data)
+                        bufSize += len(data)
+                        
+                        if bufSize >= pieceLength:
+                            #at least one complete piece
+                            data = ''.join(buf)
+                            offset = 0
+                            while bufSize - offset >= pieceLength:
+                                yield pieceIndex, data[offset:offset+pieceLength]
+                                pieceIndex += 1
+                                offset += pieceLength
+                            buf = [data[offset:]]
+                            bufSize -= offset
+                            
+            except IOError:
+                #file operation failed
+                raise StorageException('Failure while trying to read from file "%s":\n%s' % (filePath, logTraceback()))
+            
+        if (not self.shouldAbortLoad) and bufSize > 0:
+            #last piece
+            yield pieceIndex, ''.join(buf)
+            
+            
+    def _hashPieces(self, pieceQueue):
+        #executed by the check threads, compares the hashes of the queued pieces until it gets None
+        piece = pieceQueue.get()
+        while piece is not None:
+            pieceIndex, data = piece
+            if not self.shouldAbortLoad:
+                try:
+                    if sha1(data).digest() == self.torrent.getPieceHashByPieceIndex(pieceIndex):
+                        #hash matches, piece is finished
+                        self.ownStatus.setPieceStatus(pieceIndex, True)
+                        self.log.debug('Piece Nr. %d is finished', pieceIndex)
+                    else:
+                        #hash doesn't match, not finished
+                        self.ownStatus.setPieceStatus(pieceIndex, False)
+                        self.log.debug('Piece Nr. %d is  not finished', pieceIndex)
+                    
+                    with self.checkLock:
+                        #remember that this piece was hashed, advance the checkpoint if possible
+                        self.checkHashedPieces.add(pieceIndex)
+                        while self.checkVerifiedPieces in self.checkHashedPieces:
+                            self.checkHashedPieces.remove(self.checkVerifiedPieces)
+                            self.checkVerifiedPieces += 1
+                except:
+                    #keep going, the reader would block otherwise
+                    self.log.error('Failure while checking piece %i:\n%s', pieceIndex, logTraceback())
+                
+                with self.checkLock:
+                    self.checkedBytes += len(data)
+            piece = pieceQueue.get()
+            
+            
+    def _checkPieceAvailability(self, pieceRanges=None):
+        #check which pieces are already finished, either all or only those within the given (startPiece, endPiece) ranges
+        #files are read sequentially by this thread while the hashing is done by a pool of threads
+        #a full check resumes a previously interrupted one if possible, may throw StorageException if things go wrong
+        threadAmount = max(1, self.config.get('storage', 'checkThreads'))
+        pieceQueue = Queue(threadAmount * 2)
+        fileStamps = self._getFileStamps()
+        startPiece = 0
+        if pieceRanges is None:
+            #full check
+            shouldCheckpoint = self.config.get('storage', 'persistPieceStatus')
+            if shouldCheckpoint:
+                startPiece = self._loadCheckCheckpoint(fileStamps)
+            pieceRanges = [(startPiece, self.torrent.getTotalAmountOfPieces())]
+        else:
+            #partial check, not worth a checkpoint
+            shouldCheckpoint = False
+        
+        with self.checkLock:
+            self.checkRunning = True
+            self.checkStartTime = time()
+            self.checkSkippedBytes = self._getPieceRangeSize(0, startPiece)
+            self.checkTotalBytes = self.checkSkippedBytes + sum(self._getPieceRangeSize(rangeStart, rangeEnd) for rangeStart, rangeEnd in pieceRanges)
+            self.checkedBytes = self.checkSkippedBytes
+            self.checkHashedPieces = set()
+            self.checkVerifiedPieces = startPiece
+        
+        threads = []
+        for i in xrange(0, threadAmount):
+            thread = threading.Thread(target=self._hashPieces, args=(pieceQueue,))
+            thread.start()
+            threads.append(thread)
+        
+        try:
+            lastCheckpoint = time()
+            readSize = max(4194304, self.torrent.getPieceLength())
+            for rangeStart, rangeEnd in pieceRanges:
+                for piece in self._iterPieceData(readSize, rangeStart, rangeEnd):
+                    pieceQueue.put(piece)
+                    if shouldCheckpoint and time() - lastCheckpoint >= 30:
+                        #persist progress from time to time, so that an interrupted check doesn't need to start from scratch
+                        self._storeCheckCheckpoint(fileStamps)
+                        lastCheckpoint = time()
+        finally:
+            #stop check threads
+            for thread in threads:
+                pieceQueue.put(None)
+            for thread in threads:
+                thread.join()
+                
+            with self.checkLock:
+                self.checkRunning = False
+                self.checkEndTime = time()
+                
+            if shouldCheckpoint:
+                #removed by _load once the complete status got persisted
+                self._storeCheckCheckpoint(fileStamps)
+                
+            self.log.info('Checked %i bytes in %.1f seconds', self.checkedBytes - self.checkSkippedBytes, self.checkEndTime - self.checkStartTime)
             
             
+    def _isLoadAborted(self):
+        return self.shouldAbortLoad
+    
+    
     def _load(self, completionCallback):
         with self.loadLock:
             #inside lock
@@ -219,20 +1407,36 @@ class Storage:
                 else:
                     #possibly need to check, some files already existed
                     if self.ownStatus.loadPersistedData():
-                        #persisted status info existed
-                        self.log.debug('Skipping hashing, managed to load persisted status data')
+                        #persisted status info existed, only pieces of files which changed since then need to be checked
+                        pieceRanges = self._getPieceRangesOfChangedFiles(self._getFileStamps())
+                        if len(pieceRanges) == 0:
+                            self.log.debug('Skipping hashing, managed to load persisted status data and no file changed')
                     else:
-                        #there is no persisted data
-                        self.log.debug('Checking which pieces are already finished')
-                        self._checkPieceAvailability()
+                        #there is no persisted data, need to check everything
+                        pieceRanges = None
+                        
+                    if pieceRanges is None or len(pieceRanges) > 0:
+                        #wait until we are allowed to check
+                        self.log.debug('Waiting for permission to check which pieces are already finished')
+                        if self.checkScheduler.acquire(self.ident, self._isLoadAborted):
+                            try:
+                                self.log.debug('Checking which pieces are already finished')
+                                self._checkPieceAvailability(pieceRanges)
+                            finally:
+                                self.checkScheduler.release(self.ident)
                     
                     
                 #check if loading wasn't aborted
                 if not self.shouldAbortLoad:
                     self.ownStatus.persist()
+                    self.btPersister.remove('Storage-checkCheckpoint')
+                    self._storeFileStamps()
                     loadSuccess = True
                     self.loaded = True
                     
+                    #allocate the files in the background, already usable without it
+                    self._startAllocation()
+                    
             except StorageException, se:
                 self.log.error('Failure during load:\n%s', logTraceback())
             
@@ -250,6 +1454,7 @@ class Storage:
     def abortLoad(self):
         #abort loading
         self.shouldAbortLoad = True
+        self.checkScheduler.abort()
         with self.loadLock:
             self.shouldAbortLoad = False
         
@@ -258,68 +1463,139 @@ class Storage:
         return self.loaded
     
     
-    ##external functions - pieces - need self.lock (to prevent parallel access to the same file)
+    def getLoadState(self):
+        #returns the state of the check scheduler for this torrent, 'loading' if it isn't known there
+        state = self.checkScheduler.getState(self.ident)
+        if state is None:
+            state = 'loading'
+        return state
+    
+    
+    ##external functions - files
+    
+    def close(self):
+        #stop allocating and close all pooled file handles and mappings of this torrent, they get reopened on demand
+        self._stopAllocation()
+        self.filePool.closeAll(self.ident)
+        self.mmapPool.closeAll(self.ident)
+        self.readCache.clear(self.ident)
+        self.ownStatus.flush()
+        if self.loaded:
+            #remember how the files look like now, so that the next load only needs to check files which changed in the meantime
+            self._storeFileStamps()
+    
+    
+    ##external functions - allocation
+    
+    def getAllocationMode(self):
+        return self.allocationMode
+    
+    
+    def setAllocationMode(self, mode):
+        #sets the allocation mode of this torrent, None means that the default of the config is used, applies to the next allocation
+        self.allocationMode = mode
+        if mode is None:
+            self.btPersister.remove('Storage-allocationMode')
+        else:
+            self.btPersister.store('Storage-allocationMode', mode)
+            
+            
+    ##external functions - backend
+    
+    def getBackend(self):
+        return self.backend
+    
+    
+    def setBackend(self, backend):
+        #sets the backend of this torrent, None means that the default of the config is used, applies to the following reads and writes
+        self.backend = backend
+        if backend is None:
+            self.btPersister.remove('Storage-backend')
+        else:
+            self.btPersister.store('Storage-backend', backend)
+        if not self._getBackend() == 'mmap':
+            #not needed anymore
+            self.mmapPool.closeAll(self.ident)
+        self.readCache.clear(self.ident)
+        
+        
+    ##external functions - persisting
+    
+    def enablePersisting(self, active):
+        self.ownStatus.enablePersisting(active)
+        if active:
+            if self.loaded:
+                self._storeFileStamps()
+        else:
+            self.btPersister.remove('Storage-fileStamps')
+            self.btPersister.remove('Storage-checkCheckpoint')
+    
+    
+    ##external functions - pieces - need the locks of the involved files (to prevent parallel writes to the same file)
     
     def getData(self, pieceIndex, addOffset, length):
-        with self.lock:
-            #inside lock, get responsible files
-            fromOffset = self.torrent.convertPieceIndexToOffset(pieceIndex, addOffset)
-            files = self.torrent.getFilesForOffset(fromOffset, fromOffset + length)
+        backend = self._getBackend()
+        spanSize = self.readCacheSpanSize
+        if backend == 'mmap' or not self.readCache.mayCache(spanSize):
+            #caching is disabled or the page cache already does the caching for mapped files, read directly
+            spans = self._getSpansOfData(pieceIndex, addOffset, length)
+            locks = self._acquireFileLocks(spans, False)
+            try:
+                data = self._readData(spans, backend)
+            finally:
+                self._releaseFileLocks(locks, False)
             
-            #read data from files
+        else:
+            #collect the data from the cached spans of the piece, read missing spans from disk
+            pieceLength = self.torrent.getLengthOfPiece(pieceIndex)
+            endOffset = addOffset + length
             data = []
-            for sfile in files:
-                filePath = self._getFilePath(sfile['path'])
-                
-                try:
-                    #read data from file
-                    datafile = open(filePath, 'rb')
-                    with datafile:
-                        #file opened
-                        datafile.seek(sfile['offset'])
-                        fileData = datafile.read(sfile['bytes'])
-                    
-                except IOError:
-                    #file operation failed
-                    raise StorageException('Failure while trying to read from file "%s":\n%s' % (filePath, logTraceback()))
-                    
-                if len(fileData) == sfile['bytes']:
-                    #got enough data
-                    data.append(fileData)
-                else:
-                    #too few bytes, something went wrong here - too short file?!
-                    raise StorageException('Couldn\'t read enough bytes from file "%s": wanted %i, got %i' % (sfile['path'], sfile['bytes'], len(fileData)))
-                
+            spanOffset = addOffset - (addOffset % spanSize)
+            while spanOffset < endOffset:
+                spanData = self.readCache.get(self.ident, pieceIndex, spanOffset)
+                if spanData is None:
+                    #the span is added to the cache while its files are still locked, so that a parallel write can't invalidate it in between
+                    spans = self._getSpansOfData(pieceIndex, spanOffset, min(spanSize, pieceLength - spanOffset))
+                    locks = self._acquireFileLocks(spans, False)
+                    try:
+                        spanData = self._readData(spans, backend)
+                        self.readCache.add(self.ident, pieceIndex, spanOffset, spanData)
+                    finally:
+                        self._releaseFileLocks(locks, False)
+                data.append(spanData[max(addOffset - spanOffset, 0):endOffset - spanOffset])
+                spanOffset += spanSize
             data = ''.join(data)
         return data
 
 
-    def getDataHandle(self, pieceIndex, addOffset, length):
-        def handle(self=self, pieceIndex=pieceIndex, addOffset=addOffset, length=length):
-            return self.getData(pieceIndex, addOffset, length)
-        return handle
-
-
     def storeData(self, pieceIndex, data, offset=0):
-        with self.lock:
-            #inside lock, get responsible files
-            fromOffset = self.torrent.convertPieceIndexToOffset(pieceIndex) + offset
-            files = self.torrent.getFilesForOffset(fromOffset, fromOffset+len(data))
+        #get responsible files and lock them
+        fromOffset = self.torrent.convertPieceIndexToOffset(pieceIndex) + offset
+        spans = self.torrent.getFileSpansForOffset(fromOffset, fromOffset+len(data))
+        backend = self._getBackend()
+        locks = self._acquireFileLocks(spans, True)
+        try:
+            #cached data of these pieces gets stale
+            pieceLength = self.torrent.getPieceLength()
+            self.readCache.invalidate(self.ident, xrange(fromOffset / pieceLength, (fromOffset + max(len(data), 1) - 1) / pieceLength + 1))
             
             #store data
-            for sfile in files:
-                filePath = self._getFilePath(sfile['path'])
+            dataOffset = 0
+            for fileIndex, fileOffset, fileBytes in spans:
+                filePath = self._getFilePathOfIndex(fileIndex)
                 
                 try:
-                    datafile = open(filePath, 'rb+')
-                    with datafile:
-                        datafile.seek(sfile['offset'])
-                        datafile.write(data[:sfile['bytes']])
-                        data = data[sfile['bytes']:]
+                    if backend == 'mmap':
+                        self._writeToMapping(filePath, self.torrent.getFileSize(fileIndex), fileOffset, data[dataOffset:dataOffset + fileBytes])
+                    else:
+                        self._writeToFile(filePath, fileOffset, data[dataOffset:dataOffset + fileBytes])
+                    dataOffset += fileBytes
                         
-                except IOError:
+                except (IOError, mmap.error):
                     #file operation failed
                     raise StorageException('Failure while trying to write to file "%s":\n%s' % (filePath, logTraceback()))
+        finally:
+            self._releaseFileLocks(locks, True)
                 
                 
     ##external functions - stats - no locking
@@ -355,4 +1631,18 @@ class Storage:
         
         stats['progressBytes'] = gotBytes
         stats['progressPercent'] = 100 * gotBytes / (totalBytes * 1.0)
+        
+        with self.checkLock:
+            if self.checkRunning:
+                checkTime = time() - self.checkStartTime
+            else:
+                checkTime = self.checkEndTime - self.checkStartTime
+            stats['checkRunning'] = self.checkRunning
+            stats['checkedBytes'] = self.checkedBytes
+            stats['checkProgressPercent'] = 100 * self.checkedBytes / (max(self.checkTotalBytes, 1) * 1.0)
+            stats['checkSpeed'] = (self.checkedBytes - self.checkSkippedBytes) / max(checkTime, 0.001)
+        stats['allocationRunning'] = self.allocationRunning
+        stats.update(self.filePool.getStats())
+        stats.update(self.mmapPool.getStats())
+        stats.update(self.readCache.getStats())
         return stats
\ No newline at end of file
@@ -81,7 +81,7 @@ class SuperSeedingHandler:
             
         #offer new pieces if needed
         if len(connSet['upPieces']) < 2:
-            wantedPieces = connStatus.getMatchingMissingPieces(self.ownStatus.getGotPieces())
+            wantedPieces = connStatus.getMatchingMissingPieces(self.ownStatus.getGotPiecesMask())
             wantedPieces.difference_update(connSet['upPieces'])
             pieces = self.pieceStatus.getUpPieces(wantedPieces, 2 - len(connSet['upPieces']))
             if len(pieces) == 0:
@@ -121,7 +121,7 @@ class SuperSeedingHandler:
                 connSet['upPieces'].remove(pieceIndex)
                 self.pieceStatus.decreaseAssignedUploads(pieceIndex)
                 
-                wantedPieces = connStatus.getMatchingMissingPieces(self.ownStatus.getGotPieces())
+                wantedPieces = connStatus.getMatchingMissingPieces(self.ownStatus.getGotPiecesMask())
                 wantedPieces.difference_update(connSet['upPieces'])
                 upPiece = self.pieceStatus.getUpPieces(wantedPieces, 1)
                 assert len(upPiece) <= 1, 'Got more then we want: '+str(len(upPiece))
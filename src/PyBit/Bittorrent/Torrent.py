@@ -17,10 +17,11 @@ You should have received a copy of the GNU General Public License
 along with PyBit.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from Bencoding import bencode, bdecode
+from Bencoding import bdecodeWithRawValues
 from HttpUtilities import i2pHttpUrlRegexObj
 
-from copy import deepcopy
+from array import array
+from bisect import bisect_right
 from hashlib import sha1
 from random import shuffle
 import logging
@@ -28,6 +29,13 @@ import os
 import re
 
 
+#file offsets need 64bit, fall back to doubles (exact up to 2^53) where longs only have 32bit
+if array('L').itemsize >= 8:
+    offsetTypecode = 'L'
+else:
+    offsetTypecode = 'd'
+
+
 
 
 class TorrentException(Exception):
@@ -47,50 +55,47 @@ class Torrent:
         self.createdBy = None
         self.torrentHash = None
         self.torrentName = None
-        self.files = None
+        self.files = None               #tuple of {'path', 'size', 'offset'} dicts, shared with callers of getFiles()
+        self.filePaths = None           #fileIndex => path
+        self.fileOffsets = None         #fileIndex => offset of the first byte of the file
+        self.fileEnds = None            #fileIndex => offset of the first byte after the file
+        self.pieceFirstFile = None      #pieceIndex => index of the file which contains the first byte of the piece
         self.pieceLength = None
-        self.pieceHashes = None
+        self.pieceHashes = None         #all hashes, concatenated
         self.charset = None
         self.log = logging.getLogger('Torrent')
         
-    def _getFileIndexForOffset(self, offset):
-        startPos = 0
-        endPos = len(self.files)-1
-
-        #search using divide and conquer
-        while endPos - startPos > 5:        
-            curPos = startPos + ((endPos - startPos)/2)
-            startOffset = self.files[curPos]['offset']
-            endOffset = startOffset + self.files[curPos]['size']
-            
-            if offset >= endOffset:
-                #right
-                startPos = curPos + 1
-                    
-            elif offset < startOffset:
-                #left
-                endPos = curPos - 1
-            
-            else:
-                #match
-                startPos = curPos
-                endPos = curPos
-                    
-        place = endPos
-        for i in xrange(startPos, endPos):
-            startOffset = self.files[i]['offset']
-            endOffset = startOffset + self.files[i]['size']
-            if offset >= startOffset and offset < endOffset:
-                #found the right spot
-                place = i
-                break
+    def _buildSpanTable(self):
+        #precomputes which files belong to which piece, so that the files of a byte range can be found without searching the whole file list
+        self.filePaths = tuple(fileSet['path'] for fileSet in self.files)
+        self.fileOffsets = array(offsetTypecode, [fileSet['offset'] for fileSet in self.files])
+        self.fileEnds = array(offsetTypecode, [fileSet['offset'] + fileSet['size'] for fileSet in self.files])
         
-        return place
+        pieceAmount = (int(self.fileEnds[-1]) + self.pieceLength - 1) / self.pieceLength
+        self.pieceFirstFile = array('l', [0]) * pieceAmount
+        lastFileIndex = len(self.files) - 1
+        fileIndex = 0
+        for pieceIndex in xrange(0, pieceAmount):
+            offset = pieceIndex * self.pieceLength
+            while fileIndex < lastFileIndex and self.fileEnds[fileIndex] <= offset:
+                fileIndex += 1
+            self.pieceFirstFile[pieceIndex] = fileIndex
+            
+    
+    def _getFileIndexForOffset(self, offset):
+        #only the files between the first files of this and the next piece may contain the offset
+        pieceIndex = offset / self.pieceLength
+        startPos = self.pieceFirstFile[pieceIndex]
+        if pieceIndex + 1 < len(self.pieceFirstFile):
+            endPos = self.pieceFirstFile[pieceIndex + 1] + 1
+        else:
+            endPos = len(self.files)
+        return min(bisect_right(self.fileEnds, offset, startPos, endPos), len(self.files) - 1)
     
 
     def load(self, torrentdata):
-        #decode torrentdata
-        torrentdata = bdecode(torrentdata)
+        #decode torrentdata, keep the raw info dict for the hash
+        torrentdata, rawValues = bdecodeWithRawValues(torrentdata, ('info',))
         
         #encoding
         if 'encoding' in torrentdata:
@@ -156,7 +161,7 @@ class Torrent:
         
         #torrent hash and name
         info = torrentdata['info']
-        self.torrentHash = sha1(bencode(info)).digest()
+        self.torrentHash = sha1(rawValues['info']).digest()
         self.torrentName = unicode(info['name'], self.charset, 'ignore')
 
         #files
@@ -194,13 +199,16 @@ class Torrent:
         #piece length
         self.pieceLength = info['piece length']
         
-        #piece hashes
-        rawpieces = info['pieces']            
-        self.pieceHashes = []
-        place = 0
-        while place < len(rawpieces):
-            self.pieceHashes.append(rawpieces[place:place+20])
-            place += 20
+        #piece hashes, kept in one string and sliced on demand
+        self.pieceHashes = info['pieces']
+        if not len(self.pieceHashes) % 20 == 0:
+            raise TorrentException('Length of piece hashes (%i) is not a multiple of 20!', len(self.pieceHashes))
+            
+        #the file list doesn't change anymore, callers get it without copying
+        self.files = tuple(self.files)
+        
+        #piece to file mapping
+        self._buildSpanTable()
 
     ##torrent data
     def getCreator(self):
@@ -236,52 +244,47 @@ class Torrent:
     ##files
     
     def getFiles(self):
-        return deepcopy(self.files)
+        #returns the internal tuple of file dicts, callers must not modify them
+        return self.files
     
 
     def getAmountOfFiles(self):
         return len(self.files) 
     
     
-    def getFilesForOffset(self, fromOffset, toOffset):
+    def getFilePath(self, fileIndex):
+        return self.filePaths[fileIndex]
+    
+    
+    def getFileSize(self, fileIndex):
+        return int(self.fileEnds[fileIndex] - self.fileOffsets[fileIndex])
+    
+    
+    def getFileOffset(self, fileIndex):
+        return int(self.fileOffsets[fileIndex])
+    
+    
+    def getFileSpansForOffset(self, fromOffset, toOffset):
+        #returns a list of (fileIndex, offset inside the file, bytes) tuples, files without any bytes in the range are skipped
         assert toOffset <= self.getTotalSize(),'toOffset outside of valid range?!'
         
-        #get last and first involved file
-        firstFileIndex = self._getFileIndexForOffset(fromOffset)
-        lastFileIndex = self._getFileIndexForOffset(toOffset-1)
-        
-        result = []
-        #first result
-        firstFile = self.files[firstFileIndex]
-        firstFileResult = {'path':firstFile['path'],
-                           'offset':fromOffset - firstFile['offset']}
-
-        if firstFileIndex == lastFileIndex:
-            #requested offset-range is inside of file
-            firstFileResult['bytes'] = toOffset - firstFile['offset'] - firstFileResult['offset']
-            result.append(firstFileResult)            
-        else:
-            #multiple files involvled
-            firstFileResult['bytes'] = firstFile['size'] - firstFileResult['offset']
-            result.append(firstFileResult)
-            
-            #intermediary results
-            for place in xrange(firstFileIndex+1,lastFileIndex):
-                fl = self.files[place]
-                result.append({'path':fl['path'],
-                              'offset':0,
-                              'bytes':fl['size']})
-            
-            #last result
-            fl = self.files[lastFileIndex]
-            result.append({'path':fl['path'],
-                           'offset':0,
-                           'bytes':toOffset - fl['offset']})
-        return result
+        spans = []
+        for fileIndex in xrange(self._getFileIndexForOffset(fromOffset), self._getFileIndexForOffset(toOffset - 1) + 1):
+            startOffset = max(fromOffset, self.fileOffsets[fileIndex])
+            endOffset = min(toOffset, self.fileEnds[fileIndex])
+            if endOffset > startOffset:
+                spans.append((fileIndex, int(startOffset - self.fileOffsets[fileIndex]), int(endOffset - startOffset)))
+        return spans
+    
+    
+    def getFilesForOffset(self, fromOffset, toOffset):
+        return [{'path':self.filePaths[fileIndex],
+                 'offset':offset,
+                 'bytes':bytes} for fileIndex, offset, bytes in self.getFileSpansForOffset(fromOffset, toOffset)]
     
     
     def getTotalSize(self):
-        return self.files[-1]['offset'] + self.files[-1]['size']
+        return int(self.fileEnds[-1])
     
     
     ##pieces
@@ -290,15 +293,20 @@ class Torrent:
         return self.pieceLength
     
     def getTotalAmountOfPieces(self):
-        return len(self.pieceHashes)
+        return len(self.pieceHashes) / 20
     
     
     def getPieceHashByOffset(self, offset):
-        return self.pieceHashes[offset/self.pieceLength]
+        return self.getPieceHashByPieceIndex(offset/self.pieceLength)
     
 
     def getPieceHashByPieceIndex(self, pieceIndex):
-        return self.pieceHashes[pieceIndex]
+        if pieceIndex < 0:
+            raise IndexError('piece index out of range')
+        pieceHash = self.pieceHashes[pieceIndex*20:pieceIndex*20+20]
+        if not len(pieceHash) == 20:
+            raise IndexError('piece index out of range')
+        return pieceHash
     
 
     def convertPieceIndexToOffset(self, pieceIndex, addOffset = 0):
@@ -340,6 +348,55 @@ class Torrent:
         stats['torrentHash'] = self.torrentHash
         stats['trackerAmount'] = self.amountOfTrackers
         stats['fileAmount'] = len(self.files)
-        stats['pieceAmount'] = len(self.pieceHashes)
+        stats['pieceAmount'] = len(self.pieceHashes) / 20
         stats['pieceLength'] = self.pieceLength
-        return stats
\ No newline at end of file
+        return stats
+
+
+
+
+if __name__ == '__main__':
+    #load-time benchmark with a synthetic torrent, usage: Torrent.py [pieces] [files] [runs]
+    from Bencoding import bencode
+    from time import time
+    import sys
+    
+    pieceAmount = 200000
+    fileAmount = 10000
+    runs = 5
+    if len(sys.argv) > 1:
+        pieceAmount = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        fileAmount = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        runs = int(sys.argv[3])
+        
+    pieceLength = 262144
+    totalSize = pieceAmount * pieceLength
+    fileSize = totalSize / fileAmount
+    files = [{'path':['dir%i' % (fileIdx / 100), 'file%i' % (fileIdx,)], 'length':fileSize} for fileIdx in xrange(0, fileAmount - 1)]
+    files.append({'path':['last'], 'length':totalSize - fileSize * (fileAmount - 1)})
+    torrentData = bencode({'announce':'http://tracker.i2p/announce.php',
+                           'info':{'name':'benchmark',
+                                   'piece length':pieceLength,
+                                   'pieces':''.join(sha1(str(pieceIdx)).digest() for pieceIdx in xrange(0, pieceAmount)),
+                                   'files':files}})
+    
+    print 'Torrent with %i pieces and %i files, %i bytes of metadata' % (pieceAmount, fileAmount, len(torrentData))
+    times = []
+    for run in xrange(0, runs):
+        start = time()
+        torrent = Torrent()
+        torrent.load(torrentData)
+        times.append(time() - start)
+    print 'Load: best %.3f s, average %.3f s (%i runs)' % (min(times), sum(times) / len(times), runs)
+    
+    start = time()
+    for pieceIdx in xrange(0, pieceAmount):
+        torrent.getPieceHashByPieceIndex(pieceIdx)
+    print 'Hash lookups: %.3f s for %i pieces' % (time() - start, pieceAmount)
+    
+    start = time()
+    for pieceIdx in xrange(0, pieceAmount):
+        torrent.getFileSpansForOffset(pieceIdx * pieceLength, (pieceIdx + 1) * pieceLength)
+    print 'Span lookups: %.3f s for %i pieces' % (time() - start, pieceAmount)
@@ -22,11 +22,9 @@ from time import time
 import re
 import threading
 
-from Bencoding import bdecode
 from HttpUtilities import joinUrl, splitUrl
 from Logger import Logger
 from TrackerInfo import PersistentTrackerInfo
-from Utilities import logTraceback
 
 
 class TrackerRequester:
@@ -133,7 +131,9 @@ class TrackerRequester:
                                                        requestTimeout=self.config.get('http', 'trackerRequestTimeout'),\
                                                        maxHeaderSize=self.config.get('http', 'trackerRequestMaxHeaderSize'),\
                                                        maxDataSize=self.config.get('http', 'trackerRequestMaxDataSize'),\
-                                                       maxReqTries=2)
+                                                       maxReqTries=2,\
+                                                       decodeData=True,\
+                                                       storeData=False)
             self.announceHttpRequests.add(requestId)
             self.trackerInfo.setAnnounceTry(trackerSet['id'])
         else:
@@ -141,18 +141,12 @@ class TrackerRequester:
             self.announceEvent = self.sched.scheduleEvent(self.announce, timedelta=60)
         
     
-    def _parseAnnounceResponse(self, trackerSet, data):
+    def _parseAnnounceResponse(self, trackerSet, response):
+        #response is already decoded by the http requester
         url = trackerSet['logUrl']
         result = u'Invalid Response' #May be "Invalid Response", "Request Failed", "No Peers" or "Ok"
         errorMsg = None
         
-        try:
-            response = bdecode(data)
-        except:
-            self.log.warn('Failed to parse announce response from tracker "%s":\n%s', logTraceback(), url)
-            response = None
-        
-        
         if response is not None:
             if not isinstance(response, dict):
                 #whatever this is, its not a standard response
@@ -221,14 +215,19 @@ class TrackerRequester:
         self.announceHttpRequests.remove(response['id'])
         success = response['success']
         
-        if not success:
+        if not success and response['header'] is not None and response['header']['code'] == '200':
+            #got a response, but it isn't valid bencoded data
+            self.log.warn('Failed to parse announce response from tracker "%s": %s', trackerSet['logUrl'], response['failureMsg'])
+            result = u'Invalid Response'
+            errorMsg = None
+        elif not success:
             #http request failed
             result = u'Connect Failed'
             errorMsg = None
         else:
             #http request succeded
             self.log.debug('Got announce response from tracker "%s"', trackerSet['logUrl'])
-            result, errorMsg = self._parseAnnounceResponse(trackerSet, response['data'])
+            result, errorMsg = self._parseAnnounceResponse(trackerSet, response['decodedData'])
             
         if errorMsg is None:
             self.trackerInfo.setAnnounceResult(trackerSet['id'], result)
@@ -320,23 +319,19 @@ class TrackerRequester:
                                                    requestTimeout=self.config.get('http', 'trackerRequestTimeout'),\
                                                    maxHeaderSize=self.config.get('http', 'trackerRequestMaxHeaderSize'),\
                                                    maxDataSize=self.config.get('http', 'trackerRequestMaxDataSize'),\
-                                                   maxReqTries=2)
+                                                   maxReqTries=2,\
+                                                   decodeData=True,\
+                                                   storeData=False)
         self.scrapeHttpRequests.add(requestId)
         self.trackerInfo.setScrapeTry(trackerSet['id'])
         
     
-    def _parseScrapeResponse(self, trackerSet, data):
+    def _parseScrapeResponse(self, trackerSet, response):
+        #response is already decoded by the http requester
         url = trackerSet['scrapeLogUrl']
         infoHash = self.torrent.getTorrentHash()
         valid = False
         
-        try:
-            response = bdecode(data)
-        except:
-            self.log.warn('Failed to parse scrape response from tracker "%s":\n%s', url, logTraceback())
-            response = None
-        
-        
         if response is not None:
             if not isinstance(response, dict):
                 #whatever this is, its not a standard response
@@ -416,7 +411,7 @@ class TrackerRequester:
         if success:
             #got data
             self.log.debug('Got scrape response from tracker "%s"', trackerSet['logUrl'])
-            valid = self._parseScrapeResponse(trackerSet, response['data'])
+            valid = self._parseScrapeResponse(trackerSet, response['decodedData'])
         
         if success and valid:
             #success
@@ -878,6 +878,105 @@ class Storage_ConfigPanel(wx.Panel):
         self.check2.SetValue(self.config.getBool('storage','persistPieceStatus'))
         storageRealItems.Add(self.check2, 1)
         
+        #max open files
+        label3 = wx.StaticText(self, -1, "Max open files:")
+        label3.SetToolTipString('Maximum number of data files which are kept open at the same time (shared by all torrents)')
+        storageRealItems.Add(label3, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin1 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin1.SetRange(1, 1024)
+        self.spin1.SetValue(self.config.get('storage','maxOpenFiles'))
+        self.spin1.SetToolTipString('Maximum number of data files which are kept open at the same time (shared by all torrents)')
+        storageRealItems.Add(self.spin1, 1)
+        
+        #piece buffer size
+        label4 = wx.StaticText(self, -1, "Piece buffer size (KB):")
+        label4.SetToolTipString('Maximum amount of memory which is used for collecting the blocks of unfinished pieces before they are written to disk (shared by all torrents)')
+        storageRealItems.Add(label4, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin2 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin2.SetRange(0, 1048576)
+        self.spin2.SetValue(self.config.get('storage','pieceBufferSize')/1024)
+        self.spin2.SetToolTipString('Maximum amount of memory which is used for collecting the blocks of unfinished pieces before they are written to disk (shared by all torrents)')
+        storageRealItems.Add(self.spin2, 1)
+        
+        #read cache
+        label9 = wx.StaticText(self, -1, "Read cache (KB):")
+        label9.SetToolTipString('Maximum amount of memory which is used for caching data read from disk, mainly for uploads (shared by all torrents)')
+        storageRealItems.Add(label9, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin6 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin6.SetRange(0, 1048576)
+        self.spin6.SetValue(self.config.get('storage','readCacheSize')/1024)
+        self.spin6.SetToolTipString('Maximum amount of memory which is used for caching data read from disk, mainly for uploads (shared by all torrents)')
+        storageRealItems.Add(self.spin6, 1)
+        
+        #disk threads
+        label5 = wx.StaticText(self, -1, "Disk threads:")
+        label5.SetToolTipString('Number of threads which read and write data in the background (shared by all torrents)')
+        storageRealItems.Add(label5, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin3 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin3.SetRange(1, 16)
+        self.spin3.SetValue(self.config.get('storage','diskThreads'))
+        self.spin3.SetToolTipString('Number of threads which read and write data in the background (shared by all torrents)')
+        storageRealItems.Add(self.spin3, 1)
+        
+        #check threads
+        label6 = wx.StaticText(self, -1, "Hashing threads:")
+        label6.SetToolTipString('Number of threads which hash the data of a torrent when checking which pieces are already finished')
+        storageRealItems.Add(label6, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin4 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin4.SetRange(1, 16)
+        self.spin4.SetValue(self.config.get('storage','checkThreads'))
+        self.spin4.SetToolTipString('Number of threads which hash the data of a torrent when checking which pieces are already finished')
+        storageRealItems.Add(self.spin4, 1)
+        
+        #concurrent checks
+        label7 = wx.StaticText(self, -1, "Max concurrent checks:")
+        label7.SetToolTipString('Maximum number of torrents which may check their data at the same time (torrents further up in the queue are checked first)')
+        storageRealItems.Add(label7, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin5 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin5.SetRange(1, 16)
+        self.spin5.SetValue(self.config.get('storage','maxConcurrentChecks'))
+        self.spin5.SetToolTipString('Maximum number of torrents which may check their data at the same time (torrents further up in the queue are checked first)')
+        storageRealItems.Add(self.spin5, 1)
+        
+        #allocation mode
+        label8 = wx.StaticText(self, -1, "Default allocation mode:")
+        label8.SetToolTipString('Determines how files are allocated: Sparse (only set the file size), Full (reserve the space, where supported) or Compat (grow files step by step). Can be overwritten per torrent.')
+        storageRealItems.Add(label8, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.combo1 = wx.ComboBox(self, -1, size = wx.Size(85, -1),\
+                                  choices=["Sparse", "Full", "Compat"], style=wx.CB_READONLY)
+        self.combo1.SetValue(self.config.get('storage','allocationMode').capitalize())
+        self.combo1.SetToolTipString('Determines how files are allocated: Sparse (only set the file size), Full (reserve the space, where supported) or Compat (grow files step by step). Can be overwritten per torrent.')
+        storageRealItems.Add(self.combo1, 1)
+        
+        #storage backend
+        label10 = wx.StaticText(self, -1, "Default storage backend:")
+        label10.SetToolTipString('Determines how data files are accessed: File (normal reads and writes) or Mmap (memory mapped files, the read cache of the operating system is used). Can be overwritten per torrent.')
+        storageRealItems.Add(label10, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.combo2 = wx.ComboBox(self, -1, size = wx.Size(85, -1),\
+                                  choices=["File", "Mmap"], style=wx.CB_READONLY)
+        self.combo2.SetValue(self.config.get('storage','backend').capitalize())
+        self.combo2.SetToolTipString('Determines how data files are accessed: File (normal reads and writes) or Mmap (memory mapped files, the read cache of the operating system is used). Can be overwritten per torrent.')
+        storageRealItems.Add(self.combo2, 1)
+        
+        #max mapped bytes
+        label11 = wx.StaticText(self, -1, "Max mapped data (KB):")
+        label11.SetToolTipString('Maximum amount of data files which is memory mapped at the same time by torrents which use the mmap backend (shared by all torrents)')
+        storageRealItems.Add(label11, 1, wx.ALIGN_CENTER_VERTICAL)
+        
+        self.spin7 = wx.SpinCtrl(self, -1, size=wx.Size(80,-1))
+        self.spin7.SetRange(16384, 16777216)
+        self.spin7.SetValue(self.config.get('storage','maxMappedBytes')/1024)
+        self.spin7.SetToolTipString('Maximum amount of data files which is memory mapped at the same time by torrents which use the mmap backend (shared by all torrents)')
+        storageRealItems.Add(self.spin7, 1)
+        
         #build up comment box 
         commentLabel = wx.StaticText(self, -1, 'Storing progress information on disk is commonly called "fast resume", '+\
                                                'meaning that with the help of the stored information torrents can be '+\
@@ -902,6 +1001,15 @@ class Storage_ConfigPanel(wx.Panel):
     def saveConfig(self, optionDict):
         optionDict[('storage', 'skipFileCheck')] = self.check1.GetValue()
         optionDict[('storage', 'persistPieceStatus')] = self.check2.GetValue()
+        optionDict[('storage', 'maxOpenFiles')] = self.spin1.GetValue()
+        optionDict[('storage', 'pieceBufferSize')] = self.spin2.GetValue()*1024
+        optionDict[('storage', 'readCacheSize')] = self.spin6.GetValue()*1024
+        optionDict[('storage', 'diskThreads')] = self.spin3.GetValue()
+        optionDict[('storage', 'checkThreads')] = self.spin4.GetValue()
+        optionDict[('storage', 'maxConcurrentChecks')] = self.spin5.GetValue()
+        optionDict[('storage', 'allocationMode')] = str(self.combo1.GetValue().lower())
+        optionDict[('storage', 'backend')] = str(self.combo2.GetValue().lower())
+        optionDict[('storage', 'maxMappedBytes')] = self.spin7.GetValue()*1024
 
 
 
@@ -1184,7 +1292,16 @@ if __name__ == "__main__":
                                'downloadFolder':(u'/tmp', 'unicode')},
                       'requester':{'strictAvailabilityPrio':(True, 'bool')},
                       'storage':{'persistPieceStatus':(True, 'bool'),
-                                 'skipFileCheck':(False, 'bool')},
+                                 'skipFileCheck':(False, 'bool'),
+                                 'maxOpenFiles':(64, 'int'),
+                                 'pieceBufferSize':(16777216, 'int'),
+                                 'readCacheSize':(8388608, 'int'),
+                                 'diskThreads':(2, 'int'),
+                                 'checkThreads':(2, 'int'),
+                                 'maxConcurrentChecks':(1, 'int'),
+                                 'allocationMode':('sparse', 'str'),
+                                 'backend':('file', 'str'),
+                                 'maxMappedBytes':(268435456, 'int')},
                       'tracker':{'announceInterval':(3600, 'int'),
                                  'scrapeInterval':(3600, 'int'),
                                  'clearOldScrapeStats':(True, 'bool'),
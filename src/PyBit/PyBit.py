@@ -90,7 +90,16 @@ class PyBit:
                                    'downloadFolder':(self.progPath, 'unicode')},
                           'requester':{'strictAvailabilityPrio':(True, 'bool')},
                           'storage':{'persistPieceStatus':(True, 'bool'),
-                                     'skipFileCheck':(False, 'bool')},
+                                     'skipFileCheck':(False, 'bool'),
+                                     'maxOpenFiles':(64, 'int'),
+                                     'pieceBufferSize':(16777216, 'int'),
+                                     'readCacheSize':(8388608, 'int'),
+                                     'diskThreads':(2, 'int'),
+                                     'checkThreads':(2, 'int'),
+                                     'maxConcurrentChecks':(1, 'int'),
+                                     'allocationMode':('sparse', 'str'),
+                                     'backend':('file', 'str'),
+                                     'maxMappedBytes':(268435456, 'int')},
                           'tracker':{'announceInterval':(3600, 'int'),
                                      'scrapeInterval':(3600, 'int'),
                                      'clearOldScrapeStats':(True, 'bool'),
@@ -191,6 +191,22 @@ class TorrentList(PersistentVirtualListCtrl):
                 
             self.dataUpdate()
             
+            
+    def OnSetAllocationMode(self, mode):
+        #sets the allocation mode of all selected torrents
+        with self.lock:
+            for row in self._getSelectedRows():
+                torrentId = self._getRawData('Id', row)
+                self.torrentHandler.setAllocationMode(torrentId, mode)
+                
+                
+    def OnSetStorageBackend(self, backend):
+        #sets the storage backend of all selected torrents
+        with self.lock:
+            for row in self._getSelectedRows():
+                torrentId = self._getRawData('Id', row)
+                self.torrentHandler.setStorageBackend(torrentId, backend)
+            
         
     def OnRightClick(self, event):
         with self.lock:
@@ -250,6 +266,46 @@ class TorrentListOptionsPopup(wx.Menu):
         
         self.AppendSubMenu(superseedingMenu, 'Superseeding', 'Enable superseeding?')
         
+        #allocation menu
+        allocationMenu = wx.Menu()
+        allocationMenu.SetEventHandler(self)
+        
+        id = wx.NewId()
+        allocationMenu.AppendCheckItem(id, 'Default', 'Use the allocation mode of the config for all selected torrents')
+        self.Bind(wx.EVT_MENU, self.OnDefaultAllocation, id=id)
+        
+        id = wx.NewId()
+        allocationMenu.AppendCheckItem(id, 'Sparse', 'Only set the size of the files of all selected torrents (fast, space is used as data arrives)')
+        self.Bind(wx.EVT_MENU, self.OnSparseAllocation, id=id)
+        
+        id = wx.NewId()
+        allocationMenu.AppendCheckItem(id, 'Full', 'Reserve the space for the files of all selected torrents (fast where supported by the filesystem)')
+        self.Bind(wx.EVT_MENU, self.OnFullAllocation, id=id)
+        
+        id = wx.NewId()
+        allocationMenu.AppendCheckItem(id, 'Compatible', 'Grow the files of all selected torrents step by step (slow, works everywhere)')
+        self.Bind(wx.EVT_MENU, self.OnCompatAllocation, id=id)
+        
+        self.AppendSubMenu(allocationMenu, 'Allocation', 'How should the files be allocated?')
+        
+        #backend menu
+        backendMenu = wx.Menu()
+        backendMenu.SetEventHandler(self)
+        
+        id = wx.NewId()
+        backendMenu.AppendCheckItem(id, 'Default', 'Use the storage backend of the config for all selected torrents')
+        self.Bind(wx.EVT_MENU, self.OnDefaultBackend, id=id)
+        
+        id = wx.NewId()
+        backendMenu.AppendCheckItem(id, 'File', 'Access the files of all selected torrents with normal reads and writes')
+        self.Bind(wx.EVT_MENU, self.OnFileBackend, id=id)
+        
+        id = wx.NewId()
+        backendMenu.AppendCheckItem(id, 'Mmap', 'Memory map the files of all selected torrents (good for seeding, uses the read cache of the operating system)')
+        self.Bind(wx.EVT_MENU, self.OnMmapBackend, id=id)
+        
+        self.AppendSubMenu(backendMenu, 'Storage backend', 'How should the files be accessed?')
+        
         
     def OnStart(self, event):
         self.torrentList.OnStart(None)
@@ -280,4 +336,32 @@ class TorrentListOptionsPopup(wx.Menu):
         
         
     def OnDisableSuperSeeding(self, event):
-        self.torrentList.OnSetSuperSeeding(False)
\ No newline at end of file
+        self.torrentList.OnSetSuperSeeding(False)
+        
+        
+    def OnDefaultAllocation(self, event):
+        self.torrentList.OnSetAllocationMode(None)
+        
+        
+    def OnSparseAllocation(self, event):
+        self.torrentList.OnSetAllocationMode('sparse')
+        
+        
+    def OnFullAllocation(self, event):
+        self.torrentList.OnSetAllocationMode('full')
+        
+        
+    def OnCompatAllocation(self, event):
+        self.torrentList.OnSetAllocationMode('compat')
+        
+        
+    def OnDefaultBackend(self, event):
+        self.torrentList.OnSetStorageBackend(None)
+        
+        
+    def OnFileBackend(self, event):
+        self.torrentList.OnSetStorageBackend('file')
+        
+        
+    def OnMmapBackend(self, event):
+        self.torrentList.OnSetStorageBackend('mmap')
\ No newline at end of file